@@ -0,0 +1,220 @@
+# OSIRIS END-TO-END BENCHMARK
+# Times every stage of the chain on a (synthetic) EventTree file and records events/s and peak RSS
+# Authors: Davide Basilico davide.basilico@mi.infn.it, Marco Beretta marco.beretta@mi.infn.it
+
+import os
+import json
+import time
+import argparse
+import multiprocessing
+from argparse import RawTextHelpFormatter
+import numpy as np
+import pandas as pd
+import uproot
+from EventReader import read_chunks, entry_step
+from HitTable import concatenate_hits, table_dtypes
+from WaveformAnalyzer import analyze_file, budget_step_size
+from EventReconstruction import process_data, apply_muon_veto, add_energies
+from Coincidence import find_coincidences, Po_tau, hmTau
+from SyntheticEventTree import generate_run, MUON, PROMPT
+from Instrumentation import peak_rss_MB
+from VertexFit import VertexFitter, CONVERGED
+
+def parse_arguments():
+	prs = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter)
+	prs.add_argument("-i", "--InputFile", default="null", help="EventTree ROOT file; default: a synthetic run generated with --duration and --seed")
+	prs.add_argument("-t", "--duration", type=float, default=20., help="Duration of the synthetic run in s; default: 20")
+	prs.add_argument("--seed", type=int, default=1, help="Seed of the synthetic run; default: 1")
+	prs.add_argument("-w", "--workers", type=int, default=1, help="Worker processes for the waveform analysis; default: 1")
+	prs.add_argument("-s", "--step_size", default="50 MB", help="EventTree chunk size; default: 50 MB")
+	prs.add_argument("-o", "--OutputFile", default="null", help="JSON file for the results; default: none")
+	prs.add_argument("--baseline", default="null", help="JSON file of a previous benchmark: stages slower by more than --tolerance are reported")
+	prs.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative slowdown with respect to --baseline; default: 0.2")
+	prs.add_argument("--compact", default="false", help="Also run the waveform analysis and the reconstruction in the default and in the memory-efficient mode\n(one process each), report their peak RSS and check the outputs against compact_tolerances; default: false")
+	prs.add_argument("--memory_budget", default="null", help="Memory budget of the memory-efficient run (e.g. '200 MB'); default: --step_size")
+	prs.add_argument("--cleaning", default="false", help="Low-pass FFT cleaning in the --compact comparison; default: false")
+	return prs.parse_args()
+
+class StageTimer:
+	def __init__(self):
+		self.stages = {}
+
+	def run(self, name, n_events, function, *args, **kwargs):
+		time_start = time.perf_counter()
+		cpu_start = time.process_time()
+		result = function(*args, **kwargs)
+		wall = time.perf_counter() - time_start
+		self.stages[name] = {
+			'wall_s': wall,
+			'cpu_s': time.process_time() - cpu_start,
+			'events': int(n_events),
+			'events_per_s': n_events / wall if wall > 0 else np.inf,
+			'peak_rss_MB': peak_rss_MB()
+		}
+		print(f"{name:<20s} {wall:8.3f} s  {self.stages[name]['events_per_s']:12.0f} events/s  peak RSS {self.stages[name]['peak_rss_MB']:8.1f} MB")
+		return result
+
+def read_stage(input_file, step_size):
+	tree = uproot.open(input_file)['EventTree']
+	n_bytes = 0
+	for chunk in read_chunks(tree, 0, tree.num_entries, entry_step(step_size)):
+		n_bytes += chunk['samples'].nbytes
+	return n_bytes
+
+def analysis_stage(input_file, workers, step_size):
+	return pd.DataFrame(concatenate_hits(list(analyze_file(input_file, workers, step_size, use_cache="false"))))
+
+def vertex_stage(hits, vertex_fitter):
+	return process_data(hits, vertex_fitter)
+
+def coincidence_stage(results):
+	events = add_energies(results).events
+	return find_coincidences(events, Po_tau * hmTau, energy='Energy_Prompt')
+
+# Tolerances of the memory-efficient mode (--compact true) with respect to the default outputs, as (atol, rtol) of numpy.isclose:
+# charges, PMT positions and gains are stored in float32 (relative 1e-7), and with cleaning the cleaned waveforms too (a few
+# 0.01 in the charge of a hit); integers and times are exact. Up to compact_max_mismatch of the rows may be outside: with
+# cleaning a few rise times move by one or more samples (about 1e-4 of the hits), and so do the charges of their events,
+# and the barycenters of events with little charge.
+compact_tolerances = {
+	'hits': {
+		'index': (0, 0), 'charge': (0.1, 1e-6), 'GCU': (0, 0), 'WF_RiseTime': (0, 0), 'trgTime': (0, 0), 'ID_channel': (0, 0),
+		'GCUID': (0, 0), 'x_PMT': (1e-3, 0), 'y_PMT': (1e-3, 0), 'z_PMT': (1e-3, 0), 'LivePMTs': (0, 0), 'gain': (0, 1e-6),
+		'OD': (0, 0), 'Shape_Ch': (0, 0)
+	},
+	'events': {
+		'Charge': (0.5, 1e-6), 'Fired_PMTs': (0, 0), 'Charge_Norm': (0.05, 1e-6), 'Charge_Norm_OD': (0.05, 1e-6), 'Charge_Norm_ID': (0.05, 1e-6),
+		'x_CM': (0.05, 0), 'y_CM': (0.05, 0), 'z_CM': (0.05, 0), 'trgTime': (0, 0), 'trgTime_aligned': (0, 0), 'OD_fired': (0, 0),
+		'Shape_Ch': (0, 0), 'Hits': (0, 0)
+	}
+}
+compact_max_mismatch = 1e-3
+
+def pipeline_run(input_file, workers, step_size, cleaning, compact):
+	# Waveform analysis and reconstruction of a whole run, in a process of its own: returns the hits, the events,
+	# the size of the hit table and the peak RSS of the process
+	dtypes = table_dtypes('false', compact)
+	hits = pd.DataFrame(concatenate_hits(list(analyze_file(input_file, workers, step_size, cleaning, use_cache="false", compact=compact)), dtypes))
+	results = process_data(hits).events
+	return hits, results, int(hits.memory_usage(deep=True).sum()), peak_rss_MB()
+
+def format_distance(distance):
+	return "n/a" if distance is None else f"{distance:.0f} mm"
+
+def outside_tolerances(reference, table, tolerances):
+	# Fraction of the rows of each column outside its tolerances (all of them if the tables have different rows)
+	if len(reference) != len(table) or not np.array_equal(reference.index.to_numpy(), table.index.to_numpy()):
+		return {name: 1. for name in tolerances}
+	fractions = {}
+	for name, (atol, rtol) in tolerances.items():
+		expected = reference[name].to_numpy(dtype=np.float64)
+		outside = ~np.isclose(table[name].to_numpy(dtype=np.float64), expected, atol=atol, rtol=rtol, equal_nan=True)
+		fractions[name] = float(outside.mean()) if len(expected) > 0 else 0.
+	return fractions
+
+def compact_comparison(input_file, workers, step_size, cleaning, memory_budget="null"):
+	# Default (float64, --step_size) against memory-efficient run (--compact true, --memory_budget), one fresh process each
+	# so that the peak RSS of one does not hide that of the other
+	compact_step = budget_step_size(input_file, memory_budget, workers, cleaning, "true", use_cache="false") if memory_budget != "null" else step_size
+	runs = {}
+	for mode, mode_step in (("default", step_size), ("compact", compact_step)):
+		with multiprocessing.get_context("spawn").Pool(1) as pool:
+			runs[mode] = pool.apply(pipeline_run, (input_file, workers, entry_step(mode_step), cleaning, "true" if mode == "compact" else "false"))
+	(hits, results, hit_bytes, rss), (compact_hits, compact_results, compact_hit_bytes, compact_rss) = runs["default"], runs["compact"]
+	outside = {'hits': outside_tolerances(hits, compact_hits, compact_tolerances['hits']),
+		'events': outside_tolerances(results, compact_results, compact_tolerances['events'])}
+	failed = [f"{table}.{name}" for table, fractions in outside.items() for name, fraction in fractions.items() if fraction > compact_max_mismatch]
+	print(f"Peak RSS: default {rss:.1f} MB, compact {compact_rss:.1f} MB ({100. * (compact_rss / rss - 1.):+.1f}%); "
+		f"hit table {hit_bytes / 1e6:.1f} MB -> {compact_hit_bytes / 1e6:.1f} MB")
+	for name in failed:
+		table, column = name.split(".")
+		print(f"OUT OF TOLERANCE {name}: {100. * outside[table][column]:.3f}% of the rows")
+	if len(failed) == 0:
+		print(f"Compact outputs within tolerances: {len(compact_hits)} hits, {len(compact_results)} events")
+	return {
+		'step_size': str(step_size),
+		'compact_step_size': str(compact_step),
+		'cleaning': cleaning,
+		'peak_rss_MB': rss,
+		'compact_peak_rss_MB': compact_rss,
+		'hit_table_MB': hit_bytes / 1e6,
+		'compact_hit_table_MB': compact_hit_bytes / 1e6,
+		'outside_tolerances': outside,
+		'failed': failed
+	}
+
+def compare(stages, baseline_file, tolerance, min_wall=0.05):
+	# Stages that took less than min_wall in the baseline are too short to be timed reliably and are skipped
+	with open(baseline_file) as f:
+		baseline = json.load(f)['stages']
+	regressions = []
+	for name, stage in stages.items():
+		if name in baseline and baseline[name]['wall_s'] >= min_wall and stage['events_per_s'] < baseline[name]['events_per_s'] * (1. - tolerance):
+			regressions.append(name)
+			print(f"REGRESSION {name}: {stage['events_per_s']:.0f} events/s against {baseline[name]['events_per_s']:.0f}")
+	return regressions
+
+def main():
+	args = parse_arguments()
+	print("### Welcome to the HORUS benchmark ###")
+	timer = StageTimer()
+
+	input_file = args.InputFile
+	if input_file == "null":
+		input_file = f"benchmark_{args.seed}_20240101_000000.root"
+		n_generated = generate_run(input_file, duration=args.duration, seed=args.seed)
+		print(f"Synthetic run: {input_file} ({n_generated} events)")
+	n_entries = uproot.open(input_file)['EventTree'].num_entries
+
+	n_bytes = timer.run("read", n_entries, read_stage, input_file, args.step_size)
+	hits = timer.run("waveform_analysis", n_entries, analysis_stage, input_file, args.workers, args.step_size)
+	process_data(hits.iloc[:0])  # compiles (or loads) the numba kernels outside of the timing
+	results = timer.run("reconstruction", hits['index'].nunique(), process_data, hits)
+	with VertexFitter(args.workers) as vertex_fitter:
+		if len(hits) > 0:
+			process_data(hits[hits['index'] <= hits['index'].iloc[min(len(hits) - 1, 1000)]], vertex_fitter)  # compiles (or loads) the fit
+		fitted = timer.run("vertex_fit", len(results), vertex_stage, hits, vertex_fitter)
+	print(vertex_fitter.summary())
+	survivors = timer.run("muon_veto", len(results), apply_muon_veto, results, 5, 20E-6)
+	pairs = timer.run("coincidence", len(survivors), coincidence_stage, survivors)
+
+	summary = {
+		'input_file': os.path.abspath(input_file),
+		'entries': int(n_entries),
+		'read_MB_per_s': n_bytes / 1e6 / timer.stages['read']['wall_s'],
+		'hits': len(hits),
+		'events': len(results),
+		'events_after_veto': len(survivors),
+		'coincidences': len(pairs),
+		'workers': args.workers,
+		'step_size': args.step_size,
+		'stages': timer.stages
+	}
+	with uproot.open(input_file) as f:
+		if "SyntheticTruth" in f:
+			kind = f["SyntheticTruth"]["kind"].array(library="np")
+			summary['injected_muons'] = int(np.count_nonzero(kind == MUON))
+			summary['injected_bipo'] = int(np.count_nonzero(kind == PROMPT))
+			# Median distance from the true vertex of the converged fits and of their barycenters
+			truth = f["SyntheticTruth"].arrays(["x", "y", "z"], library="np")
+			converged = fitted.events['Vertex_Status'].to_numpy() == CONVERGED
+			event = fitted.events.index.to_numpy()[converged]
+			true_vertex = np.column_stack([truth[name][event] for name in ("x", "y", "z")])
+			for name, columns in (('vertex_fit', ['x_fit', 'y_fit', 'z_fit']), ('barycenter', ['x_CM', 'y_CM', 'z_CM'])):
+				summary[f'{name}_median_distance_mm'] = float(np.median(np.linalg.norm(fitted.events[columns].to_numpy()[converged] - true_vertex, axis=1))) if converged.any() else None
+			print(f"Vertex: median distance from the true vertex {format_distance(summary['vertex_fit_median_distance_mm'])} (barycenter {format_distance(summary['barycenter_median_distance_mm'])})")
+	print(f"Hits: {summary['hits']}; events: {summary['events']}; after veto: {summary['events_after_veto']}; coincidences: {summary['coincidences']}")
+	if args.compact == "true":
+		summary['compact'] = compact_comparison(input_file, args.workers, args.step_size, args.cleaning, args.memory_budget)
+
+	if args.OutputFile != "null":
+		with open(args.OutputFile, 'w') as f:
+			json.dump(summary, f, indent=2)
+		print(f"Benchmark results written: {args.OutputFile}")
+	if args.baseline != "null" and len(compare(timer.stages, args.baseline, args.tolerance)) > 0:
+		raise SystemExit(1)
+	if args.compact == "true" and len(summary['compact']['failed']) > 0:
+		raise SystemExit(1)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,74 @@
+import os
+import numpy as np
+from functools import lru_cache
+
+# Dense lookup tables for the OSIRIS cable map, indexed by (GCUID, GCU channel).
+# The readout channelID carries high/low gain in its lowest bit, so GCU channel = channelID // 2.
+
+table_names = ('x', 'y', 'z', 'gain_corr', 'OD', 'live')
+cable_map_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "OSIRIS_cable_map_N.conf")
+cache_version = 2  # bumped when the tables change meaning, so that older caches are rebuilt
+
+# OD PMTs as (GCUID, high-gain channelID), as in the original WaveformAnalyzer. Only these are OD: the map also marks
+# as VETO the cells of GCU channels 3-5 of the same GCUs, which are not used as OD.
+OD_ids = [(17,1), (18,1), (19,5), (20,1), (37, 3), (38,1), (38,5), (39,1), (40,1), (42, 1), (42, 5), (43, 3)]
+
+class CableMap:
+	def __init__(self, x, y, z, gain_corr, OD, live):
+		self.x = x
+		self.y = y
+		self.z = z
+		self.gain_corr = gain_corr
+		self.OD = OD
+		self.live = live
+		self.n_GCU, self.n_channels = x.shape
+		self.padded = [np.append(table.ravel(), np.zeros(1, dtype=table.dtype)) for table in (x, y, z, gain_corr, OD, live)]
+
+	def flat_index(self, GCUID, channelID):
+		# Pairs outside the table are sent to the last cell, which is never live
+		GCUID = np.asarray(GCUID, dtype=np.int64)
+		channel = np.asarray(channelID, dtype=np.int64) // 2
+		inside = (GCUID >= 0) & (GCUID < self.n_GCU) & (channel >= 0) & (channel < self.n_channels)
+		return np.where(inside, GCUID * self.n_channels + channel, self.x.size)
+
+	def gather(self, GCUID, channelID):
+		# Returns x, y, z, gain_corr, OD, live for every (GCUID, channelID) pair
+		idx = self.flat_index(GCUID, channelID)
+		return tuple(table[idx] for table in self.padded)
+
+def parse_cable_map(file_path):
+	rows = []
+	with open(file_path, 'r') as file:
+		for line in file:
+			columns = line.strip().split('\t')
+			if len(columns) > 14:
+				rows.append((int(columns[1]), int(columns[3]), float(columns[11]), float(columns[12]), float(columns[13]), float(columns[14])))
+
+	GCUID, channel, x, y, z, gain_corr = (np.array(column) for column in zip(*rows))
+	shape = (GCUID.max() + 1, channel.max() + 1)
+	tables = {}
+	for name, values in (('x', x), ('y', y), ('z', z), ('gain_corr', gain_corr), ('live', gain_corr != 0)):
+		tables[name] = np.zeros(shape, dtype=values.dtype)
+		tables[name][GCUID, channel] = values
+	tables['OD'] = np.zeros(shape, dtype=bool)
+	for OD_GCUID, OD_channelID in OD_ids:
+		tables['OD'][OD_GCUID, OD_channelID // 2] = True
+	return tables
+
+@lru_cache(maxsize=None)
+def load_cable_map(file_path=cable_map_file, cache=True):
+	# The parsed tables are cached next to the map and rebuilt when the map changes
+	cache_path = file_path + ".npz"
+	stamp = np.array([os.path.getmtime(file_path), os.path.getsize(file_path), cache_version])
+	if cache and os.path.exists(cache_path):
+		with np.load(cache_path) as cached:
+			if np.array_equal(cached['stamp'], stamp):
+				return CableMap(*(cached[name] for name in table_names))
+
+	tables = parse_cable_map(file_path)
+	if cache:
+		try:
+			np.savez(cache_path, stamp=stamp, **tables)
+		except OSError:
+			pass
+	return CableMap(*(tables[name] for name in table_names))
@@ -0,0 +1,196 @@
+# OSIRIS Bi-Po COINCIDENCE SEARCH
+# Authors: Davide Basilico davide.basilico@mi.infn.it, Marco Beretta marco.beretta@mi.infn.it
+
+import os
+import numpy as np
+import pandas as pd
+import uproot
+import argparse
+from argparse import RawTextHelpFormatter
+from multiprocessing import Pool
+from Instrumentation import RunReport, profile_modes
+from EventStore import EventStore, is_store
+
+Po_tau = 237E-6  # mean life time
+hmTau = 5  # how many Tau
+EB_min = 0.0  # Bismuth cuts
+EB_max = 3.5
+EP_min = 0.6  # Polonium cuts
+EP_max = 1.3
+r_cut = 5000  # no cut for now
+
+pair_dtypes = {
+    'prompt_index': np.int64,
+    'delayed_index': np.int64,
+    'prompt_trgTime': np.float64,
+    'delayed_trgTime': np.float64,
+    'dt': np.float64,
+    'prompt_energy': np.float64,
+    'delayed_energy': np.float64,
+    'distance': np.float64
+}
+
+def parse_arguments():
+    prs = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter)
+    prs.add_argument("-i", "--InputFile", nargs="+", required=True, help="RecEvents ROOT file(s) from EventReconstruction, or event store directories (see EventStore.py)")
+    prs.add_argument("-o", "--OutputFile", default="null", help="Output ROOT file with the BiPo pair tree; default: none")
+    prs.add_argument("--Po_tau", type=float, default=Po_tau, help="Po mean life in s; default: 237e-6")
+    prs.add_argument("--hmTau", type=float, default=hmTau, help="Coincidence window in units of Po_tau; default: 5")
+    prs.add_argument("--EB_min", type=float, default=EB_min, help="Prompt (Bi) minimum energy in MeV; default: 0.0")
+    prs.add_argument("--EB_max", type=float, default=EB_max, help="Prompt (Bi) maximum energy in MeV; default: 3.5")
+    prs.add_argument("--EP_min", type=float, default=EP_min, help="Delayed (Po) minimum energy in MeV; default: 0.6")
+    prs.add_argument("--EP_max", type=float, default=EP_max, help="Delayed (Po) maximum energy in MeV; default: 1.3")
+    prs.add_argument("--r_cut", type=float, default=r_cut, help="Maximum prompt-delayed distance in mm; default: 5000")
+    prs.add_argument("--t_min", type=float, default=None, help="Only events with trgTime >= t_min (s); default: none")
+    prs.add_argument("--t_max", type=float, default=None, help="Only events with trgTime <= t_max (s); default: none")
+    prs.add_argument("--accidentals", type=int, default=0, help="Number of random time offsets for the accidental background; default: 0 (off)")
+    prs.add_argument("--offset_min", type=float, default=0.01, help="Minimum accidental offset in s; default: 0.01")
+    prs.add_argument("--offset_max", type=float, default=1.0, help="Maximum accidental offset in s; default: 1.0")
+    prs.add_argument("--seed", type=int, default=None, help="Random seed for the accidental offsets")
+    prs.add_argument("-w", "--workers", type=int, default=1, help="Number of worker processes for the accidentals; default: 1")
+    prs.add_argument("--profile", default="false", choices=profile_modes, help="Profile the run: cprofile (OutputFile.prof) or sample (in the report); default: false")
+    return prs.parse_args()
+
+def preselect(events, EB_min=EB_min, EB_max=EB_max, EP_min=EP_min, EP_max=EP_max, energy='Energy'):
+    # Time-sorted prompt and delayed candidates; `order` is the rank in time of every candidate,
+    # used to keep only delayed events that come after the prompt when the window starts at 0
+    trgTime = events['trgTime'].to_numpy(dtype=float)
+    E = events[energy].to_numpy(dtype=float)
+    valid = ~np.isnan(trgTime)
+    sorted_events = np.flatnonzero(valid)[np.argsort(trgTime[valid], kind='stable')]
+
+    candidates = {}
+    for name, selected in (('prompt', (EB_min < E) & (E < EB_max)), ('delayed', (EP_min <= E) & (E <= EP_max) & (E < EB_max))):
+        rank = np.flatnonzero(selected[sorted_events])
+        rows = sorted_events[rank]
+        candidates[name] = {
+            'row': rows,
+            'order': rank,
+            'trgTime': trgTime[rows],
+            'energy': E[rows],
+            'position': np.column_stack([events[axis].to_numpy(dtype=float)[rows] for axis in ('x_CM', 'y_CM', 'z_CM')])
+        }
+    return candidates
+
+def search_pairs(candidates, window, offset=0., r_cut=r_cut):
+    # All (prompt, delayed) pairs with offset <= dt < offset + window and distance < r_cut
+    prompt, delayed = candidates['prompt'], candidates['delayed']
+    lo = np.searchsorted(delayed['trgTime'], prompt['trgTime'] + offset, side='left')
+    if offset <= 0:
+        lo = np.maximum(lo, np.searchsorted(delayed['order'], prompt['order'], side='right'))
+    hi = np.searchsorted(delayed['trgTime'], prompt['trgTime'] + offset + window, side='right')
+    n_pairs = np.clip(hi - lo, 0, None)
+
+    p = np.repeat(np.arange(len(lo)), n_pairs)
+    d = np.arange(n_pairs.sum()) - np.repeat(np.cumsum(n_pairs) - n_pairs, n_pairs) + np.repeat(lo, n_pairs)
+    dt = delayed['trgTime'][d] - prompt['trgTime'][p]
+    distance = np.sqrt(np.sum((delayed['position'][d] - prompt['position'][p]) ** 2, axis=1))
+    selected = (dt >= offset) & (dt < offset + window) & (distance < r_cut)
+    return p[selected], d[selected], dt[selected], distance[selected]
+
+def find_coincidences(events, window=Po_tau * hmTau, offset=0., EB_min=EB_min, EB_max=EB_max, EP_min=EP_min, EP_max=EP_max, r_cut=r_cut, energy='Energy'):
+    candidates = preselect(events, EB_min, EB_max, EP_min, EP_max, energy)
+    p, d, dt, distance = search_pairs(candidates, window, offset, r_cut)
+    index = events.index.to_numpy()
+    prompt, delayed = candidates['prompt'], candidates['delayed']
+    pairs = pd.DataFrame({
+        'prompt_index': index[prompt['row'][p]],
+        'delayed_index': index[delayed['row'][d]],
+        'prompt_trgTime': prompt['trgTime'][p],
+        'delayed_trgTime': delayed['trgTime'][d],
+        'dt': dt,
+        'prompt_energy': prompt['energy'][p],
+        'delayed_energy': delayed['energy'][d],
+        'distance': distance
+    })
+    return pairs.astype(pair_dtypes)
+
+def count_pairs(candidates, window, offsets, r_cut=r_cut):
+    return np.array([len(search_pairs(candidates, window, offset, r_cut)[0]) for offset in offsets], dtype=np.int64)
+
+worker_state = {}
+
+def init_worker(candidates, window, r_cut):
+    # The preselected candidates are sent once per worker, not once per offset
+    worker_state.update(candidates=candidates, window=window, r_cut=r_cut)
+
+def count_pairs_worker(offsets):
+    return count_pairs(worker_state['candidates'], worker_state['window'], offsets, worker_state['r_cut'])
+
+def accidental_counts(events, offsets, window=Po_tau * hmTau, EB_min=EB_min, EB_max=EB_max, EP_min=EP_min, EP_max=EP_max, r_cut=r_cut, energy='Energy', workers=1):
+    # Coincidence counts in windows shifted by each offset, reusing one sorted preselection
+    candidates = preselect(events, EB_min, EB_max, EP_min, EP_max, energy)
+    offsets = np.asarray(offsets, dtype=float)
+    if workers > 1:
+        chunks = np.array_split(offsets, 4 * workers)
+        with Pool(workers, initializer=init_worker, initargs=(candidates, window, r_cut)) as pool:
+            counts = np.concatenate(pool.map(count_pairs_worker, chunks))
+    else:
+        counts = count_pairs(candidates, window, offsets, r_cut)
+    return pd.DataFrame({'offset': offsets, 'counts': counts})
+
+def accidental_summary(accidentals):
+    # Mean accidental count per window with the spread-based and the Poisson error on the mean
+    counts = accidentals['counts'].to_numpy()
+    n_offsets = len(counts)
+    return {
+        'n_offsets': n_offsets,
+        'mean': counts.mean(),
+        'std': counts.std(ddof=1) if n_offsets > 1 else np.nan,
+        'mean_error': counts.std(ddof=1) / np.sqrt(n_offsets) if n_offsets > 1 else np.nan,
+        'poisson_error': np.sqrt(counts.sum()) / n_offsets
+    }
+
+def load_events(input_files, t_min=None, t_max=None, energy_range=(None, None)):
+    # RecEvents from EventReconstruction; Energy_Prompt is the calibrated energy of each event.
+    # From an event store only the blocks with events in the time and energy ranges are read
+    frames = []
+    for file_path in input_files:
+        if is_store(file_path):
+            events = EventStore(file_path).select(["trgTime", "Energy_Prompt", "x", "y", "z"], trgTime=(t_min, t_max), Energy_Prompt=energy_range)
+            frames.append(events.reset_index().rename(columns={'index': 'Index'}))
+            continue
+        with uproot.open(file_path) as f:
+            events = f["RecEvents"].arrays(["Index", "trgTime", "Energy_Prompt", "x", "y", "z"], library="pd")
+        if t_min is not None or t_max is not None:
+            trgTime = events['trgTime'].to_numpy()
+            events = events[(trgTime >= (t_min if t_min is not None else -np.inf)) & (trgTime <= (t_max if t_max is not None else np.inf))]
+        frames.append(events)
+    events = pd.concat(frames, ignore_index=True).set_index('Index')
+    return events.rename(columns={'Energy_Prompt': 'Energy', 'x': 'x_CM', 'y': 'y_CM', 'z': 'z_CM'})
+
+def main():
+    args = parse_arguments()
+    print("### Welcome to the HORUS Bi-Po coincidence search ###")
+    report = RunReport("Coincidence", vars(args), args.profile)
+    with report.stage("load"):
+        # Events outside both energy windows can never be in a pair
+        events = load_events(args.InputFile, args.t_min, args.t_max, (min(args.EB_min, args.EP_min), max(args.EB_max, args.EP_max)))
+    with report.stage("coincidence"):
+        pairs = find_coincidences(events, args.Po_tau * args.hmTau, 0., args.EB_min, args.EB_max, args.EP_min, args.EP_max, args.r_cut)
+    print("Events: ", len(events), "\nCoincidences: ", len(pairs))
+    report.count("events", len(events))
+    report.count("pairs", len(pairs))
+
+    if args.accidentals > 0:
+        offsets = np.random.default_rng(args.seed).uniform(low=args.offset_min, high=args.offset_max, size=args.accidentals)
+        with report.stage("accidentals"):
+            accidentals = accidental_counts(events, offsets, args.Po_tau * args.hmTau, args.EB_min, args.EB_max, args.EP_min, args.EP_max, args.r_cut, workers=args.workers)
+        report.count("accidental_offsets", len(offsets))
+        summary = accidental_summary(accidentals)
+        print(f"Accidentals: {summary['mean']:.4f} +- {summary['mean_error']:.4f} (spread) +- {summary['poisson_error']:.4f} (Poisson) per window, from {summary['n_offsets']} offsets")
+
+    if args.OutputFile != "null":
+        with report.stage("write"):
+            with uproot.recreate(args.OutputFile) as f:
+                f["BiPo"] = {key: pairs[key].to_numpy() for key in pair_dtypes}
+                if args.accidentals > 0:
+                    f["Accidentals"] = {key: accidentals[key].to_numpy() for key in accidentals}
+                    f["AccidentalSummary"] = {key: np.array([value]) for key, value in summary.items()}
+        print(f"Output ROOT file created: {args.OutputFile}")
+    # Without an output file the report goes next to the (first) input: coincidence-<input>_report.json
+    input_dir, input_name = os.path.split(args.InputFile[0])
+    report.write(args.OutputFile if args.OutputFile != "null" else os.path.join(input_dir, "coincidence-" + input_name))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+import time
+import threading
+from queue import Queue, Empty, Full
+import numpy as np
+import awkward as ak
+import uproot
+
+# Chunked EventTree reader: chunks are sized in bytes by uproot, decompressed in a background thread
+# while the previous one is analyzed, and handed over as flat NumPy arrays
+
+branches = ["eventId", "trgSec", "trgNsec", "IDdata.samples", "IDdata.GCUID", "IDdata.channelID"]
+
+def flatten_events(events, entry_start):
+	# One row of `samples` per channel; the channels of event j are offsets[j]:offsets[j+1]
+	n_channels = ak.to_numpy(ak.num(events["IDdata.channelID"]))
+	samples = ak.flatten(events["IDdata.samples"], axis=1)
+	n_samples = ak.to_numpy(ak.num(samples))
+	if len(n_samples) > 0 and np.all(n_samples == n_samples[0]):
+		samples = ak.to_numpy(ak.flatten(samples, axis=None)).reshape(len(n_samples), n_samples[0])
+	else:
+		samples = ak.to_numpy(samples)
+	return {
+		'entry_start': entry_start,
+		'n_events': len(n_channels),
+		'trgTime': ak.to_numpy(events["trgSec"]) + 1e-9*ak.to_numpy(events["trgNsec"]),
+		'offsets': np.append(0, np.cumsum(n_channels)),
+		'samples': samples,
+		'GCUID': ak.to_numpy(ak.flatten(events["IDdata.GCUID"])),
+		'channelID': ak.to_numpy(ak.flatten(events["IDdata.channelID"]))
+	}
+
+def chunk_bytes(chunk):
+	return sum(value.nbytes for value in chunk.values() if isinstance(value, np.ndarray))
+
+class ReadStats:
+	# Decoded bytes and events handed to the analysis, and the time spent waiting for them
+	def __init__(self):
+		self.bytes = 0
+		self.events = 0
+		self.channels = 0
+		self.wait_time = 0.
+		self.time_start = time.perf_counter()
+
+	def add(self, chunk):
+		self.bytes += chunk_bytes(chunk)
+		self.events += chunk['n_events']
+		self.channels += len(chunk['channelID'])
+
+	def merge(self, other):
+		self.bytes += other.bytes
+		self.events += other.events
+		self.channels += other.channels
+		self.wait_time += other.wait_time
+
+	def summary(self):
+		elapsed = time.perf_counter() - self.time_start
+		return f"Read {self.bytes / 1e6:.1f} MB, {self.events} events in {elapsed:.2f} s: {self.bytes / 1e6 / elapsed:.1f} MB/s, {self.events / elapsed:.0f} events/s (waiting for data {self.wait_time:.2f} s)"
+
+def prefetch(iterable, depth=1):
+	# Runs the iterable in a background thread, at most `depth` items ahead of the consumer
+	queue = Queue(maxsize=depth)
+	stop = threading.Event()
+	done = object()
+
+	def put(entry):
+		# Waits for room in the queue unless the consumer is gone; returns False once it is
+		while not stop.is_set():
+			try:
+				queue.put(entry, timeout=0.1)
+				return True
+			except Full:
+				pass
+		return False
+
+	def produce():
+		try:
+			for item in iterable:
+				if not put((item, None)):
+					return
+			put((done, None))
+		except BaseException as error:
+			put((done, error))
+
+	thread = threading.Thread(target=produce, daemon=True)
+	thread.start()
+	try:
+		while True:
+			item, error = queue.get()
+			if error is not None:
+				raise error
+			if item is done:
+				return
+			yield item
+	finally:
+		stop.set()
+		try:
+			while True:
+				queue.get_nowait()
+		except Empty:
+			pass
+		thread.join()
+
+def entry_step(step_size):
+	# "50 MB" is passed to uproot as it is, a plain number is a number of entries
+	return int(step_size) if str(step_size).isdigit() else step_size
+
+def read_chunks(tree, entry_start, entry_stop, step_size="50 MB", depth=1, stats=None):
+	# Yields flat chunks of [entry_start, entry_stop); step_size is in bytes ("50 MB") or in entries (int)
+	def decode():
+		for events, report in tree.iterate(branches, entry_start=entry_start, entry_stop=entry_stop, step_size=step_size, report=True):
+			yield flatten_events(events, report.tree_entry_start)
+
+	chunks = prefetch(decode(), depth) if depth > 0 else decode()
+	while True:
+		time_wait = time.perf_counter()
+		chunk = next(chunks, None)
+		if stats is not None:
+			stats.wait_time += time.perf_counter() - time_wait
+		if chunk is None:
+			return
+		if stats is not None:
+			stats.add(chunk)
+		yield chunk
@@ -3,15 +3,25 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import sys
 import uproot
+import awkward as ak
 from tqdm import tqdm
 from tqdm.auto import tqdm
 tqdm.pandas()
 import os
 import argparse
 from argparse import RawTextHelpFormatter
+from HitTable import read_hits, iterate_hits, compact_multi_pulse_dtypes
+from MuonVeto import muon_times, veto_mask, vetoed_live_time
+from RecoKernel import segment_offsets, segment_kahan_sums, segment_means, EventTable
+from Instrumentation import RunReport, profile_modes
+from Manifest import Manifest
+from Histograms import HistogramSet
+from VertexFit import VertexFitter, CONVERGED
+from EventStore import build_store
 
 c = 3.0e8
 n_LS = 1.55
+vertex_modes = ("barycenter", "fit")
 
 def parse_arguments():
     prs = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter)
@@ -20,100 +30,128 @@ def parse_arguments():
     prs.add_argument("-m", "--muon", default="true", help="Apply muon veto; default: true")
     prs.add_argument("-a", "--All", default="false", help="Analyse all the data file with a specific pattern; default: false")
     prs.add_argument("-d", "--Dir", default="false", help="Directory containing files to be analyzed; default: false")
-    prs.add_argument("-Muon_Veto_Threshold", "--Threshold_OD_Fired", default=5, help="Muon veto threshold for OD multiplicity; default: 5")    
+    prs.add_argument("-Muon_Veto_Threshold", "--Threshold_OD_Fired", type=int, default=5, help="Muon veto threshold for OD multiplicity; default: 5")
+    prs.add_argument("-Muon_Veto_Window", "--Muon_Veto_Window", type=float, default=20E-6, help="Half-width of the muon veto time window in s; default: 20e-6")
+    prs.add_argument("-s", "--stream", default="false", help="Streaming mode: reconstruct and write one chunk of hits at a time; default: false")
+    prs.add_argument("-c", "--chunk_size", type=int, default=1000000, help="Hits per chunk in streaming mode; default: 1000000")
+    prs.add_argument("--manifest", default="null", help="Manifest JSON file: incremental mode, every input file is reconstructed on its own into OutputFile_runs/\nunless it was already done from the same file with the same parameters, then the merged output is updated; default: none")
+    prs.add_argument("--vertex", default="barycenter", choices=vertex_modes, help="Event position: charge barycenter, or likelihood fit of the charges and times of the hits\n(x_fit, y_fit, z_fit, t0_fit, Vertex_Chi2, Vertex_Status, Vertex_Iterations; TOF from the fitted vertex); default: barycenter")
+    prs.add_argument("--vertex_workers", type=int, default=1, help="Worker processes of the vertex fit; default: 1")
+    prs.add_argument("--histograms", default="null", help="ROOT file for the monitoring histograms of the hits and of the reconstructed events; default: none")
+    prs.add_argument("--event_store", default="null", help="Directory for the event store of the output (time-sorted, memory-mappable columns, see EventStore.py); default: none")
+    prs.add_argument("--compact", default="false", help="Memory-efficient mode: hits loaded with compact dtypes (uint8/uint16 channels and flags,\nfloat32 charges and positions, see HitTable.py); the events are computed in float64 as usual; default: false")
+    prs.add_argument("--profile", default="false", choices=profile_modes, help="Profile the run: cprofile (OutputFile.prof) or sample (in the report); default: false")
     return prs.parse_args()
 
-def load_data(input_file, all_files, folder_path):
-    df_list = []
+def load_dtypes(compact):
+    # dtypes of the loaded hits: compact ones (multi-pulse columns included, for the files that have them) or pandas defaults
+    return compact_multi_pulse_dtypes if compact == "true" else None
 
+def list_input_files(input_file, all_files, folder_path):
     if input_file != "null" and all_files == "false":
-        data_unclean = pd.read_csv(input_file, delimiter='\t')
-        print("Open only: ", input_file)
-        return data_unclean
+        return [input_file]
 
     if all_files != "false":
-    	folder = os.path.dirname(input_file)
-    	prefix = os.path.basename(input_file).rsplit('_', 1)[0]  # Ottieni il prefisso dal nome del file di input
-
-    	files = [f for f in os.listdir(folder) if f.startswith(prefix)]
-    	files.sort()
-    	for i, filename in enumerate(files):
-    	    file_path = os.path.join(folder, filename)
-    	    df = pd.read_csv(file_path, delimiter='\t')
-    	    if i != 0:
-    	        df["index"] = df["index"] + df_list[-1]["index"].max() + 1
-    	    df_list.append(df)
-    	    print("Loading: ", filename)
-    	    print("Events from ", df["index"].min(), " to ", df["index"].max())
-    	data_unclean = pd.concat(df_list, ignore_index=True)
-    	return data_unclean
-
+        folder = os.path.dirname(input_file) or "."
+        prefix = os.path.basename(input_file).rsplit('_', 1)[0]  # Ottieni il prefisso dal nome del file di input
+        files = sorted(f for f in os.listdir(folder) if f.startswith(prefix))
+        return [os.path.join(folder, f) for f in files]
 
     if folder_path != "false":
-        files = [f for f in os.listdir(folder_path) if f.endswith('.txt')]
-        files.sort()
-        for i, filename in enumerate(files):
-            file_path = os.path.join(folder_path, filename)
-            df = pd.read_csv(file_path, delimiter='\t')
-            if i != 0:
-                df["index"] = df["index"] + df_list[-1]["index"].max() + 1
-            df_list.append(df)
-            print(f"Open: {filename}")
-            print(df["index"].min(), df["index"].max())
-        data_unclean = pd.concat(df_list, ignore_index=True)
-        print(data_unclean["index"].max())
-        return data_unclean
-
-    return None
-
-def process_data(data):
-    data = data.replace([np.inf, -np.inf], np.nan).dropna(subset=['charge'])
-    grouped = data.groupby('index')
-    total_charge = -grouped['charge'].sum()
-    average_live_pmts = grouped['LivePMTs'].mean()
-    trgTime = grouped['trgTime'].mean()
-    trgTime_diff = trgTime.diff().shift(-1)
-    normalized_charge = total_charge / average_live_pmts
-    Fired_PMTs = grouped.size()
-    OD_fired = grouped['OD'].sum()
-    Shape_Ch = grouped['Shape_Ch'].max()
-
-    data_OD = data[data['OD'] == 1]
-    grouped_OD = data_OD.groupby('index')
-    total_charge_OD = -grouped_OD['charge'].sum()
-    average_live_pmts_OD = grouped_OD['LivePMTs'].mean()
-    normalized_charge_OD = total_charge_OD / average_live_pmts_OD
-
-    data_ID = data[data['OD'] == 0]
-    grouped_ID = data_ID.groupby('index')
-    total_charge_ID = -grouped_ID['charge'].sum()
-    average_live_pmts_ID = grouped_ID['LivePMTs'].mean()
-    normalized_charge_ID = total_charge_ID / average_live_pmts_ID
-
-    weights = data['charge'].abs()
-
-    print("-- Position reco based on charge barycenter")
-    x_CM = (data['x_PMT'] * weights).groupby(data['index']).sum() / weights.groupby(data['index']).sum()
-    y_CM = (data['y_PMT'] * weights).groupby(data['index']).sum() / weights.groupby(data['index']).sum()
-    z_CM = (data['z_PMT'] * weights).groupby(data['index']).sum() / weights.groupby(data['index']).sum()
-
-    data = data.merge(x_CM.rename('x_CM'), on='index')
-    data = data.merge(y_CM.rename('y_CM'), on='index')
-    data = data.merge(z_CM.rename('z_CM'), on='index')
+        files = sorted(f for f in os.listdir(folder_path) if f.endswith('.txt') or (f.endswith('.root') and not f.startswith('rec-')))
+        return [os.path.join(folder_path, f) for f in files]
 
-    print("-- TOF calculation")
-    data['TOF'] = np.sqrt((data['x_CM'] - data['x_PMT']) ** 2 +
-                          (data['y_CM'] - data['y_PMT']) ** 2 +
-                          (data['z_CM'] - data['z_PMT']) ** 2) / 1000 / n_LS / c * 1.0e9
+    return []
 
-    TOF = data.groupby('index')['TOF'].apply(list)
-    data['WF_RiseTime_diff'] = data['WF_RiseTime'] - data['TOF']
-    WF_RiseTime_diff_per_event = data.groupby('index')['WF_RiseTime_diff'].apply(list)
-    WF_RiseTime_per_event = data.groupby('index')['WF_RiseTime'].apply(list)
-    mean_WF_RiseTime_per_event = data.groupby('index')['WF_RiseTime'].mean()
+def load_data(input_file, all_files, folder_path, compact="false"):
+    df_list = []
+    files = list_input_files(input_file, all_files, folder_path)
+    if len(files) == 0:
+        return None
+
+    for i, file_path in enumerate(files):
+        df = read_hits(file_path, load_dtypes(compact))
+        if i != 0:
+            df["index"] = df["index"] + df_list[-1]["index"].max() + 1
+        df_list.append(df)
+        print("Loading: ", os.path.basename(file_path))
+        print("Events from ", df["index"].min(), " to ", df["index"].max())
+    return df_list[0] if len(df_list) == 1 else pd.concat(df_list, ignore_index=True)
+
+def hit_column(data, name, keep, order):
+    values = data[name].to_numpy()[keep]
+    if order is not None:
+        values = values[order]
+    if values.dtype.kind == 'f':
+        # float32 hits (--compact) are reconstructed in float64 like the others
+        values = np.where(np.isinf(values), np.nan, values.astype(np.float64, copy=False))
+    return values
+
+def process_data(data, vertex_fitter=None):
+    # Hits are sorted once by event index; every per-event quantity comes from one segmented reduction.
+    # Hit tables of the multi-pulse analysis have one hit per pulse: all the pulses add to the charges and
+    # the barycenter, while the channel counts and the averages per channel only take the first pulse (pulse 0).
+    # With a VertexFitter the position is also fitted (see VertexFit.py), starting from the barycenter.
+    keep = np.isfinite(data['charge'].to_numpy(dtype=float))
+    order, events, offsets = segment_offsets(data['index'].to_numpy()[keep])
+    charge, live_pmts, trg_time, OD, shape_ch, x_PMT, y_PMT, z_PMT, rise_time = (hit_column(data, name, keep, order)
+        for name in ('charge', 'LivePMTs', 'trgTime', 'OD', 'Shape_Ch', 'x_PMT', 'y_PMT', 'z_PMT', 'WF_RiseTime'))
+    pulse = hit_column(data, 'pulse', keep, order) if 'pulse' in data else np.zeros(len(charge), dtype=np.int32)
+
+    first = pulse == 0
+    OD_hit = OD == 1
+    ID_hit = OD == 0
+    weights = np.abs(charge)
+    per_channel = lambda values: np.where(first, values, np.nan)
+    values = np.column_stack([
+        charge, per_channel(live_pmts), per_channel(trg_time),
+        np.where(OD_hit, charge, np.nan), np.where(OD_hit & first, live_pmts, np.nan),
+        np.where(ID_hit, charge, np.nan), np.where(ID_hit & first, live_pmts, np.nan),
+        weights, x_PMT * weights, y_PMT * weights, z_PMT * weights,
+        per_channel(rise_time)
+    ]).astype(float)
+    sums, counts = segment_kahan_sums(values, offsets)
+    means = segment_means(sums, counts)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        total_charge = -sums[:, 0]
+        average_live_pmts = means[:, 1]
+        trgTime = means[:, 2]
+        trgTime_diff = np.append(np.diff(trgTime), np.nan)
+        normalized_charge = total_charge / average_live_pmts
+        Hits = np.diff(offsets)
+        Fired_PMTs = np.add.reduceat(first, offsets[:-1], dtype=np.int64) if len(events) > 0 else Hits
+        OD_fired = np.add.reduceat(OD * first, offsets[:-1], dtype=np.result_type(OD.dtype, np.int32)) if len(events) > 0 else OD[:0]
+        Shape_Ch = np.maximum.reduceat(shape_ch, offsets[:-1]) if len(events) > 0 else shape_ch[:0]
+
+        normalized_charge_OD = np.where(counts[:, 3] > 0, -sums[:, 3], np.nan) / means[:, 4]
+        normalized_charge_ID = np.where(counts[:, 5] > 0, -sums[:, 5], np.nan) / means[:, 6]
+
+        print("-- Position reco based on charge barycenter")
+        x_CM = sums[:, 8] / sums[:, 7]
+        y_CM = sums[:, 9] / sums[:, 7]
+        z_CM = sums[:, 10] / sums[:, 7]
+
+    x_vertex, y_vertex, z_vertex = x_CM, y_CM, z_CM
+    if vertex_fitter is not None:
+        print("-- Position reco based on likelihood vertex fit")
+        # First pulses of the ID channels with a rise time; the charge of the (negative) pulses is fitted as positive
+        fitted = first & ID_hit & np.isfinite(rise_time.astype(float))
+        fitted_offsets = np.append(0, np.cumsum(np.add.reduceat(fitted, offsets[:-1], dtype=np.int64))) if len(events) > 0 else np.zeros(1, dtype=np.int64)
+        vertex = vertex_fitter.fit(fitted_offsets, x_PMT[fitted], y_PMT[fitted], z_PMT[fitted], rise_time[fitted], np.maximum(-charge[fitted], 0.),
+                                   np.column_stack([x_CM, y_CM, z_CM]))
+        converged = vertex['status'] == CONVERGED
+        x_vertex, y_vertex, z_vertex = (np.where(converged, vertex[name], CM) for name, CM in (('x', x_CM), ('y', y_CM), ('z', z_CM)))
+
+    print("-- TOF calculation")
+    TOF = np.sqrt((np.repeat(x_vertex, Hits) - x_PMT) ** 2 +
+                  (np.repeat(y_vertex, Hits) - y_PMT) ** 2 +
+                  (np.repeat(z_vertex, Hits) - z_PMT) ** 2) / 1000 / n_LS / c * 1.0e9
+    WF_RiseTime_diff = rise_time - TOF
+    mean_WF_RiseTime_per_event = means[:, 11]
 
-    trgTime_aligned = grouped['trgTime'].mean() - (mean_WF_RiseTime_per_event - 250) * 1e-9
-    trgTime_diff_aligned = trgTime_aligned.diff().shift(-1)
+    trgTime_aligned = trgTime - (mean_WF_RiseTime_per_event - 250) * 1e-9
+    trgTime_diff_aligned = np.append(np.diff(trgTime_aligned), np.nan)
 
     results = pd.DataFrame({
         'Charge': total_charge,
@@ -128,87 +166,433 @@ def process_data(data):
         'trgTime_diff': trgTime_diff,
         'trgTime_aligned': trgTime_aligned,
         'trgTime_diff_aligned': trgTime_diff_aligned,
-        'TOF': TOF,
-        'WF_RiseTime': WF_RiseTime_per_event,
-        'WF_RiseTime_diff': WF_RiseTime_diff_per_event,
         'OD_fired': OD_fired,
-        'Shape_Ch': Shape_Ch
-    })
-    return results
-
-def apply_muon_veto(results,Threshold_OD_Fired):
+        'Shape_Ch': Shape_Ch,
+        'Hits': Hits
+    }, index=pd.Index(events, name='index'))
+    if vertex_fitter is not None:
+        for name, column in vertex_columns.items():
+            results[name] = vertex[column]
+    # TOF, WF_RiseTime, WF_RiseTime_diff and Pulse stay flat, in the sorted hit order (see EventTable)
+    return EventTable(results, {'TOF': TOF, 'WF_RiseTime': rise_time, 'WF_RiseTime_diff': WF_RiseTime_diff, 'Pulse': pulse}, offsets)
+
+def apply_muon_veto(results, Threshold_OD_Fired, Muon_Veto_Window=20E-6):
     print("-- Applying the muon veto")
-    od_mult = results['OD_fired'] >= Threshold_OD_Fired
-    events_to_remove = results[od_mult]
+    od_mult = results.events['OD_fired'].to_numpy() >= Threshold_OD_Fired
+    trgTime = results.events['trgTime'].to_numpy()
+    muons = muon_times(trgTime, results.events['OD_fired'].to_numpy(), Threshold_OD_Fired)
 
-    time_threshold = 20E-6
-    for i, (index, row) in enumerate(tqdm(events_to_remove.iterrows(), desc="\tApplying time cut: ")):
-        if i == 0:
-            print("\n\n\tIt could take time. This is the total number of iterations: ", len(events_to_remove.index.to_numpy()), " \n")
-        time_diff_condition = (results['trgTime'] - row['trgTime']).abs() < time_threshold
-        results = results.loc[~time_diff_condition]
+    vetoed = veto_mask(trgTime, muons, Muon_Veto_Window) | od_mult
+    live_time = np.nanmax(trgTime) - np.nanmin(trgTime) if len(trgTime) > 0 else 0.
+    vetoed_time = vetoed_live_time(muons, Muon_Veto_Window, np.nanmin(trgTime), np.nanmax(trgTime)) if len(muons) > 0 else 0.
+    print(f"\tMuons: {len(muons)}; vetoed events: {vetoed.sum()}; vetoed live time: {vetoed_time:.6f} s ({100. * vetoed_time / live_time if live_time > 0 else 0.:.3f}% of {live_time:.6g} s)")
 
-    results = results.loc[~od_mult]
-    return results
+    return results.take(~vetoed)
+
+def add_energies(results):
+    events = results.events.assign(Energy_Prompt=results.events['Charge_Norm'] / 3800., Energy_Delayed=results.events['Charge_Norm'].shift(-1) / 3800.)
+    return EventTable(events, results.hits, results.offsets).take(events['Energy_Prompt'].notna().to_numpy())
 
 def calculate_energies(results):
     print("-- Calculating Energy_Prompt and Energy_Delayed")
-    results['Energy_Prompt'] = results['Charge_Norm'] / 3800.
-    results['Energy_Delayed'] = results['Charge_Norm'].shift(-1) / 3800.
-    results = results.dropna(subset=['Energy_Prompt'])
+    return add_energies(results)
+
+def output_name(output_file, input_file, all_files, folder_path):
+    if output_file != "null":
+        return output_file
+    input_stem = os.path.splitext(input_file)[0]
+    if all_files == "true" or folder_path != "false":
+        return "rec-" + input_stem[:-5] + ".root"
+    return "rec-" + input_stem + ".root"
+
+rec_types = {
+    "Index": np.int64,
+    "x": np.float64,
+    "y": np.float64,
+    "z": np.float64,
+    "Fired_PMTs": np.int64,
+    "Charge": np.float64,
+    "Charge_Norm": np.float64,
+    "Charge_Norm_OD": np.float64,
+    "Charge_Norm_ID": np.float64,
+    'trgTime': np.float64,
+    'trgTime_diff': np.float64,
+    'trgTime_aligned': np.float64,
+    'trgTime_diff_aligned': np.float64,
+    "TOF": "var * float64",
+    'WF_RiseTime': "var * int64",
+    'WF_RiseTime_diff': "var * float64",
+    'Pulse': "var * int32",
+    'Energy_Prompt': np.float64,
+    'Energy_Delayed': np.float64,
+    'OD_fired': np.int64,
+    'Shape_Ch': np.int64
+}
+rec_columns = {"Index": None, "x": 'x_CM', "y": 'y_CM', "z": 'z_CM'}
+# Extra branches of the vertex fit (--vertex fit), from the columns of VertexFitter.fit
+vertex_types = {
+    'x_fit': np.float64,
+    'y_fit': np.float64,
+    'z_fit': np.float64,
+    't0_fit': np.float64,
+    'Vertex_Chi2': np.float64,
+    'Vertex_Status': np.int32,
+    'Vertex_Iterations': np.int32
+}
+vertex_columns = {'x_fit': 'x', 'y_fit': 'y', 'z_fit': 'z', 't0_fit': 't0', 'Vertex_Chi2': 'chi2', 'Vertex_Status': 'status', 'Vertex_Iterations': 'iterations'}
+
+def rec_branches(results, types=rec_types):
+    branches = {"Index": results.events.index.to_numpy().astype(np.int64)}
+    for name, branch_type in types.items():
+        if name == "Index":
+            continue
+        if isinstance(branch_type, str):
+            branches[name] = ak.values_astype(results.jagged(name), np.dtype(branch_type.split()[-1]))
+        else:
+            branches[name] = results.events[rec_columns.get(name, name)].to_numpy().astype(branch_type)
+    return branches
+
+class RecWriter:
+    # RecEvents TTree that can be filled in several chunks; with vertex=True it also has the vertex fit branches
+    def __init__(self, output_filename, vertex=False):
+        self.output_filename = output_filename
+        self.types = {**rec_types, **vertex_types} if vertex else rec_types
+        self.file = uproot.recreate(output_filename)
+        self.file.mktree("RecEvents", {name: (branch_type if isinstance(branch_type, str) else np.dtype(branch_type)) for name, branch_type in self.types.items()})
+        self.entries = 0
+
+    def write(self, results):
+        if len(results) > 0:
+            self.file["RecEvents"].extend(rec_branches(results, self.types))
+            self.entries += len(results)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def read_rec_events(file_path):
+    # RecEvents back into an event table; the jagged branches are read as offsets + content, without Python lists
+    with uproot.open(file_path) as f:
+        arrays = f["RecEvents"].arrays(library="ak")
+    scalars = [name for name, branch_type in {**rec_types, **vertex_types}.items() if not isinstance(branch_type, str) and name != "Index" and name in arrays.fields]
+    events = pd.DataFrame({rec_columns.get(name, name): ak.to_numpy(arrays[name]) for name in scalars}, index=pd.Index(ak.to_numpy(arrays["Index"]), name='index'))
+    events['Hits'] = ak.to_numpy(ak.num(arrays["TOF"]))
+    # Files written before the multi-pulse analysis have no Pulse branch: one (first) pulse per hit
+    hits = {name: ak.to_numpy(ak.flatten(arrays[name])) for name, branch_type in rec_types.items() if isinstance(branch_type, str) and name in arrays.fields}
+    hits.setdefault('Pulse', np.zeros(int(events['Hits'].sum()), dtype=np.int32))
+    return EventTable(events, hits, np.append(0, np.cumsum(events['Hits'].to_numpy())))
+
+def reconstruct(data, muon, Threshold_OD_Fired, Muon_Veto_Window, report, vertex_fitter=None):
+    # Event table of a hit table: reconstruction, muon veto and energies, timed in report
+    report.count("hits", len(data))
+    with report.stage("reconstruction"):
+        results = process_data(data, vertex_fitter)
+    n_events = len(results)
+
+    if muon:
+        with report.stage("muon_veto"):
+            results = apply_muon_veto(results, Threshold_OD_Fired, Muon_Veto_Window)
+        report.count("vetoed_events", n_events - len(results))
+
+    with report.stage("energies"):
+        results = calculate_energies(results)
+    report.count("events", len(results))
     return results
 
+def merge_rec_events(run_files, index_offsets, output_filename):
+    # RecEvents of several runs in one file, written one run at a time, with index_offsets added to the event index of each run;
+    # the vertex fit branches are kept if every run has them
+    vertex = len(run_files) > 0
+    for file_path in run_files:
+        with uproot.open(file_path) as f:
+            vertex = vertex and "Vertex_Status" in f["RecEvents"]
+    with RecWriter(output_filename, vertex) as writer:
+        for file_path, index_offset in zip(run_files, index_offsets):
+            results = read_rec_events(file_path)
+            results.events.index = results.events.index + index_offset
+            writer.write(results)
+    return writer.entries
+
+def file_stamp(file_path):
+    return [os.path.getsize(file_path), os.path.getmtime(file_path)]
+
+def incremental_data(files, output_filename, manifest_file, muon, Threshold_OD_Fired, Muon_Veto_Window, report, histogram_file="null", vertex_fitter=None, compact="false"):
+    # Each input file is reconstructed on its own into <output>_runs/rec-<file>.root, unless the manifest shows
+    # that this output was completed from the same file with the same parameters; the merged output is rebuilt
+    # from the per-run files when one of them changed. Events at the edges of a run do not see the next run
+    # (trgTime_diff, Energy_Delayed and the muon veto stop at the end of the file).
+    # The histograms of each run are kept next to it (hist-<file>.root) and added up.
+    manifest = Manifest(manifest_file)
+    parameters = {'muon': muon, 'Threshold_OD_Fired': Threshold_OD_Fired, 'Muon_Veto_Window': Muon_Veto_Window, 'vertex': "fit" if vertex_fitter is not None else "barycenter", 'compact': compact}
+    run_dir = os.path.splitext(output_filename)[0] + "_runs"
+    os.makedirs(run_dir, exist_ok=True)
+    run_files = []
+    histograms = HistogramSet() if histogram_file != "null" else None
+    for file_path in files:
+        run_output = os.path.join(run_dir, "rec-" + os.path.splitext(os.path.basename(file_path))[0] + ".root")
+        run_histograms = os.path.join(run_dir, "hist-" + os.path.splitext(os.path.basename(file_path))[0] + ".root")
+        run_files.append(run_output)
+        if manifest.is_done(file_path, run_output, "EventReconstruction", parameters) and (histograms is None or os.path.exists(run_histograms)):
+            if histograms is not None:
+                histograms.read(run_histograms)
+            print("Unchanged since the last reconstruction, skipped: ", os.path.basename(file_path))
+            continue
+        print("Reconstructing: ", os.path.basename(file_path))
+        manifest.start(file_path, run_output, "EventReconstruction", parameters)
+        report.count("bytes_input", os.path.getsize(file_path))
+        with report.stage("load"):
+            data = read_hits(file_path, load_dtypes(compact))
+        results = reconstruct(data, muon, Threshold_OD_Fired, Muon_Veto_Window, report, vertex_fitter)
+        with report.stage("write"):
+            with RecWriter(run_output, vertex_fitter is not None) as writer:
+                writer.write(results)
+        if histograms is not None:
+            with report.stage("histograms"):
+                run = HistogramSet(histograms.cable_map)
+                run.fill_hits(data)
+                run.fill_events(results.events)
+                run.write(run_histograms)
+            histograms.add(run)
+        manifest.finish(run_output, index_max=int(data['index'].max()) if len(data) > 0 else -1)
+
+    if histograms is not None:
+        histograms.write(histogram_file)
+    runs = {os.path.abspath(run_output): file_stamp(run_output) for run_output in run_files}
+    merged = manifest.record(output_filename)
+    if merged is not None and merged.get('runs') == runs and os.path.exists(output_filename):
+        print(f"Merged output up to date: {output_filename}")
+        return
+    # As in load_data, the event index of a run continues after the largest hit index of the previous one
+    index_max = np.array([manifest.record(run_output)['index_max'] for run_output in run_files], dtype=np.int64)
+    with report.stage("merge"):
+        entries = merge_rec_events(run_files, np.cumsum(index_max + 1) - (index_max + 1), output_filename)
+    manifest.update(output_filename, program="EventReconstruction (merged)", runs=runs, status="done")
+    print(f"Output ROOT file created: {output_filename} ({entries} events from {len(run_files)} runs)")
+
 def save_results(results, output_file, input_file, all_files, folder_path):
-    if output_file == "null":
-        if all_files == "true" or folder_path != "false":
-            output_filename = "rec-" + input_file[:-9] + ".root"
-        else:
-            output_filename = "rec-" + input_file[:-4] + ".root"
-    else:
-        output_filename = output_file
-
-    with uproot.recreate(output_filename) as f:
-        f["RecEvents"] = {
-            "Index": results.index.to_numpy(),
-            "x": results['x_CM'].to_numpy() if 'x_CM' in results else None,
-            "y": results['y_CM'].to_numpy() if 'y_CM' in results else None,
-            "z": results['z_CM'].to_numpy() if 'z_CM' in results else None,
-            "Fired_PMTs": results['Fired_PMTs'].to_numpy(),
-            "Charge": results['Charge'],
-            "Charge_Norm": results['Charge_Norm'],
-            "Charge_Norm_OD": results['Charge_Norm_OD'],
-            "Charge_Norm_ID": results['Charge_Norm_ID'],
-            'trgTime': results['trgTime'],
-            'trgTime_diff': results['trgTime_diff'],
-            'trgTime_aligned': results['trgTime_aligned'],
-            'trgTime_diff_aligned': results['trgTime_diff_aligned'],
-            "TOF": results['TOF'],
-            'WF_RiseTime': results['WF_RiseTime'],
-            'WF_RiseTime_diff': results['WF_RiseTime_diff'],
-            'Energy_Prompt': results['Energy_Prompt'].to_numpy(),
-            'Energy_Delayed': results['Energy_Delayed'].to_numpy(),
-            'OD_fired': results['OD_fired'],
-            'Shape_Ch': results['Shape_Ch']
-        }
+    output_filename = output_name(output_file, input_file, all_files, folder_path)
+    with RecWriter(output_filename, 'Vertex_Status' in results.events) as writer:
+        writer.write(results)
     print(f"Output ROOT file created: {output_filename}")
 
+class StreamingReconstruction:
+    # Events are kept in `pending` until nothing later in the run can change them:
+    # the next event (trgTime_diff), a muon within the veto window and the next surviving event (Energy_Delayed).
+    # Run files must list their events in increasing index and trigger time, as WaveformAnalyzer writes them.
+    def __init__(self, writer, muon, Threshold_OD_Fired, Muon_Veto_Window, report=None, histograms=None, vertex_fitter=None):
+        self.writer = writer
+        self.vertex_fitter = vertex_fitter
+        self.histograms = histograms  # HistogramSet filled with the events as they are written
+        self.report = report if report is not None else RunReport("StreamingReconstruction")
+        self.muon = muon
+        self.threshold = Threshold_OD_Fired
+        self.window = Muon_Veto_Window
+        self.carry = None  # hits of the last, possibly incomplete, event
+        self.pending = None
+        self.muons = np.array([])  # muons of already written events that can still veto pending ones
+        self.veto_stop = -np.inf
+        self.vetoed_time = 0.
+        self.t_first = np.nan
+        self.t_last = np.nan
+
+    def add_hits(self, hits, last_chunk):
+        self.report.count("hits", len(hits))
+        if self.carry is not None:
+            hits = pd.concat([self.carry, hits], ignore_index=True)
+        if len(hits) == 0:
+            return
+        if last_chunk:
+            self.carry = None
+        else:
+            last = hits['index'].to_numpy() == hits['index'].iloc[-1]
+            self.carry = hits[last]
+            hits = hits[~last]
+        if len(hits) == 0:
+            return
+        with self.report.stage("reconstruction"):
+            events = process_data(hits, self.vertex_fitter)
+        self.pending = events if self.pending is None else EventTable.concat([self.pending, events])
+        self.flush(final=False)
+
+    def flush(self, final):
+        with self.report.stage("muon_veto"):
+            emitted = self.advance(final)
+        if emitted is not None:
+            with self.report.stage("write"):
+                self.writer.write(emitted)
+            self.report.count("events", len(emitted))
+            if self.histograms is not None:
+                with self.report.stage("histograms"):
+                    self.histograms.fill_events(emitted.events)
+
+    def advance(self, final):
+        # Returns the events that are ready to be written and keeps the others pending
+        results = self.pending
+        if results is None or len(results) == 0:
+            return None
+        events = results.events
+        trgTime = events['trgTime'].to_numpy()
+        if np.isnan(self.t_first) and not np.all(np.isnan(trgTime)):
+            self.t_first = np.nanmin(trgTime)
+        events['trgTime_diff'] = np.append(np.diff(trgTime), np.nan)
+        events['trgTime_diff_aligned'] = np.append(np.diff(events['trgTime_aligned'].to_numpy()), np.nan)
+
+        vetoed = np.zeros(len(results), dtype=bool)
+        if self.muon:
+            OD_fired = events['OD_fired'].to_numpy()
+            muons = np.concatenate([self.muons, muon_times(trgTime, OD_fired, self.threshold)])
+            vetoed = veto_mask(trgTime, muons, self.window) | (OD_fired >= self.threshold)
+
+        if final:
+            k = len(results)
+        else:
+            with np.errstate(invalid='ignore'):
+                ready = (trgTime <= np.nanmax(trgTime) - self.window) | np.isnan(trgTime)
+            ready[-1] = False
+            k = len(ready) if ready.all() else int(np.argmin(ready))
+
+        survivors = np.flatnonzero(~vetoed[:k])
+        if final or len(survivors) == 0:
+            emitted, keep_from = results.take(survivors), k
+        else:
+            # The last survivor stays pending: its Energy_Delayed comes from the next survivor
+            emitted, keep_from = results.take(survivors), survivors[-1]
+        emitted = add_energies(emitted)
+        if not final and len(survivors) > 0:
+            emitted = emitted.take(emitted.events.index.to_numpy() != events.index[keep_from])
+        self.report.count("vetoed_events", np.count_nonzero(vetoed[:keep_from]))
+
+        if self.muon:
+            new_muons = muon_times(trgTime[:keep_from], OD_fired[:keep_from], self.threshold)
+            self.account_veto_time(new_muons)
+            self.report.count("muons", len(new_muons))
+            self.muons = np.concatenate([self.muons, new_muons])
+            if keep_from < len(results):
+                self.muons = self.muons[self.muons >= np.nanmin(trgTime[keep_from:]) - self.window]
+        self.t_last = np.nanmax(trgTime[:keep_from]) if keep_from > 0 else self.t_last
+        self.pending = results.take(slice(keep_from, None))
+        return emitted
+
+    def account_veto_time(self, muons):
+        # Running length of the union of veto windows, relative to the start of the run to keep the precision
+        for t in muons - self.t_first:
+            start = max(t - self.window, self.veto_stop, 0.)
+            self.vetoed_time += max(t + self.window - start, 0.)
+            self.veto_stop = max(self.veto_stop, t + self.window)
+
+    def close(self):
+        if self.carry is not None:
+            self.add_hits(self.carry.iloc[:0], last_chunk=True)
+        self.flush(final=True)
+        if self.muon and self.veto_stop > self.t_last - self.t_first:
+            self.vetoed_time -= self.veto_stop - (self.t_last - self.t_first)  # clip to the end of the run
+        return self.vetoed_time
+
+def stream_data(files, output_filename, muon, Threshold_OD_Fired, Muon_Veto_Window, chunk_size, report=None, histogram_file="null", vertex_fitter=None, compact="false"):
+    # Bounded-memory reconstruction: hit chunks are reconstructed and appended to RecEvents one at a time
+    report = report if report is not None else RunReport("stream_data")
+    index_offset = 0
+    histograms = HistogramSet() if histogram_file != "null" else None
+    with RecWriter(output_filename, vertex_fitter is not None) as writer:
+        stream = StreamingReconstruction(writer, muon, Threshold_OD_Fired, Muon_Veto_Window, report, histograms, vertex_fitter)
+        for file_path in files:
+            print("Streaming: ", os.path.basename(file_path))
+            report.count("bytes_input", os.path.getsize(file_path))
+            file_max = None
+            chunks = iterate_hits(file_path, chunk_size, load_dtypes(compact))
+            while True:
+                with report.stage("load"):
+                    hits, last_chunk = next(chunks, (None, None))
+                if hits is None:
+                    break
+                hits["index"] = hits["index"] + index_offset
+                if histograms is not None:
+                    with report.stage("histograms"):
+                        histograms.fill_hits(hits)
+                if len(hits) > 0:
+                    file_max = hits["index"].max() if file_max is None else max(file_max, hits["index"].max())
+                stream.add_hits(hits, last_chunk)
+            if file_max is not None:
+                index_offset = file_max + 1
+        vetoed_time = stream.close()
+    if histograms is not None:
+        histograms.write(histogram_file)
+    if muon:
+        print(f"\tVetoed live time: {vetoed_time:.6f} s")
+    print(f"Output ROOT file created: {output_filename} ({writer.entries} events)")
+
+def write_event_store(output_filename, store_path, report):
+    if store_path != "null":
+        with report.stage("event_store"):
+            build_store([output_filename], store_path)
+        print(f"Event store created: {store_path}")
+
+def finish_vertex_fit(vertex_fitter, report):
+    if vertex_fitter is not None:
+        vertex_fitter.close()
+        vertex_fitter.record(report)
+        print(vertex_fitter.summary())
+
 def main():
     args = parse_arguments()
     print("### Welcome to the HORUS Event Reconstruction ###")		
+    vertex_fitter = VertexFitter(args.vertex_workers) if args.vertex == "fit" else None
+
+    if args.manifest != "null":
+        files = list_input_files(args.InputFile, args.All, args.Dir)
+        if len(files) == 0:
+            print("No data loaded.")
+            return
+        print("### Incremental Event Reconstruction ###")
+        output_filename = output_name(args.OutputFile, args.InputFile, args.All, args.Dir)
+        report = RunReport("EventReconstruction", vars(args), args.profile)
+        incremental_data(files, output_filename, args.manifest, args.muon == "true", args.Threshold_OD_Fired, args.Muon_Veto_Window, report, args.histograms, vertex_fitter, args.compact)
+        finish_vertex_fit(vertex_fitter, report)
+        write_event_store(output_filename, args.event_store, report)
+        report.write(output_filename)
+        return
+
+    if args.stream == "true":
+        files = list_input_files(args.InputFile, args.All, args.Dir)
+        if len(files) == 0:
+            print("No data loaded.")
+            return
+        print("### Streaming Event Reconstruction ###")
+        output_filename = output_name(args.OutputFile, args.InputFile, args.All, args.Dir)
+        report = RunReport("EventReconstruction", vars(args), args.profile)
+        stream_data(files, output_filename, args.muon == "true", args.Threshold_OD_Fired, args.Muon_Veto_Window, args.chunk_size, report, args.histograms, vertex_fitter, args.compact)
+        finish_vertex_fit(vertex_fitter, report)
+        write_event_store(output_filename, args.event_store, report)
+        report.write(output_filename)
+        return
 
-    data_unclean = load_data(args.InputFile, args.All, args.Dir)
+    report = RunReport("EventReconstruction", vars(args), args.profile)
+    with report.stage("load"):
+        data_unclean = load_data(args.InputFile, args.All, args.Dir, args.compact)
     if data_unclean is None:
         print("No data loaded.")
         return
+    for file_path in list_input_files(args.InputFile, args.All, args.Dir):
+        report.count("bytes_input", os.path.getsize(file_path))
 
     print("### Event Reconstruction ###")
-    results = process_data(data_unclean)
-
-    if args.muon == "true":
-        results = apply_muon_veto(results,args.Threshold_OD_Fired)
-
-    results = calculate_energies(results)
-    save_results(results, args.OutputFile, args.InputFile, args.All, args.Dir)
+    results = reconstruct(data_unclean, args.muon == "true", args.Threshold_OD_Fired, args.Muon_Veto_Window, report, vertex_fitter)
+    finish_vertex_fit(vertex_fitter, report)
+    with report.stage("write"):
+        save_results(results, args.OutputFile, args.InputFile, args.All, args.Dir)
+    if args.histograms != "null":
+        with report.stage("histograms"):
+            histograms = HistogramSet()
+            histograms.fill_hits(data_unclean)
+            histograms.fill_events(results.events)
+            histograms.write(args.histograms)
+    write_event_store(output_name(args.OutputFile, args.InputFile, args.All, args.Dir), args.event_store, report)
+    report.write(output_name(args.OutputFile, args.InputFile, args.All, args.Dir))
 
 if __name__ == "__main__":
     main()
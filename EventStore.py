@@ -0,0 +1,201 @@
+# OSIRIS EVENT STORE
+# Per-event columns of RecEvents sorted by trgTime in memory-mappable .npy files, with min/max summaries of every
+# block of events, so that range queries (time, energy, OD multiplicity, position, run) only read the blocks they need
+# Authors: Davide Basilico davide.basilico@mi.infn.it, Marco Beretta marco.beretta@mi.infn.it
+
+import os
+import json
+import shutil
+import time
+import argparse
+from argparse import RawTextHelpFormatter
+import numpy as np
+import pandas as pd
+import uproot
+
+# One directory per store:
+#   <column>.npy       one per scalar branch of RecEvents (Index, trgTime, Charge_Norm, x, y, z, ...), plus
+#                      r (distance of x, y, z from the center, mm) and Run (number of the RecEvents file in meta.json)
+#   summary_min.npy, summary_max.npy   (blocks x summary columns) float64, NaN-ignoring min and max of every block
+#   meta.json          block size, columns, summary columns, runs (file, events, time range) and the size and mtime
+#                      of the RecEvents files; written last, a store without it is incomplete
+# Events without trgTime come last.
+summary_columns = ('trgTime', 'Charge_Norm', 'Energy_Prompt', 'OD_fired', 'x', 'y', 'z', 'r', 'Run')
+default_block_size = 4096
+
+def scalar_branches(tree):
+    # Per-event branches of a RecEvents tree: not the jagged per-hit branches nor their counters (nTOF, ...)
+    jagged = [branch for branch in tree.branches if branch.count_branch is not None]
+    counters = {branch.count_branch.name for branch in jagged}
+    return [branch.name for branch in tree.branches if branch.count_branch is None and branch.name not in counters]
+
+def file_stamp(file_path):
+    return [os.path.getsize(file_path), os.path.getmtime(file_path)]
+
+def build_store(rec_files, path, block_size=default_block_size, step_size="50 MB"):
+    # The scalar branches of every file are appended to raw files, then sorted by trgTime into the .npy columns;
+    # only the branches that all the files have are kept (e.g. the vertex fit ones only if every file has them)
+    branches = None
+    for file_path in rec_files:
+        with uproot.open(file_path) as f:
+            file_branches = scalar_branches(f["RecEvents"])
+        branches = file_branches if branches is None else [name for name in branches if name in file_branches]
+    with uproot.open(rec_files[0]) as f:
+        dtypes = {name: f["RecEvents"][name].interpretation.to_dtype.newbyteorder('=') for name in branches}
+    dtypes.update(r=np.dtype(np.float64), Run=np.dtype(np.int32))
+
+    work_path = path + ".tmp"
+    shutil.rmtree(work_path, ignore_errors=True)
+    os.makedirs(work_path)
+    raw = {name: open(os.path.join(work_path, name + ".raw"), 'wb') for name in dtypes}
+    runs = []
+    for run, file_path in enumerate(rec_files):
+        with uproot.open(file_path) as f:
+            tree = f["RecEvents"]
+            n_events, t_min, t_max = 0, np.inf, -np.inf
+            for arrays in tree.iterate(branches, step_size=step_size, library="np"):
+                arrays['r'] = np.sqrt(arrays['x'] ** 2 + arrays['y'] ** 2 + arrays['z'] ** 2)
+                arrays['Run'] = np.full(len(arrays['trgTime']), run, dtype=np.int32)
+                for name, values in arrays.items():
+                    raw[name].write(np.ascontiguousarray(values, dtype=dtypes[name]).tobytes())
+                n_events += len(arrays['trgTime'])
+                if np.any(~np.isnan(arrays['trgTime'])):
+                    t_min, t_max = min(t_min, np.nanmin(arrays['trgTime'])), max(t_max, np.nanmax(arrays['trgTime']))
+        # No time range without a finite trgTime (no events, or only events without a trigger time)
+        runs.append({'file': os.path.abspath(file_path), 'events': n_events, 't_min': float(t_min) if np.isfinite(t_min) else None, 't_max': float(t_max) if np.isfinite(t_max) else None})
+    for f in raw.values():
+        f.close()
+
+    n_events = sum(run['events'] for run in runs)
+    trgTime = np.fromfile(os.path.join(work_path, "trgTime.raw"), dtype=dtypes['trgTime'])
+    order = np.argsort(trgTime, kind='stable')  # NaN last
+    del trgTime
+    starts = np.arange(0, n_events, block_size)
+    summary_min = np.full((len(starts), len(summary_columns)), np.nan)
+    summary_max = np.full((len(starts), len(summary_columns)), np.nan)
+    rows_per_copy = max(block_size, (1 << 20) // block_size * block_size)
+    for name, dtype in dtypes.items():
+        raw_path = os.path.join(work_path, name + ".raw")
+        values = np.memmap(raw_path, dtype=dtype, mode='r', shape=(n_events,)) if n_events > 0 else np.empty(0, dtype=dtype)
+        column = np.lib.format.open_memmap(os.path.join(work_path, name + ".npy"), mode='w+', dtype=dtype, shape=(n_events,))
+        for start in range(0, n_events, rows_per_copy):
+            column[start:start + rows_per_copy] = values[order[start:start + rows_per_copy]]
+        if name in summary_columns and n_events > 0:
+            k = summary_columns.index(name)
+            with np.errstate(invalid='ignore'):
+                summary_min[:, k] = np.fmin.reduceat(column.astype(np.float64), starts)
+                summary_max[:, k] = np.fmax.reduceat(column.astype(np.float64), starts)
+        column.flush()
+        del values, column
+        os.remove(raw_path)
+    np.save(os.path.join(work_path, "summary_min.npy"), summary_min)
+    np.save(os.path.join(work_path, "summary_max.npy"), summary_max)
+
+    meta = {
+        'block_size': block_size,
+        'events': n_events,
+        'columns': {name: dtype.str for name, dtype in dtypes.items()},
+        'summaries': list(summary_columns),
+        'runs': runs,
+        'sources': {os.path.abspath(file_path): file_stamp(file_path) for file_path in rec_files}
+    }
+    with open(os.path.join(work_path, "meta.json"), 'w') as f:
+        json.dump(meta, f, indent=2)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(work_path, path)
+    return path
+
+def is_store(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, "meta.json"))
+
+class EventStore:
+    # Read-only memory maps of a store; select() reads only the blocks whose summaries can match the query
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.block_size = self.meta['block_size']
+        self.num_events = self.meta['events']
+        self.runs = self.meta['runs']
+        self.columns = {name: np.load(os.path.join(path, name + ".npy"), mmap_mode='r') for name in self.meta['columns']}
+        self.summaries = {name: k for k, name in enumerate(self.meta['summaries'])}
+        self.summary_min = np.load(os.path.join(path, "summary_min.npy"))
+        self.summary_max = np.load(os.path.join(path, "summary_max.npy"))
+        self.blocks_read = 0  # blocks read by the queries so far
+
+    def up_to_date(self):
+        # True if the RecEvents files are those the store was built from (same size and mtime)
+        return all(os.path.exists(file_path) and file_stamp(file_path) == stamp for file_path, stamp in self.meta['sources'].items())
+
+    @property
+    def num_blocks(self):
+        return len(self.summary_min)
+
+    def candidate_blocks(self, ranges):
+        # Blocks whose [min, max] overlaps every range with a summary
+        candidates = np.ones(self.num_blocks, dtype=bool)
+        for name, (low, high) in ranges.items():
+            if name not in self.summaries:
+                continue
+            k = self.summaries[name]
+            with np.errstate(invalid='ignore'):
+                if low is not None:
+                    candidates &= self.summary_max[:, k] >= low
+                if high is not None:
+                    candidates &= self.summary_min[:, k] <= high
+        return np.flatnonzero(candidates)
+
+    def rows(self, **ranges):
+        # Rows (in time order) of the events with low <= column <= high for every column=(low, high); None leaves a side open
+        for name in ranges:
+            if name not in self.columns:
+                raise ValueError(f"Column not in the event store: {name}. Available: {', '.join(self.columns)}")
+        blocks = self.candidate_blocks(ranges)
+        self.blocks_read += len(blocks)
+        if len(blocks) == 0:
+            return np.array([], dtype=np.int64)
+        # Consecutive candidate blocks are read as one slice
+        runs = np.split(blocks, np.flatnonzero(np.diff(blocks) > 1) + 1)
+        selected = []
+        for run in runs:
+            start, stop = run[0] * self.block_size, min((run[-1] + 1) * self.block_size, self.num_events)
+            keep = np.ones(stop - start, dtype=bool)
+            for name, (low, high) in ranges.items():
+                values = self.columns[name][start:stop]
+                if low is not None:
+                    keep &= values >= low
+                if high is not None:
+                    keep &= values <= high
+            selected.append(start + np.flatnonzero(keep))
+        return np.concatenate(selected)
+
+    def select(self, columns=None, **ranges):
+        # Event table (index: Index) of the events in the ranges, in time order, e.g.
+        # store.select(['trgTime', 'Energy_Prompt', 'x', 'y', 'z'], trgTime=(t0, t1), Energy_Prompt=(0.6, 1.3), r=(None, 1000.))
+        rows = self.rows(**ranges)
+        columns = [name for name in self.columns if name != 'Index'] if columns is None else columns
+        return pd.DataFrame({name: self.columns[name][rows] for name in columns}, index=pd.Index(self.columns['Index'][rows], name='index'))
+
+    def time_range(self):
+        times = [(run['t_min'], run['t_max']) for run in self.runs if run['t_min'] is not None]
+        return (min(t[0] for t in times), max(t[1] for t in times)) if len(times) > 0 else (None, None)
+
+def parse_arguments():
+    prs = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter)
+    prs.add_argument("InputFile", nargs="+", help="RecEvents ROOT file(s) from EventReconstruction, HORUS or Farm")
+    prs.add_argument("-o", "--OutputDir", required=True, help="Event store directory")
+    prs.add_argument("-b", "--block_size", type=int, default=default_block_size, help=f"Events per block of the min/max summaries; default: {default_block_size}")
+    return prs.parse_args()
+
+def main():
+    args = parse_arguments()
+    print("### Welcome to the HORUS event store ###")
+    build_store(args.InputFile, args.OutputDir, args.block_size)
+    store = EventStore(args.OutputDir)
+    print(f"Event store created: {args.OutputDir} ({store.num_events} events, {store.num_blocks} blocks)")
+
+if __name__ == "__main__":
+    time_start = time.time()
+    main()
+    time_end = time.time()
+    print(f"Completed in: {time_end-time_start:.2f} s")
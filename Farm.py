@@ -0,0 +1,164 @@
+# OSIRIS RUN FARM: fused reconstruction (HORUS.py) of many raw ROOT files in parallel, merged into one RecEvents
+# Authors: Davide Basilico davide.basilico@mi.infn.it, Marco Beretta marco.beretta@mi.infn.it
+
+import os
+import glob
+import time
+import argparse
+import traceback
+from argparse import RawTextHelpFormatter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import redirect_stdout, redirect_stderr
+import numpy as np
+import uproot
+from HORUS import reconstruct_file
+from EventReconstruction import merge_rec_events, vertex_modes
+from Manifest import Manifest
+from Instrumentation import RunReport
+from utils import extract_date_and_formatted_date
+
+def parse_arguments():
+    prs = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter)
+    prs.add_argument("Input", nargs="+", help="Raw ROOT files (EventTree), directories or glob patterns (quoted, e.g. 'data/RUN_202407*.root')")
+    prs.add_argument("-o", "--OutputDir", default="farm", help="Directory for rec-<run>.root, logs/<run>.log and the merged file; default: farm")
+    prs.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="Files reconstructed at the same time; default: number of CPUs")
+    prs.add_argument("--merged", default="rec-merged.root", help="Merged RecEvents file in OutputDir, 'false' to skip the merge; default: rec-merged.root")
+    prs.add_argument("--manifest", default="null", help="Manifest JSON file: files already reconstructed with the same parameters are skipped; default: none")
+    prs.add_argument("-m", "--muon", default="true", help="Apply muon veto; default: true")
+    prs.add_argument("-Muon_Veto_Threshold", "--Threshold_OD_Fired", type=int, default=5, help="Muon veto threshold for OD multiplicity; default: 5")
+    prs.add_argument("-Muon_Veto_Window", "--Muon_Veto_Window", type=float, default=20E-6, help="Half-width of the muon veto time window in s; default: 20e-6")
+    prs.add_argument("-w", "--workers", type=int, default=1, help="Worker processes for the waveform analysis of each file; default: 1")
+    prs.add_argument("--cleaning", default="false", help="Low-pass FFT cleaning of the waveforms; default: false")
+    prs.add_argument("--cutoff", type=float, default=0.10, help="Cleaning cutoff frequency in units of the sampling frequency; default: 0.10")
+    prs.add_argument("--multi_pulse", default="false", help="Every pulse of each waveform is a hit (see WaveformAnalyzer.py); default: false")
+    prs.add_argument("--vertex", default="barycenter", choices=vertex_modes, help="Event position: charge barycenter or likelihood vertex fit (see EventReconstruction.py); default: barycenter")
+    prs.add_argument("--cache", default="true", help="Read the decoded waveform cache of a run when it exists; default: true")
+    prs.add_argument("-s", "--step_size", default="50 MB", help="Size of the chunks read from EventTree; default: 50 MB")
+    prs.add_argument("--memory_budget", default="null", help="Memory for the waveform chunks of each job (e.g. '2 GB'), instead of --step_size; default: none")
+    prs.add_argument("--compact", default="false", help="Memory-efficient mode: float32 waveform analysis and compact hit dtypes (see WaveformAnalyzer.py); default: false")
+    return prs.parse_args()
+
+def raw_files(inputs):
+    # Raw ROOT files of the given files, directories and glob patterns, without the outputs of HORUS (rec-*.root)
+    files = set()
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, "*.root")
+        files.update(f for f in glob.glob(pattern) if f.endswith(".root") and not os.path.basename(f).startswith("rec-"))
+    return sorted(os.path.abspath(f) for f in files if has_event_tree(f))
+
+def has_event_tree(file_path):
+    try:
+        with uproot.open(file_path) as f:
+            return "EventTree" in f
+    except Exception:
+        return False
+
+def run_key(file_path):
+    # Runs are merged in time order (run string of the name); names without a run string come last
+    extracted_string, _ = extract_date_and_formatted_date(file_path)
+    return (extracted_string is None, extracted_string or "", os.path.basename(file_path))
+
+def output_paths(input_file, output_dir):
+    stem = os.path.splitext(os.path.basename(input_file))[0]
+    return os.path.join(output_dir, "rec-" + stem + ".root"), os.path.join(output_dir, "logs", stem + ".log")
+
+def run_job(task):
+    # One file, start to end, with everything it prints in its log; errors are returned, not raised
+    input_file, output_dir, options, manifest_file = task
+    output_file, log_file = output_paths(input_file, output_dir)
+    parameters = {name: value for name, value in options.items() if name not in ('workers', 'step_size', 'memory_budget', 'use_cache')}  # those that change the output
+    time_start = time.time()
+    status, error = "done", None
+    with open(log_file, 'w') as log, redirect_stdout(log), redirect_stderr(log):
+        try:
+            manifest = Manifest(manifest_file) if manifest_file != "null" else None
+            if manifest is not None and manifest.is_done(input_file, output_file, "HORUS", parameters):
+                print("Unchanged since the last reconstruction, skipped: ", input_file)
+                status = "skipped"
+            else:
+                if manifest is not None:
+                    manifest.start(input_file, output_file, "HORUS", parameters)
+                report = RunReport("HORUS", {'InputFile': input_file, **options})
+                reconstruct_file(input_file, output_file, report=report, **options)
+                report.write(output_file)
+                if manifest is not None:
+                    manifest.finish(output_file)
+        except Exception:
+            traceback.print_exc()
+            status, error = "failed", traceback.format_exc().strip().splitlines()[-1]
+    return {'input': input_file, 'output': output_file, 'log': log_file, 'status': status, 'error': error, 'time': time.time() - time_start}
+
+def run_farm(files, output_dir, jobs, options, manifest_file="null"):
+    # Largest files first, so that the longest jobs do not start last
+    os.makedirs(os.path.join(output_dir, "logs"), exist_ok=True)
+    files = sorted(files, key=os.path.getsize, reverse=True)
+    tasks = [(input_file, output_dir, options, manifest_file) for input_file in files]
+    results = []
+    with ProcessPoolExecutor(max(jobs, 1)) as pool:  # not a multiprocessing.Pool: its daemon workers could not start the -w workers
+        futures = [pool.submit(run_job, task) for task in tasks]
+        for k, future in enumerate(as_completed(futures)):
+            result = future.result()
+            results.append(result)
+            print(f"[{k + 1}/{len(futures)}] {result['status']:<7s} {os.path.basename(result['input'])} ({result['time']:.1f} s)" + (f": {result['error']} (see {result['log']})" if result['error'] else ""))
+    return results
+
+def run_entries(input_file):
+    try:
+        return int(uproot.open(input_file)['EventTree'].num_entries)
+    except Exception:
+        return 0
+
+def merge_runs(results, merged_file):
+    # Global event index: the EventTree entries of each run follow those of all the previous runs in time order
+    # (failed ones included), so that an event keeps its index whatever files were reconstructed together
+    runs = sorted(results, key=lambda result: run_key(result['input']))
+    entries = np.array([run_entries(result['input']) for result in runs], dtype=np.int64)
+    index_offsets = np.cumsum(entries) - entries
+    merged = [k for k, result in enumerate(runs) if result['status'] != "failed"]
+    n_events = merge_rec_events([runs[k]['output'] for k in merged], index_offsets[merged], merged_file)
+    with uproot.update(merged_file) as f:
+        f["runs"] = "\n".join(os.path.basename(runs[k]['input']) for k in merged)
+        f.mktree("MergedRuns", {"index_offset": np.int64, "entries": np.int64})
+        f["MergedRuns"].extend({"index_offset": index_offsets[merged], "entries": entries[merged]})
+    return n_events, len(merged)
+
+def main():
+    args = parse_arguments()
+    print("### Welcome to the HORUS run farm ###")
+    files = raw_files(args.Input)
+    if len(files) == 0:
+        print("No raw ROOT files found.")
+        return
+    print(f"Files: {len(files)} ({sum(os.path.getsize(f) for f in files) / 1e9:.2f} GB); jobs: {args.jobs}")
+
+    options = {
+        'muon': args.muon == "true",
+        'Threshold_OD_Fired': args.Threshold_OD_Fired,
+        'Muon_Veto_Window': args.Muon_Veto_Window,
+        'workers': args.workers,
+        'cleaning': args.cleaning,
+        'cleaning_cutoff': args.cutoff,
+        'step_size': args.step_size,
+        'use_cache': args.cache,
+        'multi_pulse': args.multi_pulse,
+        'vertex': args.vertex,
+        'compact': args.compact,
+        'memory_budget': args.memory_budget
+    }
+    results = run_farm(files, args.OutputDir, args.jobs, options, args.manifest)
+    failed = [result for result in results if result['status'] == "failed"]
+
+    if args.merged != "false":
+        merged_file = os.path.join(args.OutputDir, args.merged)
+        n_events, n_runs = merge_runs(results, merged_file)
+        print(f"Output ROOT file created: {merged_file} ({n_events} events from {n_runs} runs)")
+    if len(failed) > 0:
+        print(f"Failed: {len(failed)} files")
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    time_start = time.time()
+    main()
+    time_end = time.time()
+    print(f"Completed in: {time_end-time_start:.2f} s")
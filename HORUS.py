@@ -0,0 +1,87 @@
+# OSIRIS FUSED RECONSTRUCTION: EventTree -> waveform analysis -> event reconstruction -> RecEvents
+# Authors: Davide Basilico davide.basilico@mi.infn.it, Marco Beretta marco.beretta@mi.infn.it
+
+import os
+import time
+import argparse
+from argparse import RawTextHelpFormatter
+import pandas as pd
+from HitTable import HitWriter, table_dtypes
+from WaveformAnalyzer import analyze_file, budget_step_size
+from EventReconstruction import RecWriter, StreamingReconstruction, vertex_modes, finish_vertex_fit, write_event_store
+from VertexFit import VertexFitter
+from utils import extract_date_and_formatted_date
+from Instrumentation import RunReport, profile_modes
+from Histograms import HistogramSet
+
+def parse_arguments():
+    prs = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter)
+    prs.add_argument("InputFile", help="Input ROOT file (EventTree)")
+    prs.add_argument("-o", "--OutputFile", default="null", help="Output ROOT file with the RecEvents tree; default: rec-input_file.root")
+    prs.add_argument("--hits", default="null", help="Also write the intermediate hit table (debug); .root for a HitTree, text otherwise; default: none")
+    prs.add_argument("-m", "--muon", default="true", help="Apply muon veto; default: true")
+    prs.add_argument("-Muon_Veto_Threshold", "--Threshold_OD_Fired", type=int, default=5, help="Muon veto threshold for OD multiplicity; default: 5")
+    prs.add_argument("-Muon_Veto_Window", "--Muon_Veto_Window", type=float, default=20E-6, help="Half-width of the muon veto time window in s; default: 20e-6")
+    prs.add_argument("-w", "--workers", type=int, default=1, help="Number of worker processes for the waveform analysis; default: 1 (serial)")
+    prs.add_argument("--cleaning", default="false", help="Low-pass FFT cleaning of the waveforms; default: false")
+    prs.add_argument("--cache", default="true", help="Read the decoded waveform cache of the run (see WaveformCache.py) when it exists; default: true")
+    prs.add_argument("--cache_dir", default="null", help="Waveform cache directory; default: waveform_cache next to the input file")
+    prs.add_argument("-s", "--step_size", default="50 MB", help="Size of the chunks read from EventTree, in bytes (e.g. '50 MB') or entries; default: 50 MB")
+    prs.add_argument("--memory_budget", default="null", help="Memory for the waveform chunks being analysed, shared by the workers (e.g. '2 GB'), instead of --step_size; default: none")
+    prs.add_argument("--compact", default="false", help="Memory-efficient mode: waveforms analysed in float32, hits with compact dtypes (see WaveformAnalyzer.py); default: false")
+    prs.add_argument("--cutoff", type=float, default=0.10, help="Cleaning cutoff frequency in units of the sampling frequency; default: 0.10")
+    prs.add_argument("--multi_pulse", default="false", help="Every pulse of each waveform is a hit (see WaveformAnalyzer.py); default: false")
+    prs.add_argument("--vertex", default="barycenter", choices=vertex_modes, help="Event position: charge barycenter or likelihood vertex fit (see EventReconstruction.py); default: barycenter")
+    prs.add_argument("--vertex_workers", type=int, default=1, help="Worker processes of the vertex fit; default: 1")
+    prs.add_argument("--histograms", default="null", help="ROOT file for the monitoring histograms of the hits and of the reconstructed events; default: none")
+    prs.add_argument("--event_store", default="null", help="Directory for the event store of the output (see EventStore.py); default: none")
+    prs.add_argument("--profile", default="false", choices=profile_modes, help="Profile the run: cprofile (OutputFile.prof) or sample (in the report); default: false")
+    return prs.parse_args()
+
+def reconstruct_file(input_file, output_file, hit_file="null", muon=True, Threshold_OD_Fired=5, Muon_Veto_Window=20E-6, workers=1, cleaning="false", cleaning_cutoff=0.10, step_size="50 MB", use_cache="true", cache_dir="null", report=None, multi_pulse="false", histogram_file="null", vertex="barycenter", vertex_workers=1, compact="false", memory_budget="null"):
+    # Hits of every block go straight into the streaming reconstruction; nothing is written in between.
+    # The hits are histogrammed in the waveform analysis (by the workers in parallel mode), the events as they are written
+    report = report if report is not None else RunReport("reconstruct_file")
+    extracted_string, extracted_date = extract_date_and_formatted_date(input_file)
+    print("Run: ", extracted_string, "\nDate:", extracted_date)
+    hit_writer = None
+    if hit_file != "null":
+        hit_writer = HitWriter(hit_file, "root" if hit_file.endswith(".root") else "txt", extracted_string, extracted_date, dtypes=table_dtypes(multi_pulse, compact))
+    if memory_budget != "null":
+        step_size = budget_step_size(input_file, memory_budget, workers, cleaning, compact, multi_pulse, use_cache, cache_dir)
+
+    histograms = HistogramSet() if histogram_file != "null" else None
+    vertex_fitter = VertexFitter(vertex_workers) if vertex == "fit" else None
+    with RecWriter(output_file, vertex_fitter is not None) as writer:
+        stream = StreamingReconstruction(writer, muon, Threshold_OD_Fired, Muon_Veto_Window, report, histograms, vertex_fitter)
+        for hits in analyze_file(input_file, workers, step_size, cleaning, cleaning_cutoff, use_cache=use_cache, cache_dir=cache_dir, report=report, multi_pulse=multi_pulse, histograms=histograms, compact=compact):
+            if hit_writer is not None:
+                with report.stage("write_hits"):
+                    hit_writer.write(hits)
+            stream.add_hits(pd.DataFrame(hits), last_chunk=False)
+        vetoed_time = stream.close()
+    finish_vertex_fit(vertex_fitter, report)
+
+    if histograms is not None:
+        histograms.write(histogram_file)
+    if hit_writer is not None:
+        hit_writer.close()
+        print(f"Hit table created: {hit_file}")
+    if muon:
+        print(f"\tVetoed live time: {vetoed_time:.6f} s")
+    print(f"Output ROOT file created: {output_file} ({writer.entries} events)")
+
+def main():
+    args = parse_arguments()
+    print("### Welcome to the HORUS fused reconstruction ###")
+    output_file = args.OutputFile if args.OutputFile != "null" else "rec-" + os.path.splitext(os.path.basename(args.InputFile))[0] + ".root"
+    report = RunReport("HORUS", vars(args), args.profile)
+    reconstruct_file(args.InputFile, output_file, args.hits, args.muon == "true", args.Threshold_OD_Fired, args.Muon_Veto_Window, args.workers, args.cleaning, args.cutoff, args.step_size, args.cache, args.cache_dir, report, args.multi_pulse, args.histograms, args.vertex, args.vertex_workers, args.compact, args.memory_budget)
+    write_event_store(output_file, args.event_store, report)
+    report.write(output_file)
+
+if __name__ == "__main__":
+    time_start = time.time()
+    main()
+    time_end = time.time()
+    print(f"Completed in: {time_end-time_start:.2f} s")
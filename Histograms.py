@@ -0,0 +1,121 @@
+import numpy as np
+import uproot
+from uproot.writing.identify import to_TH1x, to_TH2x, to_TAxis
+from CableMap import load_cable_map
+
+# Fixed-binning monitoring histograms filled block by block: integer counts with under/overflow bins,
+# so memory does not depend on the number of hits and partial histograms (e.g. of worker processes) add up exactly.
+# Written as TH1D/TH2D; per-channel histograms use the cable-map cell GCUID * n_channels + channelID // 2 as x.
+
+class Histogram:
+    def __init__(self, name, title, axes):
+        # axes: one (bins, low, high, title) per dimension
+        self.name = name
+        self.title = title
+        self.axes = [(int(bins), float(low), float(high), axis_title) for bins, low, high, axis_title in axes]
+        self.counts = np.zeros(tuple(bins + 2 for bins, _, _, _ in self.axes), dtype=np.int64)
+
+    def bin_index(self, values, axis):
+        # 0 underflow, 1..bins, bins + 1 overflow; NaN values are not counted (-1)
+        # As numpy.histogram: the index from the scaled value is corrected against the bin edges, so that values on an edge
+        # always go to the bin starting there
+        bins, low, high, _ = self.axes[axis]
+        values = np.asarray(values, dtype=np.float64)
+        edges = self.edges(axis)
+        nan = np.isnan(values)
+        index = np.clip(np.floor((np.where(nan, low, values) - low) * (bins / (high - low))), 0, bins - 1).astype(np.int64)
+        index[values < edges[index]] -= 1
+        index[values >= edges[index + 1]] += 1
+        index = np.clip(index + 1, 0, bins + 1)
+        index[nan] = -1
+        return index
+
+    def fill(self, *values):
+        index = [self.bin_index(v, axis) for axis, v in enumerate(values)]
+        valid = np.all([i >= 0 for i in index], axis=0) if len(index) > 1 else index[0] >= 0
+        flat = np.ravel_multi_index([i[valid] for i in index], self.counts.shape)
+        self.counts += np.bincount(flat, minlength=self.counts.size).reshape(self.counts.shape)
+
+    def add(self, other):
+        if self.name != other.name or self.axes != other.axes:
+            raise ValueError(f"Histograms with different binning cannot be added: {self.name}, {other.name}")
+        self.counts += other.counts
+        return self
+
+    def edges(self, axis):
+        bins, low, high, _ = self.axes[axis]
+        return np.linspace(low, high, bins + 1)
+
+    def centers(self, axis):
+        edges = self.edges(axis)
+        return (edges[1:] + edges[:-1]) / 2
+
+    def to_root(self):
+        counts = self.counts.astype(np.float64)
+        entries = float(self.counts.sum())
+        axes = [to_TAxis(f"{'xyz'[k]}axis", axis_title, bins, low, high) for k, (bins, low, high, axis_title) in enumerate(self.axes)]
+        inner = counts[tuple(slice(1, -1) for _ in self.axes)]
+        sumw = float(inner.sum())
+        if len(self.axes) == 1:
+            x = self.centers(0)
+            return to_TH1x(self.name, self.title, counts, entries, sumw, sumw, float(np.sum(inner * x)), float(np.sum(inner * x * x)), counts, axes[0], to_TAxis("yaxis", "", 1, 0., 1.))
+        x, y = self.centers(0)[:, None], self.centers(1)[None, :]
+        data = counts.ravel(order='F')  # ROOT: x runs fastest
+        return to_TH2x(self.name, self.title, data, entries, sumw, sumw, float(np.sum(inner * x)), float(np.sum(inner * x * x)),
+                       float(np.sum(inner * y)), float(np.sum(inner * y * y)), float(np.sum(inner * x * y)), data, axes[0], axes[1])
+
+class HistogramSet:
+    # Monitoring histograms of the hits (WaveformAnalyzer) and of the reconstructed events (EventReconstruction)
+    def __init__(self, cable_map=None):
+        cable_map = cable_map if cable_map is not None else load_cable_map()
+        self.cable_map = cable_map
+        n_cells = cable_map.n_GCU * cable_map.n_channels
+        self.histograms = {h.name: h for h in (
+            Histogram("hit_charge", "Charge of the hits", [(220, -20000., 2000., "charge")]),
+            Histogram("channel_charge", f"Charge per channel (GCUID * {cable_map.n_channels} + channelID // 2)", [(n_cells, 0., n_cells, "channel"), (220, -20000., 2000., "charge")]),
+            Histogram("rise_time", "Rise time of the hits", [(600, 0., 600., "WF_RiseTime (samples)")]),
+            Histogram("channel_rise_time", f"Rise time per channel (GCUID * {cable_map.n_channels} + channelID // 2)", [(n_cells, 0., n_cells, "channel"), (150, 0., 600., "WF_RiseTime (samples)")]),
+            Histogram("Charge_Norm", "Charge_Norm of the events", [(500, -1000., 49000., "Charge_Norm")]),
+            Histogram("Fired_PMTs", "Fired PMTs of the events", [(151, -0.5, 150.5, "Fired_PMTs")])
+        )}
+
+    def __getitem__(self, name):
+        return self.histograms[name]
+
+    def fill_hits(self, hits):
+        charge = np.asarray(hits['charge'], dtype=np.float64)
+        rise_time = np.asarray(hits['WF_RiseTime'], dtype=np.float64)
+        channel = self.cable_map.flat_index(hits['GCUID'], hits['ID_channel'])
+        self['hit_charge'].fill(charge)
+        self['channel_charge'].fill(channel, charge)
+        self['rise_time'].fill(rise_time)
+        self['channel_rise_time'].fill(channel, rise_time)
+
+    def fill_events(self, results):
+        self['Charge_Norm'].fill(np.asarray(results['Charge_Norm'], dtype=np.float64))
+        self['Fired_PMTs'].fill(np.asarray(results['Fired_PMTs'], dtype=np.float64))
+
+    def add(self, other):
+        for name, histogram in self.histograms.items():
+            histogram.add(other[name])
+        return self
+
+    def read(self, file_path):
+        # Adds the histograms of a file written by write (e.g. of another run); the counts are integers stored as doubles, so the sum stays exact
+        with uproot.open(file_path) as f:
+            for name, histogram in self.histograms.items():
+                if name in f:
+                    stored = f[name]
+                    edges = [axis.edges() for axis in stored.axes]
+                    if [(len(e) - 1, e[0], e[-1]) for e in edges] != [axis[:3] for axis in histogram.axes]:
+                        raise ValueError(f"Histogram {name} of {file_path} has a different binning")
+                    histogram.counts += np.rint(stored.values(flow=True)).astype(np.int64)
+        return self
+
+    def write(self, file_path):
+        # Only the histograms that were filled
+        with uproot.recreate(file_path) as f:
+            for name, histogram in self.histograms.items():
+                if histogram.counts.any():
+                    f[name] = histogram.to_root()
+        print(f"Histogram file created: {file_path}")
@@ -0,0 +1,170 @@
+import numpy as np
+import pandas as pd
+import uproot
+
+# Hit table produced by WaveformAnalyzer: one row per fired high-gain channel
+
+hit_dtypes = {
+	'index': np.int64,
+	'charge': np.float64,
+	'GCU': np.int32,
+	'WF_RiseTime': np.int32,
+	'trgTime': np.float64,
+	'ID_channel': np.int32,
+	'GCUID': np.int32,
+	'x_PMT': np.float64,
+	'y_PMT': np.float64,
+	'z_PMT': np.float64,
+	'LivePMTs': np.int32,
+	'gain': np.float64,
+	'OD': np.int32,
+	'Shape_Ch': np.int32
+}
+hit_columns = tuple(hit_dtypes)
+
+# Extra columns of the multi-pulse analysis (WaveformAnalyzer --multi_pulse true): one row per pulse,
+# numbered from 0 within its channel; charge and WF_RiseTime are those of the pulse
+pulse_dtypes = {
+	'pulse': np.int32,
+	'peak': np.int32,
+	'amplitude': np.float64,
+	'width': np.int32
+}
+multi_pulse_dtypes = {**hit_dtypes, **pulse_dtypes}
+
+# Memory-efficient hit table (--compact true): channel numbers and flags in small integers, charges and positions
+# in float32 (about 7 significant digits). trgTime stays float64 (ns over a run time of ~1e9 s) and index int64.
+compact_hit_dtypes = {
+	'index': np.int64,
+	'charge': np.float32,
+	'GCU': np.uint16,
+	'WF_RiseTime': np.int16,
+	'trgTime': np.float64,
+	'ID_channel': np.uint8,
+	'GCUID': np.uint8,
+	'x_PMT': np.float32,
+	'y_PMT': np.float32,
+	'z_PMT': np.float32,
+	'LivePMTs': np.uint16,
+	'gain': np.float32,
+	'OD': np.uint8,
+	'Shape_Ch': np.uint16
+}
+compact_pulse_dtypes = {
+	'pulse': np.uint16,
+	'peak': np.int16,
+	'amplitude': np.float32,
+	'width': np.int16
+}
+compact_multi_pulse_dtypes = {**compact_hit_dtypes, **compact_pulse_dtypes}
+
+def table_dtypes(multi_pulse='false', compact='false'):
+	# Columns and dtypes of the hit table of an analysis
+	if compact == 'true':
+		return compact_multi_pulse_dtypes if multi_pulse == 'true' else compact_hit_dtypes
+	return multi_pulse_dtypes if multi_pulse == 'true' else hit_dtypes
+
+def cast_hits(hits, dtypes):
+	# Hit table (dict of arrays) with the given dtypes; columns without a dtype are kept as they are
+	return {key: values.astype(dtypes[key], copy=False) if key in dtypes else values for key, values in hits.items()}
+
+def text_header(columns):
+	return "name\tdate\t" + "\t".join(columns) + "\n"
+
+header = text_header(hit_columns)
+tree_name = "HitTree"
+output_formats = ("txt", "root")
+
+def text_values(values):
+	# float32 columns are written with the shortest digits that read back the same float32, not those of the float64 they widen to
+	return values.astype(str).tolist() if values.dtype == np.float32 else values.tolist()
+
+class HitWriter:
+	def __init__(self, output_file, output_format, extracted_string, extracted_date, buffer_rows=200000, dtypes=hit_dtypes):
+		if output_format not in output_formats:
+			raise ValueError(f"Output format not valid. Please use one of {output_formats}.")
+		self.output_format = output_format
+		self.dtypes = dtypes
+		self.columns = tuple(dtypes)
+		self.extracted_string = extracted_string
+		self.extracted_date = extracted_date
+		self.buffer_rows = buffer_rows
+		self.buffer = {key: [] for key in self.columns}
+		self.buffered = 0
+
+		if output_format == 'txt':
+			self.file = open(output_file, 'w')
+			self.file.write(text_header(self.columns))
+		else:
+			self.file = uproot.recreate(output_file)
+			self.file["run"] = str(extracted_string)
+			self.file["date"] = str(extracted_date)
+			self.file.mktree(tree_name, {key: np.dtype(dtype) for key, dtype in dtypes.items()})
+
+	def write(self, hits):
+		if self.output_format == 'txt':
+			columns = [text_values(np.asarray(hits[key])) for key in self.columns]
+			lines = [f"{self.extracted_string}\t{self.extracted_date}\t" + "\t".join(str(value) for value in row) + "\n" for row in zip(*columns)]
+			self.file.writelines(lines)
+			return
+
+		# Accumulate to avoid writing many tiny baskets
+		for key in self.columns:
+			self.buffer[key].append(np.asarray(hits[key], dtype=self.dtypes[key]))
+		self.buffered += len(hits['index'])
+		if self.buffered >= self.buffer_rows:
+			self.flush()
+
+	def flush(self):
+		if self.output_format == 'root' and self.buffered > 0:
+			self.file[tree_name].extend({key: np.concatenate(self.buffer[key]) for key in self.columns})
+			self.buffer = {key: [] for key in self.columns}
+			self.buffered = 0
+
+	def close(self):
+		self.flush()
+		self.file.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+def concatenate_hits(hits_list, dtypes=hit_dtypes):
+	if len(hits_list) == 0:
+		return {key: np.array([], dtype=dtype) for key, dtype in dtypes.items()}
+	return {key: np.concatenate([hits[key] for hits in hits_list]) for key in hits_list[0]}
+
+def text_dtypes(dtypes):
+	# read_csv dtypes of a text hit file: run name and date (the same on every line) as categories
+	return None if dtypes is None else {'name': 'category', 'date': 'category', **dtypes}
+
+def frame_dtypes(frame, dtypes):
+	# Hit table of a HitTree with the given dtypes (e.g. compact_hit_dtypes), for the columns it has
+	return frame if dtypes is None else frame.astype({key: dtype for key, dtype in dtypes.items() if key in frame.columns})
+
+def read_hits(file_path, dtypes=None):
+	# dtypes: dtypes of the columns (e.g. compact_hit_dtypes), pandas defaults (int64, float64) if None
+	if file_path.endswith('.root'):
+		with uproot.open(file_path) as file:
+			return frame_dtypes(file[tree_name].arrays(library="pd"), dtypes)
+	return pd.read_csv(file_path, delimiter='\t', dtype=text_dtypes(dtypes))
+
+def iterate_hits(file_path, chunk_rows, dtypes=None):
+	# Yields (hits, is_last_chunk) with at most chunk_rows hits each
+	if file_path.endswith('.root'):
+		with uproot.open(file_path) as file:
+			tree = file[tree_name]
+			for start in range(0, max(tree.num_entries, 1), chunk_rows):
+				stop = min(start + chunk_rows, tree.num_entries)
+				yield frame_dtypes(tree.arrays(entry_start=start, entry_stop=stop, library="pd"), dtypes), stop >= tree.num_entries
+		return
+	reader = pd.read_csv(file_path, delimiter='\t', chunksize=chunk_rows, dtype=text_dtypes(dtypes))
+	previous = None
+	for chunk in reader:
+		if previous is not None:
+			yield previous, False
+		previous = chunk
+	if previous is not None:
+		yield previous, True
@@ -0,0 +1,162 @@
+import os
+import sys
+import json
+import time
+import platform
+import resource
+import threading
+import cProfile
+import pstats
+import io
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+
+# Per-stage wall/CPU time, counters and peak memory of a program run, written as a JSON report next to the output.
+# Optional profiling: "cprofile" (deterministic, with overhead) or "sample" (stack of the main thread every 10 ms).
+
+profile_modes = ("false", "cprofile", "sample")
+
+def peak_rss_MB():
+    # Peak resident memory of this process so far. On Linux VmHWM of /proc: ru_maxrss is kept across exec, so a process
+    # spawned by a large one (e.g. a multiprocessing "spawn" worker) would report the peak of its parent
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1e3
+    except OSError:
+        pass
+    # ru_maxrss is in kB on Linux, in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1e6 if platform.system() == "Darwin" else peak / 1e3
+
+def report_name(output_file):
+    return os.path.splitext(output_file)[0] + "_report.json"
+
+class SamplingProfiler:
+    # Counts the functions on the stack of the main thread at regular intervals
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.leaf = Counter()
+        self.inclusive = Counter()
+        self.samples = 0
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.main_id = threading.main_thread().ident
+
+    def sample(self):
+        while not self.stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.main_id)
+            if frame is None:
+                continue
+            self.samples += 1
+            self.leaf[self.location(frame)] += 1
+            seen = set()
+            while frame is not None:
+                location = self.location(frame)
+                if location not in seen:
+                    self.inclusive[location] += 1
+                    seen.add(location)
+                frame = frame.f_back
+
+    @staticmethod
+    def location(frame):
+        return f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}"
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+
+    def summary(self, top=25):
+        share = lambda counts: [{'function': name, 'samples': n, 'fraction': n / max(self.samples, 1)} for name, n in counts.most_common(top)]
+        return {'mode': 'sample', 'interval_s': self.interval, 'samples': self.samples, 'self': share(self.leaf), 'inclusive': share(self.inclusive)}
+
+class RunReport:
+    def __init__(self, program, parameters=None, profile="false"):
+        if profile not in profile_modes:
+            raise ValueError(f"Profile mode not valid. Please use one of {profile_modes}.")
+        self.program = program
+        self.parameters = parameters if parameters is not None else {}
+        self.stages = {}
+        self.counters = Counter()
+        self.started = datetime.now().isoformat(timespec='seconds')
+        self.time_start = time.perf_counter()
+        self.cpu_start = time.process_time()
+        self.profile = profile
+        self.profiler = None
+        if profile == "cprofile":
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        elif profile == "sample":
+            self.profiler = SamplingProfiler()
+            self.profiler.start()
+
+    @contextmanager
+    def stage(self, name):
+        # Stages can be entered many times (e.g. once per chunk): times and calls add up
+        time_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - time_start, time.process_time() - cpu_start)
+
+    def add_time(self, name, wall, cpu=0.):
+        stage = self.stages.setdefault(name, {'wall_s': 0., 'cpu_s': 0., 'calls': 0})
+        stage['wall_s'] += wall
+        stage['cpu_s'] += cpu
+        stage['calls'] += 1
+        stage['peak_rss_MB'] = peak_rss_MB()
+
+    def count(self, name, n=1):
+        self.counters[name] += int(n)
+
+    def summary(self):
+        wall = time.perf_counter() - self.time_start
+        report = {
+            'program': self.program,
+            'started': self.started,
+            'wall_s': wall,
+            'cpu_s': time.process_time() - self.cpu_start,
+            'peak_rss_MB': peak_rss_MB(),
+            'parameters': self.parameters,
+            'stages': self.stages,
+            'counters': dict(self.counters)
+        }
+        # Throughput in raw EventTree entries when the program reads them, in reconstructed events otherwise
+        events = self.counters.get('entries', self.counters.get('events'))
+        if events is not None and wall > 0:
+            report['events_per_s'] = events / wall
+        return report
+
+    def stop_profiler(self, output_file):
+        if self.profiler is None:
+            return None
+        if self.profile == "cprofile":
+            self.profiler.disable()
+            profile_file = os.path.splitext(output_file)[0] + ".prof"
+            self.profiler.dump_stats(profile_file)
+            text = io.StringIO()
+            pstats.Stats(self.profiler, stream=text).sort_stats('cumulative').print_stats(25)
+            summary = {'mode': 'cprofile', 'file': profile_file, 'top_cumulative': text.getvalue()}
+        else:
+            self.profiler.stop()
+            summary = self.profiler.summary()
+        self.profiler = None
+        return summary
+
+    def write(self, output_file):
+        # JSON report next to output_file (output_report.json); returns its name
+        report = self.summary()
+        profile = self.stop_profiler(output_file)
+        if profile is not None:
+            report['profile'] = profile
+        file_name = report_name(output_file)
+        with open(file_name, 'w') as f:
+            json.dump(report, f, indent=2, default=str)
+        print(f"Run report created: {file_name}")
+        return file_name
@@ -0,0 +1,98 @@
+import os
+import json
+import fcntl
+import hashlib
+from contextlib import contextmanager
+from datetime import datetime
+
+# Processing manifest: a JSON file with one record per output file, with the input it was made from
+# (path, size, mtime, SHA-256), the program and parameters, the status ("running" or "done") and, while
+# running, the entries already finished. Several processes can share a manifest: every update re-reads
+# the file under a lock and only replaces its own record.
+#
+# {"runs": {"/data/rec-RUN_20240701_120000.root": {"input": "/data/RUN_20240701_120000.root", "size": 42888426,
+#   "mtime": 1719835200.0, "hash": "sha256:...", "program": "HORUS", "parameters": {...}, "status": "done",
+#   "entry_stop": 3999, "updated": "2024-07-02T03:00:00"}}}
+
+def file_hash(file_path, block_size=1 << 24):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return "sha256:" + digest.hexdigest()
+
+def comparable(parameters):
+    # Parameters as they are stored in the JSON file, so that a record can be compared with the current call
+    return json.loads(json.dumps(parameters, default=str))
+
+class Manifest:
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.runs = self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as f:
+            return json.load(f).get('runs', {})
+
+    @contextmanager
+    def locked(self):
+        with open(self.path + ".lock", 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def update(self, output_file, **fields):
+        key = os.path.abspath(output_file)
+        with self.locked():
+            self.runs = self.load()
+            record = self.runs.setdefault(key, {})
+            record.update(fields)
+            record['updated'] = datetime.now().isoformat(timespec='seconds')
+            work_path = self.path + ".tmp"
+            with open(work_path, 'w') as f:
+                json.dump({'runs': self.runs}, f, indent=2)
+            os.replace(work_path, self.path)
+        return record
+
+    def record(self, output_file):
+        return self.runs.get(os.path.abspath(output_file))
+
+    def same_input(self, record, input_file):
+        # Size and mtime first; the (slower) hash only when the mtime changed, e.g. for a copied file
+        if record.get('input') != os.path.abspath(input_file) or record.get('size') != os.path.getsize(input_file):
+            return False
+        if record.get('mtime') == os.path.getmtime(input_file):
+            return True
+        return record.get('hash') == file_hash(input_file)
+
+    def matches(self, input_file, output_file, program, parameters):
+        record = self.record(output_file)
+        if record is None or record.get('program') != program or record.get('parameters') != comparable(parameters) or not self.same_input(record, input_file):
+            return False
+        if record.get('mtime') != os.path.getmtime(input_file):
+            self.update(output_file, mtime=os.path.getmtime(input_file))  # same content, only touched: no need to hash it again
+        return True
+
+    def is_done(self, input_file, output_file, program, parameters):
+        # True if output_file exists and was completed from this very input with the same parameters
+        return self.matches(input_file, output_file, program, parameters) and self.record(output_file)['status'] == "done" and os.path.exists(output_file)
+
+    def resume_point(self, input_file, output_file, program, parameters):
+        # First entry still to be processed by an interrupted run, 0 if it has to start from scratch
+        if not self.matches(input_file, output_file, program, parameters) or self.record(output_file)['status'] != "running":
+            return 0
+        return self.record(output_file).get('entry_stop', 0)
+
+    def start(self, input_file, output_file, program, parameters):
+        return self.update(output_file, input=os.path.abspath(input_file), size=os.path.getsize(input_file), mtime=os.path.getmtime(input_file),
+                           hash=file_hash(input_file), program=program, parameters=comparable(parameters), status="running", entry_stop=0)
+
+    def chunk_done(self, output_file, entry_stop):
+        return self.update(output_file, entry_stop=int(entry_stop))
+
+    def finish(self, output_file, **fields):
+        return self.update(output_file, status="done", **fields)
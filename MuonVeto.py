@@ -0,0 +1,41 @@
+import numpy as np
+
+# Muon veto: events closer than `window` (in s) to an OD-tagged event are removed.
+# Both the event mask and the vetoed live time are computed with sorted sweeps, O(N log N).
+
+def muon_times(trgTime, OD_fired, threshold_OD_fired):
+    times = np.asarray(trgTime, dtype=float)[np.asarray(OD_fired) >= threshold_OD_fired]
+    return np.sort(times[~np.isnan(times)])
+
+def store_muon_times(store, threshold_OD_fired, t_min=None, t_max=None):
+    # Same as muon_times for the events of an EventStore (reconstructed without the muon veto, -m false):
+    # only the blocks with an OD_fired above threshold are read
+    events = store.select(['trgTime', 'OD_fired'], OD_fired=(threshold_OD_fired, None), trgTime=(t_min, t_max))
+    return muon_times(events['trgTime'].to_numpy(), events['OD_fired'].to_numpy(), threshold_OD_fired)
+
+def veto_mask(trgTime, muons, window):
+    # True for events within the window of the nearest muon on either side (same |dt| < window test as before)
+    times = np.asarray(trgTime, dtype=float)
+    vetoed = np.zeros(len(times), dtype=bool)
+    if len(muons) == 0:
+        return vetoed
+    right = np.searchsorted(muons, times, side='left')
+    left = right - 1
+    with np.errstate(invalid='ignore'):
+        vetoed |= (left >= 0) & (np.abs(times - muons[np.clip(left, 0, None)]) < window)
+        vetoed |= (right < len(muons)) & (np.abs(times - muons[np.clip(right, None, len(muons) - 1)]) < window)
+    return vetoed
+
+def veto_intervals(muons, window):
+    # Union of the (t - window, t + window) windows around sorted muon times
+    if len(muons) == 0:
+        return np.array([]), np.array([])
+    starts = muons - window
+    stops = muons + window
+    new_interval = np.r_[True, starts[1:] >= np.maximum.accumulate(stops)[:-1]]
+    return starts[new_interval], np.maximum.reduceat(stops, np.flatnonzero(new_interval))
+
+def vetoed_live_time(muons, window, t_start, t_stop):
+    # Computed relative to t_start: absolute trigger times are ~1e9 s and would round the windows
+    starts, stops = veto_intervals(muons - t_start, window)
+    return np.sum(np.clip(np.minimum(stops, t_stop - t_start) - np.maximum(starts, 0.), 0, None))
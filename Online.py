@@ -0,0 +1,353 @@
+# OSIRIS ONLINE MONITOR: follows a directory where eb2root writes its raw ROOT files and, while the runs are being written,
+# publishes event and muon rates, spectra and Bi-Po coincidence counts to a JSON file or a UDP socket
+# Authors: Davide Basilico davide.basilico@mi.infn.it, Marco Beretta marco.beretta@mi.infn.it
+
+import os
+import glob
+import json
+import time
+import zlib
+import socket
+import argparse
+from contextlib import closing
+from argparse import RawTextHelpFormatter
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import uproot
+from WaveformAnalyzer import open_events, analyze_chunk
+from EventReconstruction import RecWriter, StreamingReconstruction
+from Coincidence import find_coincidences, Po_tau, hmTau, EB_min, EB_max, EP_min, EP_max, r_cut
+from Histograms import HistogramSet
+from Instrumentation import RunReport
+from EventReader import entry_step
+from Farm import run_key
+
+# Only the EventTree entries not seen yet are analysed, one chunk at a time, into the same StreamingReconstruction
+# as HORUS.py: the muon veto windows, the previous event (trgTime_diff) and the next one (Energy_Delayed) carry over
+# from one poll to the next and from one run to the next. The events it emits go into the spectra and the rates, and
+# into a rolling Bi-Po search where the events of the last coincidence window stay open as prompts.
+# Runs are followed in the order of their run strings: when a newer run starts, the older ones are considered closed.
+
+def parse_arguments():
+    prs = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter)
+    prs.add_argument("Dir", help="Directory where eb2root writes the raw ROOT files (EventTree)")
+    prs.add_argument("-p", "--publish", nargs="+", default=["online_status.json"], help="Where the updates go: JSON files (replaced at every update) and/or udp://host:port\n(one JSON datagram per update); default: online_status.json")
+    prs.add_argument("-o", "--OutputFile", default="null", help="Also append the reconstructed events to this RecEvents ROOT file; default: none")
+    prs.add_argument("--histograms", default="null", help="ROOT file with the monitoring histograms (see Histograms.py), rewritten at every update; default: none")
+    prs.add_argument("--interval", type=float, default=10., help="Seconds between two updates; default: 10")
+    prs.add_argument("--poll", type=float, default=1., help="Seconds between two looks at the directory; default: 1")
+    prs.add_argument("--stop_after", type=float, default=0., help="Stop after this many seconds without new entries; default: 0 (run until interrupted)")
+    prs.add_argument("--skip_existing", default="false", help="Start from the current end of the files already in the directory; default: false")
+    prs.add_argument("-m", "--muon", default="true", help="Apply muon veto; default: true")
+    prs.add_argument("-Muon_Veto_Threshold", "--Threshold_OD_Fired", type=int, default=5, help="Muon veto threshold for OD multiplicity; default: 5")
+    prs.add_argument("-Muon_Veto_Window", "--Muon_Veto_Window", type=float, default=20E-6, help="Half-width of the muon veto time window in s; default: 20e-6")
+    prs.add_argument("--Po_tau", type=float, default=Po_tau, help="Po mean life in s; default: 237e-6")
+    prs.add_argument("--hmTau", type=float, default=hmTau, help="Coincidence window in units of Po_tau; default: 5")
+    prs.add_argument("--cleaning", default="false", help="Low-pass FFT cleaning of the waveforms; default: false")
+    prs.add_argument("--cutoff", type=float, default=0.10, help="Cleaning cutoff frequency in units of the sampling frequency; default: 0.10")
+    prs.add_argument("--compact", default="false", help="Memory-efficient mode (see WaveformAnalyzer.py); default: false")
+    prs.add_argument("-s", "--step_size", default="50 MB", help="Size of the chunks read from EventTree, in bytes (e.g. '50 MB') or entries; default: 50 MB")
+    return prs.parse_args()
+
+# What uproot raises on a file caught in between two writes of eb2root (a key, basket or header not written yet, or cut short);
+# everything else is a bug of the analysis and is raised
+read_errors = (OSError, EOFError, ValueError, zlib.error, uproot.KeyInFileError, uproot.deserialization.DeserializationError)
+
+def file_stamp(file_path):
+    return [os.path.getsize(file_path), os.path.getmtime(file_path)]
+
+def run_files(directory):
+    # Raw ROOT files of the directory in run order, without the outputs of HORUS (rec-*.root)
+    files = [f for f in glob.glob(os.path.join(directory, "*.root")) if not os.path.basename(f).startswith("rec-")]
+    return sorted((os.path.abspath(f) for f in files), key=run_key)
+
+class Publisher:
+    # A JSON file, replaced atomically so that readers never see half of it, or udp://host:port
+    def __init__(self, target):
+        self.target = target
+        self.socket = None
+        if target.startswith("udp://"):
+            host, port = target[len("udp://"):].rsplit(":", 1)
+            self.address = (host, int(port))
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def send(self, status):
+        text = json.dumps(status)
+        if self.socket is not None:
+            try:
+                self.socket.sendto(text.encode(), self.address)
+            except OSError as error:
+                print(f"Update not sent to {self.target}: {error}")
+            return
+        work_path = self.target + ".tmp"
+        with open(work_path, 'w') as f:
+            f.write(text)
+        os.replace(work_path, self.target)
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close()
+
+class RollingCoincidences:
+    # Bi-Po search on events arriving in time order: the events of the last window are kept as open prompts,
+    # so that the pairs are the same as those of Coincidence.find_coincidences on the whole run
+    def __init__(self, window=Po_tau * hmTau, EB_min=EB_min, EB_max=EB_max, EP_min=EP_min, EP_max=EP_max, r_cut=r_cut):
+        self.window = window
+        self.cuts = (EB_min, EB_max, EP_min, EP_max, r_cut)
+        self.recent = None
+        self.pairs = 0
+
+    def add(self, events):
+        # Returns the pairs whose delayed event is among the new events
+        events = events[['trgTime', 'Energy_Prompt', 'x_CM', 'y_CM', 'z_CM']]
+        events = events[~np.isnan(events['trgTime'].to_numpy())]
+        if len(events) == 0:
+            return find_coincidences(events, self.window, 0., *self.cuts, energy='Energy_Prompt')
+        combined = events if self.recent is None else pd.concat([self.recent, events])
+        pairs = find_coincidences(combined, self.window, 0., *self.cuts, energy='Energy_Prompt')
+        pairs = pairs[pairs['delayed_index'].isin(events.index)]
+        trgTime = combined['trgTime'].to_numpy()
+        self.recent = combined[trgTime >= trgTime.max() - self.window]
+        self.pairs += len(pairs)
+        return pairs
+
+    def open_prompts(self):
+        if self.recent is None:
+            return 0
+        E = self.recent['Energy_Prompt'].to_numpy()
+        return int(np.count_nonzero((self.cuts[0] < E) & (E < self.cuts[1])))
+
+class OnlineMonitor:
+    # Writer of the StreamingReconstruction: the events it emits are counted, searched for coincidences
+    # and, with a RecWriter, appended to RecEvents
+    def __init__(self, coincidences, rec_writer=None):
+        self.coincidences = coincidences
+        self.rec_writer = rec_writer
+        self.events = 0
+        self.t_first = np.nan
+        self.t_last = np.nan
+        self.recent_pairs = []
+
+    def write(self, results):
+        if self.rec_writer is not None:
+            self.rec_writer.write(results)
+        self.events += len(results)
+        trgTime = results.events['trgTime'].to_numpy()
+        if len(trgTime) > 0 and not np.all(np.isnan(trgTime)):
+            self.t_first = np.nanmin(trgTime) if np.isnan(self.t_first) else self.t_first
+            self.t_last = np.nanmax(trgTime)
+        pairs = self.coincidences.add(results.events)
+        self.recent_pairs.extend(pairs.to_dict('records'))
+
+class OnlineReconstruction:
+    def __init__(self, directory, publishers, muon=True, Threshold_OD_Fired=5, Muon_Veto_Window=20E-6, window=Po_tau * hmTau, cleaning="false", cleaning_cutoff=0.10,
+                 compact="false", step_size="50 MB", output_file="null", histogram_file="null", report=None):
+        self.directory = directory
+        self.publishers = publishers
+        self.cleaning = cleaning
+        self.cleaning_cutoff = cleaning_cutoff
+        self.compact = compact
+        self.step_size = entry_step(step_size)
+        self.histogram_file = histogram_file
+        self.report = report if report is not None else RunReport("OnlineReconstruction")
+        self.histograms = HistogramSet()
+        self.rec_writer = RecWriter(output_file) if output_file != "null" else None
+        self.monitor = OnlineMonitor(RollingCoincidences(window), self.rec_writer)
+        self.stream = StreamingReconstruction(self.monitor, muon, Threshold_OD_Fired, Muon_Veto_Window, self.report, self.histograms)
+        self.runs = {}  # file -> entries analysed, index of its first entry, size and mtime when it was last read
+        self.next_index = 0
+        self.write_times = []  # mtimes of the data analysed since the last update
+        self.latencies = []
+        self.updates = 0
+        self.last_update = {'events': 0, 'muons': 0, 'coincidences': 0, 't_last': np.nan}
+
+    def skip_existing(self):
+        # The files already in the directory are taken as analysed up to their current end
+        for file_path in run_files(self.directory):
+            try:
+                num_entries, _, _ = open_events(file_path, "false")
+            except read_errors:
+                continue
+            entries = max(num_entries - 1, 0)
+            self.runs[file_path] = {'entries': entries, 'index_base': self.next_index, 'stamp': file_stamp(file_path)}
+            self.next_index += entries
+            print(f"Skipped: {os.path.basename(file_path)} ({entries} entries)")
+
+    def poll(self):
+        # Analyses the new entries of the runs; returns the number of entries analysed
+        files = run_files(self.directory)
+        newest = max((k for k, file_path in enumerate(files) if file_path in self.runs), default=-1)
+        n_entries = 0
+        for k, file_path in enumerate(files):
+            if k < newest:
+                continue  # closed: a newer run has started
+            n_entries += self.follow(file_path)
+        return n_entries
+
+    def follow(self, file_path):
+        run = self.runs.get(file_path)
+        try:
+            stamp = file_stamp(file_path)
+        except OSError:
+            return 0
+        if run is not None and run['stamp'] == stamp:
+            return 0
+        try:
+            num_entries, chunks, _ = open_events(file_path, "false")
+        except read_errors:
+            return 0  # not readable yet (e.g. the file was just created): tried again at the next poll
+        if run is None:
+            run = self.runs[file_path] = {'entries': 0, 'index_base': self.next_index, 'stamp': None}
+            print(f"Following: {os.path.basename(file_path)}")
+        entry_stop = num_entries - 1  # as in WaveformAnalyzer.analyze_chunks, the last entry of EventTree is left out
+        n_entries = 0
+        # Only the reads are retried: a chunk goes into the reconstruction once it has been read whole
+        with closing(chunks(run['entries'], entry_stop, self.step_size)) as run_chunks:
+            while True:
+                try:
+                    chunk = next(run_chunks, None)
+                except read_errors as error:
+                    print(f"Read of {os.path.basename(file_path)} stopped at entry {run['entries']}, resumed at the next poll: {error}")
+                    self.count_entries(stamp, n_entries)
+                    return n_entries
+                if chunk is None:
+                    break
+                with self.report.stage("waveform_analysis"):
+                    hits = pd.DataFrame(analyze_chunk(chunk, self.cleaning, self.cleaning_cutoff, compact=self.compact))
+                hits['index'] = hits['index'] + run['index_base']
+                with self.report.stage("histograms"):
+                    self.histograms.fill_hits(hits)
+                self.stream.add_hits(hits, last_chunk=False)
+                run['entries'] = chunk['entry_start'] + chunk['n_events']
+                self.next_index = max(self.next_index, run['index_base'] + run['entries'])
+                n_entries += chunk['n_events']
+        run['stamp'] = stamp
+        self.count_entries(stamp, n_entries)
+        return n_entries
+
+    def count_entries(self, stamp, n_entries):
+        if n_entries > 0:
+            self.write_times.append(stamp[1])
+            self.report.count("entries", n_entries)
+
+    def status(self, final):
+        monitor = self.monitor
+        muons = self.report.counters.get('muons', 0)
+        last = self.last_update
+        interval = monitor.t_last - last['t_last'] if not np.isnan(last['t_last']) else monitor.t_last - monitor.t_first
+        live_time = monitor.t_last - monitor.t_first
+        rate = lambda n, t: n / t if t > 0 else None
+        spectra = {}
+        for name, histogram in self.histograms.histograms.items():
+            if len(histogram.axes) == 1:
+                bins, low, high, title = histogram.axes[0]
+                spectra[name] = {'title': title, 'bins': bins, 'low': low, 'high': high, 'underflow': int(histogram.counts[0]),
+                                 'overflow': int(histogram.counts[-1]), 'counts': histogram.counts[1:-1].tolist()}
+        finite = lambda value: None if np.isnan(value) else float(value)
+        return {
+            'updated': datetime.now().isoformat(timespec='milliseconds'),
+            'update': self.updates,
+            'final': final,
+            'runs': [{'file': os.path.basename(file_path), 'entries': run['entries']} for file_path, run in self.runs.items()],
+            'entries': self.report.counters.get('entries', 0),
+            'hits': self.report.counters.get('hits', 0),
+            'events': monitor.events,
+            'muons': muons,
+            'vetoed_events': self.report.counters.get('vetoed_events', 0),
+            'coincidences': monitor.coincidences.pairs,
+            'open_prompts': monitor.coincidences.open_prompts(),
+            'trgTime_first': finite(monitor.t_first),
+            'trgTime_last': finite(monitor.t_last),
+            'live_time_s': finite(live_time),
+            'vetoed_live_time_s': self.stream.vetoed_time,
+            'rates': {
+                'interval_s': finite(interval),
+                'events_per_s': rate(monitor.events - last['events'], interval),
+                'muons_per_s': rate(muons - last['muons'], interval),
+                'coincidences_per_s': rate(monitor.coincidences.pairs - last['coincidences'], interval),
+                'run_events_per_s': rate(monitor.events, live_time),
+                'run_muons_per_s': rate(muons, live_time),
+                'run_coincidences_per_s': rate(monitor.coincidences.pairs, live_time)
+            },
+            'new_coincidences': monitor.recent_pairs[-100:],
+            'spectra': spectra
+        }
+
+    def publish(self, final=False):
+        # Latency of an update: from the last write of each file read since the previous update to the moment it is sent
+        with self.report.stage("publish"):
+            status = self.status(final)
+            if self.histogram_file != "null":
+                self.histograms.write(self.histogram_file)
+            now = time.time()
+            latencies = [now - written for written in self.write_times]
+            status['latency_s'] = {'files_read': len(latencies), 'max': max(latencies, default=None), 'mean': float(np.mean(latencies)) if len(latencies) > 0 else None}
+            for publisher in self.publishers:
+                publisher.send(status)
+        self.latencies.extend(latencies)
+        self.write_times = []
+        self.updates += 1
+        self.monitor.recent_pairs = []
+        self.last_update = {'events': self.monitor.events, 'muons': status['muons'], 'coincidences': self.monitor.coincidences.pairs, 't_last': self.monitor.t_last}
+        rates = status['rates']
+        print(f"[{status['updated']}] entries {status['entries']}, events {status['events']} ({rates['events_per_s'] or 0.:.1f}/s), "
+              f"muons {status['muons']} ({rates['muons_per_s'] or 0.:.2f}/s), coincidences {status['coincidences']}, open prompts {status['open_prompts']}"
+              + (f", latency {status['latency_s']['max']:.2f} s" if status['latency_s']['max'] is not None else ""))
+        return status
+
+    def close(self):
+        # The events still pending (veto window, Energy_Delayed of the last one) are emitted and published
+        self.stream.close()
+        status = self.publish(final=True)
+        if self.rec_writer is not None:
+            self.rec_writer.close()
+        for publisher in self.publishers:
+            publisher.close()
+        if len(self.latencies) > 0:
+            print(f"Latency from file write to published update: mean {np.mean(self.latencies):.2f} s, max {np.max(self.latencies):.2f} s")
+        return status
+
+def follow_directory(online, poll=1., interval=10., stop_after=0.):
+    # Polls the directory until interrupted (Ctrl-C) or stop_after seconds without new entries, with an update every interval seconds
+    last_data = time.time()
+    last_update = time.time()
+    changed = False
+    try:
+        while True:
+            if online.poll() > 0:
+                last_data = time.time()
+                changed = True
+            if changed and time.time() - last_update >= interval:
+                online.publish()
+                last_update = time.time()
+                changed = False
+            if stop_after > 0 and time.time() - last_data > stop_after:
+                print(f"No new entries for {stop_after:g} s: stopping")
+                break
+            time.sleep(poll)
+    except KeyboardInterrupt:
+        print("Interrupted: stopping")
+    return online.close()
+
+def main():
+    args = parse_arguments()
+    print("### Welcome to the HORUS online monitor ###")
+    report = RunReport("Online", vars(args))
+    publishers = [Publisher(target) for target in args.publish]
+    online = OnlineReconstruction(args.Dir, publishers, args.muon == "true", args.Threshold_OD_Fired, args.Muon_Veto_Window, args.Po_tau * args.hmTau,
+                                  args.cleaning, args.cutoff, args.compact, args.step_size, args.OutputFile, args.histograms, report)
+    if args.skip_existing == "true":
+        online.skip_existing()
+    print(f"Watching: {os.path.abspath(args.Dir)}; updates every {args.interval:g} s to {', '.join(args.publish)}")
+    follow_directory(online, args.poll, args.interval, args.stop_after)
+    if args.OutputFile != "null":
+        print(f"Output ROOT file created: {args.OutputFile}")
+    files = [target for target in args.publish if not target.startswith("udp://")]
+    report.write(args.OutputFile if args.OutputFile != "null" else files[0] if len(files) > 0 else os.path.join(args.Dir, "online.json"))
+
+if __name__ == "__main__":
+    time_start = time.time()
+    main()
+    time_end = time.time()
+    print(f"Completed in: {time_end-time_start:.2f} s")
@@ -0,0 +1,63 @@
+# Benchmark of the FFT cleaning: per-waveform Waveform.clean_data against the batched WaveformBatch.clean_waveform_block
+# Authors: Davide Basilico davide.basilico@mi.infn.it, Marco Beretta marco.beretta@mi.infn.it
+
+import sys
+import os
+import time
+import argparse
+from argparse import RawTextHelpFormatter
+import numpy as np
+import awkward as ak
+import uproot
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from Waveform import Waveform
+from WaveformBatch import clean_waveform_block, analyze_waveform_block
+from utils import generate_synthetic_waveform
+
+def parse_arguments():
+    prs = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter)
+    prs.add_argument("-i", "--InputFile", default="null", help="EventTree ROOT file to take the waveforms from; default: synthetic waveforms")
+    prs.add_argument("-n", "--Waveforms", type=int, default=5000, help="Number of waveforms; default: 5000")
+    prs.add_argument("--cutoff", type=float, default=0.10, help="Cleaning cutoff for the batched version; default: 0.10 (the one of Waveform.clean_data)")
+    return prs.parse_args()
+
+def load_waveforms(input_file, n_waveforms):
+    if input_file == "null":
+        params = [{'flat_height': 11000, 'gaussian_amplitude': -200 * (i % 2), 'gaussian_center': 250, 'gaussian_width': 10} for i in range(n_waveforms)]
+        return np.array([generate_synthetic_waveform(p) for p in params])
+    samples = []
+    for events in uproot.iterate(input_file + ":EventTree", ["IDdata.samples"], step_size=1000):
+        samples.append(ak.to_numpy(ak.flatten(events["IDdata.samples"], axis=1)))
+        if sum(len(s) for s in samples) >= n_waveforms:
+            break
+    return np.concatenate(samples)[:n_waveforms]
+
+def main():
+    args = parse_arguments()
+    samples = load_waveforms(args.InputFile, args.Waveforms)
+    print("Waveforms: ", samples.shape[0], " x ", samples.shape[1], " samples")
+
+    time_start = time.perf_counter()
+    reference = np.array([Waveform(wf, 'std_dev', 50, 'true').clean_data(wf) for wf in samples])
+    time_reference = time.perf_counter() - time_start
+
+    clean_waveform_block(samples[:1], args.cutoff)  # the mask is built once per waveform length
+    time_start = time.perf_counter()
+    cleaned = clean_waveform_block(samples, args.cutoff)
+    time_batch = time.perf_counter() - time_start
+
+    print(f"Waveform.clean_data:   {time_reference:.3f} s ({samples.shape[0] / time_reference:.0f} waveforms/s)")
+    print(f"clean_waveform_block:  {time_batch:.3f} s ({samples.shape[0] / time_batch:.0f} waveforms/s), x{time_reference / time_batch:.1f}")
+
+    if args.cutoff == 0.10:
+        # Agreement of the cleaned waveforms and of what the analysis extracts from them
+        print(f"Max abs difference: {np.max(np.abs(cleaned - reference)):.3e} ADC (max relative {np.max(np.abs(cleaned - reference) / np.abs(reference)):.3e})")
+        result = analyze_waveform_block(samples, cleaning='true')
+        per_waveform = [Waveform(wf, 'std_dev', 50, 'true').analyze_waveform() for wf in samples]
+        rise_time = np.array([-1 if r is None else r for _, _, r in per_waveform])
+        charge = np.array([q for _, q, _ in per_waveform])
+        print("Same rise times: ", np.array_equal(result['rise_time'], rise_time))
+        print(f"Max relative charge difference: {np.max(np.abs(result['charge'] - charge) / np.maximum(np.abs(charge), 1.)):.3e}")
+
+if __name__ == "__main__":
+    main()
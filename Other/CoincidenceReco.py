@@ -8,15 +8,25 @@ import sys
 import glob
 import uproot
 import os
+import re
 from tqdm import tqdm
 from tqdm.auto import tqdm
 tqdm.pandas()
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from HitTable import read_hits
+from Coincidence import find_coincidences
 
 base_file = sys.argv[1]
-if(base_file[-9] =="_"):
-    base_number = int(base_file[-5])
-    base_filename = base_file[:-5] 
-    file_list = [f"{base_filename}{i}.txt" for i in range(0, base_number + 1)]
+# <run>_<N>.txt (e.g. RUN_20240701_120000_12.txt) stands for the parts 0 to N of the run, in numeric order;
+# for whole runs or many files use Farm.py, which merges the runs with a global event index
+parts = re.fullmatch(r'(.*\d{8}_\d{6}_)(\d+)\.txt', base_file)
+multi_part = parts is not None
+if multi_part:
+    base_filename = parts.group(1)
+    file_list = [f"{base_filename}{i}.txt" for i in range(0, int(parts.group(2)) + 1)]
+    missing = [file for file in file_list if not os.path.exists(file)]
+    if len(missing) > 0:
+        sys.exit(f"Missing parts of the run: {', '.join(missing)}")
     all_results = pd.DataFrame()
 
 else:
@@ -26,7 +36,7 @@ else:
 
 for file in file_list:
     print("open file: " + file)
-    data_unclean = pd.read_csv(file, delimiter='\t')
+    data_unclean = read_hits(file)
     data = data_unclean.replace([np.inf, -np.inf], np.nan).dropna(subset=['charge'])
 
     # Group by index and calculation of the metrics
@@ -74,18 +84,13 @@ for file in file_list:
         'WF_RiseTime_diff': data.groupby('index')['WF_RiseTime_diff'].apply(list)
     })
 
-    if(base_file[-9] =="_"):
+    if multi_part:
         all_results = pd.concat([all_results, results], ignore_index=True)
     else:
         all_results = results
 
 ### Coincidence anlysis
 
-results['trgTime_diff'] = results['trgTime'].diff()
-
-bismuto = []
-polonio = []
-
 Po_tau = 237E-6 # mean life time
 hmTau = 5 #how many Tau
 EB_min = 0.0 #Bismuth cuts
@@ -93,35 +98,15 @@ EB_max =3.5
 EP_min = 0.6 #Polonium cuts
 EP_max = 1.3
 r_cut = 5000  #no cut for now
-#accidental_offset = np.random.uniform(low=0.01, high=1.0, size=1000) #10e-3 modify this value to evalute the accidental backgrounds
+#accidental_offset = np.random.uniform(low=0.01, high=1.0, size=1000) #10e-3 modify this value to evalute the accidental backgrounds (see Coincidence.accidental_counts)
 offset = 0
 
-results_filtered = all_results[all_results['Energy'] < EB_max]
-coincidenze = []
-num_coi = []
-
-#for offset in tqdm(accidental_offset, desc="Progress"):
-
-for j in range(len(all_results)): #tqdm( , desc="Processando eventi principali")
-    for i in range(j + 1, len(results_filtered)):
-        trg_diff = (results_filtered['trgTime'].iloc[i])- results_filtered['trgTime'].iloc[j]
-        if trg_diff >= Po_tau * hmTau + offset or trg_diff < offset:
-            break        
-        pos_diff = np.sqrt(
-            (results_filtered['x_CM'].iloc[i] - results_filtered['x_CM'].iloc[j])**2 +
-            (results_filtered['y_CM'].iloc[i] - results_filtered['x_CM'].iloc[j])**2 +
-            (results_filtered['z_CM'].iloc[i] - results_filtered['z_CM'].iloc[j])**2
-        )
-        
-        if pos_diff < r_cut:
-            if EB_min < results_filtered['Energy'].iloc[j] < EB_max:
-                if EP_min <= results_filtered['Energy'].iloc[i] <= EP_max:
-                    coincidenze.append((results_filtered['Energy'].iloc[j], results_filtered['Energy'].iloc[i]))
+coincidenze = find_coincidences(all_results, Po_tau * hmTau, offset, EB_min, EB_max, EP_min, EP_max, r_cut)
 
 ### Plotting part
 
-bismuto = [b for b, p in coincidenze]  
-polonio = [p for b, p in coincidenze]  
+bismuto = coincidenze['prompt_energy'].to_numpy()
+polonio = coincidenze['delayed_energy'].to_numpy()
 
 num_coincidenze = len(coincidenze)
 #num_coi.append(len(coincidenze))
@@ -131,7 +116,7 @@ plt.figure(figsize=(10, 6))
 plt.hist(bismuto, bins=100, alpha=0.5, label='Bismuth', color='blue')
 plt.hist(polonio, bins=20, alpha=0.5, label='Polonium', color='red')
 
-if(base_file[-9] =="_"):
+if multi_part:
     plt.text(0.4, 0.9, f'Run: {base_filename}*.txt\nCoincidenze: {num_coincidenze}', transform=plt.gca().transAxes, fontsize=12, bbox=dict(facecolor='white', alpha=0.7, edgecolor='black'))
 else:
     plt.text(0.4, 0.9, f'Run: {base_file}\nCoincidenze: {num_coincidenze}', transform=plt.gca().transAxes, fontsize=12, bbox=dict(facecolor='white', alpha=0.7, edgecolor='black'))
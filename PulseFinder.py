@@ -0,0 +1,158 @@
+import numpy as np
+from numba import njit
+from WaveformBatch import baseline_statistics, clean_waveform_block, check_threshold_block, find_rise_time_block
+
+# Multi-pulse search: every pulse of every waveform of a block (channels x samples) in one compiled pass.
+# The first pulse is the pulse of Waveform: it starts at the rise time of analyze_waveform_block (first sample further
+# from the baseline than 1/rise_fraction of the largest distance) and only waveforms over the threshold of
+# analyze_waveform_block have one. The next pulses are the regions after it where the waveform stays more than
+# `threshold` below the baseline for at least min_width samples (shorter ones are noise); regions closer than min_gap
+# samples are merged. For each pulse:
+#   start      rise time: for the first pulse that of analyze_waveform_block, for the next ones the first sample of the
+#              stretch before the peak (after the end of the previous pulse) further from the baseline than amplitude / rise_fraction
+#   peak       sample of the largest distance from the baseline
+#   amplitude  baseline - samples[peak]
+#   charge     sum of samples - baseline over integration_window samples from start, stopped at the next pulse
+#   width      samples around the peak above half the amplitude (FWHM)
+# The pulses of waveform i are offsets[i]:offsets[i+1] of the flat output arrays.
+
+@njit(cache=True)
+def next_region(row, baseline, threshold, k, min_gap, min_width):
+	# First region over threshold from sample k with at least min_width samples over it: (first sample, end); -1 if none
+	n_samples = len(row)
+	while k < n_samples:
+		while k < n_samples and baseline - row[k] <= threshold:
+			k += 1
+		if k == n_samples:
+			break
+		first = k
+		stop = k + 1
+		n_over = 1
+		below = 0
+		j = k + 1
+		while j < n_samples and below < min_gap:
+			if baseline - row[j] > threshold:
+				stop = j + 1
+				n_over += 1
+				below = 0
+			else:
+				below += 1
+			j += 1
+		if n_over >= min_width:
+			return first, stop
+		k = stop
+	return -1, n_samples
+
+@njit(cache=True)
+def first_region_stop(row, baseline, threshold, first_start, min_gap):
+	# End of the first pulse: of the first region over threshold from its start, or the sample after the start
+	first, stop = next_region(row, baseline, threshold, first_start, min_gap, 1)
+	return stop if first >= 0 else first_start + 1
+
+@njit(cache=True)
+def count_pulses(samples, baseline, threshold, first_start, min_gap, min_width):
+	n_waveforms, n_samples = samples.shape
+	counts = np.zeros(n_waveforms, dtype=np.int64)
+	for i in range(n_waveforms):
+		if first_start[i] < 0:
+			continue
+		counts[i] = 1
+		k = first_region_stop(samples[i], baseline[i], threshold[i], first_start[i], min_gap)
+		while True:
+			first, k = next_region(samples[i], baseline[i], threshold[i], k, min_gap, min_width)
+			if first < 0:
+				break
+			counts[i] += 1
+	return counts
+
+@njit(cache=True)
+def fill_pulses(samples, baseline, threshold, first_start, min_gap, min_width, rise_fraction, integration_window, offsets, start, peak, amplitude, charge, width):
+	n_waveforms, n_samples = samples.shape
+	for i in range(n_waveforms):
+		if first_start[i] < 0:
+			continue
+		row = samples[i]
+		region_start = first_start[i]
+		region_stop = first_region_stop(row, baseline[i], threshold[i], first_start[i], min_gap)
+		for p in range(offsets[i], offsets[i + 1]):
+			if p > offsets[i]:
+				search_from = region_stop
+				region_start, region_stop = next_region(row, baseline[i], threshold[i], region_stop, min_gap, min_width)
+			k_peak = region_start
+			for j in range(region_start, region_stop):
+				if row[j] < row[k_peak]:
+					k_peak = j
+			height = baseline[i] - row[k_peak]
+			if p == offsets[i]:
+				k_start = first_start[i]
+			else:
+				k_start = k_peak
+				while k_start > search_from and abs(baseline[i] - row[k_start - 1]) > height / rise_fraction:
+					k_start -= 1
+			lo = k_peak
+			while lo > 0 and baseline[i] - row[lo - 1] >= height / 2:
+				lo -= 1
+			hi = k_peak + 1
+			while hi < n_samples and baseline[i] - row[hi] >= height / 2:
+				hi += 1
+			start[p] = k_start
+			peak[p] = k_peak
+			amplitude[p] = height
+			width[p] = hi - lo
+
+		# Charges, now that the start of the next pulse is known
+		for q in range(offsets[i], offsets[i + 1]):
+			stop = min(start[q] + integration_window, n_samples)
+			if q + 1 < offsets[i + 1]:
+				stop = min(stop, start[q + 1])
+			total = 0.
+			for j in range(start[q], stop):
+				total += row[j] - baseline[i]
+			charge[q] = total
+
+def pulse_threshold(std_dev_baseline, method, threshold_absolute=20, threshold_std_dev=5):
+	# Distance from the baseline a pulse has to exceed, per waveform, as in check_threshold_block
+	if method == 'baseline':
+		return np.full(len(std_dev_baseline), float(threshold_absolute))
+	elif method == 'std_dev':
+		return threshold_std_dev * std_dev_baseline
+	else:
+		raise ValueError("Threshold finder method not valid. Please use 'baseline', 'std_dev', or 'deconvolution'.")
+
+def find_pulses_block(samples, baseline, threshold, first_start, rise_fraction=5, integration_window=100, min_gap=4, min_width=2):
+	# first_start: start of the first pulse of every waveform (rise time of analyze_waveform_block), -1 for none
+	samples = np.ascontiguousarray(samples)
+	baseline = np.ascontiguousarray(baseline, dtype=np.float64)
+	threshold = np.ascontiguousarray(threshold, dtype=np.float64)
+	first_start = np.ascontiguousarray(first_start, dtype=np.int64)
+	counts = count_pulses(samples, baseline, threshold, first_start, min_gap, min_width)
+	offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+	np.cumsum(counts, out=offsets[1:])
+	n_pulses = int(offsets[-1])
+	pulses = {
+		'offsets': offsets,
+		'start': np.zeros(n_pulses, dtype=np.int64),
+		'peak': np.zeros(n_pulses, dtype=np.int64),
+		'amplitude': np.zeros(n_pulses),
+		'charge': np.zeros(n_pulses),
+		'width': np.zeros(n_pulses, dtype=np.int64)
+	}
+	fill_pulses(samples, baseline, threshold, first_start, min_gap, min_width, float(rise_fraction), integration_window, offsets,
+		pulses['start'], pulses['peak'], pulses['amplitude'], pulses['charge'], pulses['width'])
+	return pulses
+
+def analyze_pulses_block(samples, threshold_method='std_dev', baseline_entries=50, cleaning='false',
+			threshold_absolute=20, threshold_std_dev=5, rise_fraction=5, integration_window=100, cleaning_cutoff=0.10, min_gap=4, min_width=2):
+	# Multi-pulse counterpart of analyze_waveform_block: baseline, threshold and first pulse as there (from the raw samples),
+	# pulses searched on the cleaned ones when cleaning is on
+	samples = np.asarray(samples)
+	baseline, std_dev_baseline, min_value = baseline_statistics(samples, baseline_entries)
+	threshold = pulse_threshold(std_dev_baseline, threshold_method, threshold_absolute, threshold_std_dev)
+	over_threshold = check_threshold_block(baseline, std_dev_baseline, min_value, threshold_method, threshold_absolute, threshold_std_dev)
+	if(cleaning == 'true'):
+		samples = clean_waveform_block(samples, cleaning_cutoff)
+	first_start = np.where(over_threshold, find_rise_time_block(samples, baseline, baseline - min_value, rise_fraction), -1)
+	pulses = find_pulses_block(samples, baseline, threshold, first_start, rise_fraction, integration_window, min_gap, min_width)
+	pulses['baseline'] = baseline
+	pulses['std_dev_baseline'] = std_dev_baseline
+	return pulses
@@ -0,0 +1,85 @@
+import numpy as np
+import pandas as pd
+import awkward as ak
+from numba import njit
+
+# Per-event reductions over a hit table sorted by event index, in a single pass over the hits.
+# Sums are Kahan-compensated and skip NaN exactly like pandas' groupby sum/mean,
+# so the results are identical to the groupby implementation.
+
+def segment_offsets(index):
+    # Stable sort by event index; returns the hit order, the event ids and the segment offsets
+    index = np.asarray(index)
+    if len(index) > 1 and np.any(index[1:] < index[:-1]):
+        order = np.argsort(index, kind='stable')
+    else:
+        order = None
+    sorted_index = index if order is None else index[order]
+    starts = np.flatnonzero(np.r_[True, sorted_index[1:] != sorted_index[:-1]]) if len(index) > 0 else np.array([], dtype=np.int64)
+    offsets = np.append(starts, len(index))
+    return order, sorted_index[starts], offsets
+
+@njit(cache=True)
+def segment_kahan_sums(values, offsets):
+    # values: (n_hits, n_columns); returns per-event sums and non-NaN counts for every column
+    n_events = len(offsets) - 1
+    n_columns = values.shape[1]
+    sums = np.zeros((n_events, n_columns))
+    counts = np.zeros((n_events, n_columns), dtype=np.int64)
+    for e in range(n_events):
+        for k in range(n_columns):
+            total = 0.
+            compensation = 0.
+            count = 0
+            for h in range(offsets[e], offsets[e + 1]):
+                value = values[h, k]
+                if value == value:
+                    count += 1
+                    y = value - compensation
+                    t = total + y
+                    compensation = t - total - y
+                    if compensation != compensation:
+                        compensation = 0.
+                    total = t
+            sums[e, k] = total
+            counts[e, k] = count
+    return sums, counts
+
+def segment_means(sums, counts):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(counts > 0, sums / counts, np.nan)
+
+class EventTable:
+    # Reconstructed events: `events`, one row per event (indexed by event index), and `hits`, the flat per-hit
+    # columns (TOF, WF_RiseTime, WF_RiseTime_diff, Pulse) of these events, the hits of the i-th row being
+    # hits[name][offsets[i]:offsets[i + 1]]. Selections and concatenations go through take and concat,
+    # which keep the hits aligned with the rows.
+    def __init__(self, events, hits, offsets):
+        self.events = events
+        self.hits = hits
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.events)
+
+    @property
+    def counts(self):
+        return np.diff(self.offsets)
+
+    def jagged(self, name):
+        # Per-hit column as an awkward array, one list per event
+        return ak.unflatten(self.hits[name], self.counts)
+
+    def take(self, rows):
+        # Events at the given positions (integers, boolean mask or slice), with a compact copy of their hits
+        rows = np.arange(len(self))[rows]
+        starts, counts = self.offsets[rows], self.counts[rows]
+        index = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(starts, counts)
+        return EventTable(self.events.iloc[rows], {name: values[index] for name, values in self.hits.items()}, np.append(0, np.cumsum(counts)))
+
+    @staticmethod
+    def concat(tables):
+        tables = [table for table in tables if table is not None]
+        counts = np.concatenate([table.counts for table in tables])
+        hits = {name: np.concatenate([table.hits[name] for table in tables]) for name in tables[0].hits}
+        return EventTable(pd.concat([table.events for table in tables]), hits, np.append(0, np.cumsum(counts)))
@@ -0,0 +1,197 @@
+# OSIRIS SYNTHETIC EVENTTREE GENERATOR
+# Seeded, vectorized generator of raw EventTree files (as from eb2root) for load tests and benchmarks
+# Authors: Davide Basilico davide.basilico@mi.infn.it, Marco Beretta marco.beretta@mi.infn.it
+
+import time
+import argparse
+from argparse import RawTextHelpFormatter
+from datetime import datetime, timezone
+import numpy as np
+import awkward as ak
+import uproot
+from tqdm import tqdm
+from CableMap import load_cable_map
+from utils import extract_date_and_formatted_date
+
+# Event kinds of the timeline, stored in the SyntheticTruth tree
+SINGLE, MUON, BURST, PROMPT, DELAYED = 0, 1, 2, 3, 4
+
+n_samples = 600
+baseline = 11000
+noise = 5  # ADC
+pulse_width = 8  # samples; the pulse area is pulse_width * sqrt(2 pi) * amplitude
+trigger_sample = 240
+calibration = 3800.  # Charge_Norm per MeV, as in EventReconstruction
+Po_tau = 237E-6
+c_LS = 3.0e8 / 1.55
+
+# Field types of the trees; IDdata.samples has one waveform per read-out channel, as written by eb2root.
+# uproot cannot write variable-length lists of fixed-size waveforms to a TTree (the basket offsets come out in samples
+# instead of waveforms), so EventTree is written as an RNTuple, which uproot reads through the same interface.
+event_types = {'eventId': np.int64, 'trgSec': np.int64, 'trgNsec': np.int64, 'IDdata.samples': f"var * {n_samples} * uint16", 'IDdata.GCUID': "var * uint8", 'IDdata.channelID': "var * uint8"}
+truth_types = {'eventId': np.int64, 'kind': np.int8, 'energy': np.float64, 'x': np.float64, 'y': np.float64, 'z': np.float64}
+
+def parse_arguments():
+	prs = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter)
+	prs.add_argument("OutputFile", help="Output ROOT file (EventTree); a YYYYMMDD_hhmmss run string in the name sets the start time")
+	prs.add_argument("-t", "--duration", type=float, default=10., help="Run duration in s; default: 10")
+	prs.add_argument("--rate", type=float, default=200., help="Rate of single (background) events in Hz; default: 200")
+	prs.add_argument("--muon_rate", type=float, default=5., help="Muon rate in Hz; default: 5")
+	prs.add_argument("--burst_mean", type=float, default=2., help="Mean number of events in the burst after each muon (within 10 us); default: 2")
+	prs.add_argument("--bipo_rate", type=float, default=1., help="Bi-Po pair rate in Hz; default: 1")
+	prs.add_argument("--pulse_fraction", type=float, default=0.8, help="Fraction of the read-out channels of an event that carry a pulse; default: 0.8")
+	prs.add_argument("--seed", type=int, default=1, help="Random seed; default: 1")
+	prs.add_argument("-b", "--block_size", type=int, default=1000, help="Events generated and written at a time; default: 1000")
+	return prs.parse_args()
+
+def run_start_time(output_file):
+	# Start of the run from the run string of the file name, or a fixed time
+	extracted_string, _ = extract_date_and_formatted_date(output_file)
+	if extracted_string is None:
+		return 1700000000
+	return int(datetime.strptime(extracted_string, "%Y%m%d_%H%M%S").replace(tzinfo=timezone.utc).timestamp())
+
+def synthetic_timeline(rng, duration, rate, muon_rate, burst_mean, bipo_rate, Po_tau=Po_tau, r_max=3000.):
+	# Time-ordered events with their kind, visible energy (MeV) and vertex (mm)
+	def poisson_times(event_rate):
+		return np.sort(rng.uniform(0, duration, rng.poisson(event_rate * duration)))
+
+	singles = poisson_times(rate)
+	muons = poisson_times(muon_rate)
+	n_burst = rng.poisson(burst_mean, len(muons))
+	bursts = np.repeat(muons, n_burst) + rng.uniform(0.5E-6, 10E-6, n_burst.sum())
+	prompts = poisson_times(bipo_rate)
+	delayed = prompts + rng.exponential(Po_tau, len(prompts))
+
+	trgTime = np.concatenate([singles, muons, bursts, prompts, delayed])
+	kind = np.concatenate([np.full(len(t), k, dtype=np.int8) for k, t in ((SINGLE, singles), (MUON, muons), (BURST, bursts), (PROMPT, prompts), (DELAYED, delayed))])
+	energy = np.concatenate([
+		0.2 + rng.exponential(0.8, len(singles)),
+		rng.uniform(30., 100., len(muons)),
+		rng.uniform(0.5, 8., len(bursts)),
+		rng.uniform(0.8, 3.2, len(prompts)),
+		np.maximum(rng.normal(0.9, 0.08, len(delayed)), 0.1)
+	])
+
+	# Uniform vertices in a cylinder; the delayed event of a pair sits at the prompt vertex
+	n = len(trgTime)
+	r = r_max * np.sqrt(rng.uniform(0, 1, n))
+	phi = rng.uniform(0, 2 * np.pi, n)
+	vertex = np.column_stack([r * np.cos(phi), r * np.sin(phi), rng.uniform(-r_max, r_max, n)])
+	first_prompt = len(singles) + len(muons) + len(bursts)
+	vertex[first_prompt + len(prompts):] = vertex[first_prompt:first_prompt + len(prompts)]
+
+	order = np.argsort(trgTime, kind='stable')
+	keep = trgTime[order] < duration
+	order = order[keep]
+	return {'trgTime': trgTime[order], 'kind': kind[order], 'energy': energy[order], 'vertex': vertex[order]}
+
+def live_channels(cable_map):
+	# (GCUID, GCU channel), position, gain and OD flag of every live channel of the cable map
+	GCUID, channel = np.nonzero(cable_map.live)
+	position = np.column_stack([cable_map.x[GCUID, channel], cable_map.y[GCUID, channel], cable_map.z[GCUID, channel]])
+	return GCUID, channel, position, cable_map.gain_corr[GCUID, channel], cable_map.OD[GCUID, channel]
+
+def top_k(rng, weights, k):
+	# k[i] channels per row drawn without replacement with probability ~ weights (Gumbel top-k), as a boolean mask
+	keys = np.log(np.maximum(weights, 1e-300)) - np.log(-np.log(rng.uniform(1e-12, 1., weights.shape)))
+	rank = np.argsort(np.argsort(-keys, axis=1), axis=1)
+	return rank < k[:, None]
+
+def event_channels(rng, timeline, channels, pulse_fraction=0.8):
+	# Read-out channels of every event with the pulse amplitude (0 for none) and time of each
+	GCUID, channel, position, gain, OD = channels
+	n_events, n_channels = len(timeline['kind']), len(GCUID)
+	kind, energy = timeline['kind'], timeline['energy']
+	distance = np.sqrt(np.sum((timeline['vertex'][:, None, :] - position[None, :, :]) ** 2, axis=2))  # mm
+
+	# Pulsed channels: ID channels close to the vertex, plus all (muon) or some (burst) OD channels
+	weights = np.where(OD[None, :], 0., 1. / np.maximum(distance / 1000., 0.5) ** 2)
+	n_ID = np.count_nonzero(~OD)
+	n_pulsed = np.clip(rng.poisson(4 + 12 * np.minimum(energy, 10.)), 1, n_ID)
+	n_pulsed = np.where(kind == MUON, int(0.8 * n_ID), n_pulsed)
+	pulsed = top_k(rng, weights, n_pulsed)
+	OD_pulsed = np.where((kind == MUON)[:, None], OD[None, :], (kind == BURST)[:, None] & OD[None, :] & (rng.uniform(0, 1, (n_events, n_channels)) < 0.4))
+	pulsed |= OD_pulsed
+
+	# Some more channels are read out without a pulse
+	n_quiet = rng.binomial(pulsed.sum(axis=1), 1. - pulse_fraction)
+	quiet = top_k(rng, np.where(pulsed, 0., 1.), n_quiet) & ~pulsed
+	read_out = pulsed | quiet
+
+	# Amplitudes: the visible energy is shared ~ 1/d^2 so that Charge_Norm / 3800 gives back the energy
+	share = np.where(pulsed, np.where(OD[None, :], 1., weights), 0.)
+	share /= np.maximum(share.sum(axis=1, keepdims=True), 1e-300)
+	live_PMTs = read_out.sum(axis=1)  # WaveformAnalyzer takes half of the read-out channels, each PMT has two gains
+	area = calibration * energy[:, None] * live_PMTs[:, None] * share * gain[None, :] / 100.
+	amplitude = np.where(pulsed, area / (pulse_width * np.sqrt(2 * np.pi)), 0.)
+	pulse_time = trigger_sample + distance / 1000. / c_LS * 1e9 + rng.normal(0, 2., (n_events, n_channels))
+
+	event, k = np.nonzero(read_out)
+	return {
+		'n_channels': read_out.sum(axis=1),
+		'GCUID': GCUID[k],
+		'channel': channel[k],
+		'amplitude': amplitude[event, k],
+		'pulse_time': pulse_time[event, k]
+	}
+
+def synthesize_waveforms(rng, amplitude, pulse_time):
+	# One row per amplitude: flat baseline with Gaussian noise and a negative Gaussian pulse
+	x = np.arange(n_samples, dtype=np.float32)
+	u = (x[None, :] - pulse_time[:, None].astype(np.float32)) / np.float32(pulse_width)
+	samples = rng.standard_normal((len(amplitude), n_samples), dtype=np.float32) * np.float32(noise) + np.float32(baseline)
+	samples -= amplitude[:, None].astype(np.float32) * np.exp(np.float32(-0.5) * u * u)
+	return np.clip(np.rint(samples), 0, np.iinfo(np.uint16).max).astype(np.uint16)
+
+def event_block(rng, timeline, channels, start_time, pulse_fraction):
+	# EventTree branches of a block of events; every PMT is read out in low gain (even channelID, 1/10 amplitude) and high gain (odd)
+	read_out = event_channels(rng, timeline, channels, pulse_fraction)
+	amplitude = np.column_stack([read_out['amplitude'] / 10., read_out['amplitude']]).ravel()
+	pulse_time = np.repeat(read_out['pulse_time'], 2)
+	samples = synthesize_waveforms(rng, amplitude, pulse_time)
+	counts = 2 * read_out['n_channels']
+
+	trgNsec_total = np.rint(timeline['trgTime'] * 1e9).astype(np.int64)
+	return {
+		'trgSec': start_time + trgNsec_total // 1000000000,
+		'trgNsec': trgNsec_total % 1000000000,
+		'IDdata.samples': ak.unflatten(samples, counts),
+		'IDdata.GCUID': ak.unflatten(np.repeat(read_out['GCUID'], 2).astype(np.uint8), counts),
+		'IDdata.channelID': ak.unflatten((2 * np.repeat(read_out['channel'], 2) + np.tile([0, 1], len(read_out['channel']))).astype(np.uint8), counts)
+	}
+
+def generate_run(output_file, duration=10., rate=200., muon_rate=5., burst_mean=2., bipo_rate=1., pulse_fraction=0.8, seed=1, block_size=1000):
+	# Writes EventTree and the SyntheticTruth tree (kind, energy, vertex of every event); returns the number of events
+	rng = np.random.default_rng(seed)
+	timeline = synthetic_timeline(rng, duration, rate, muon_rate, burst_mean, bipo_rate)
+	channels = live_channels(load_cable_map())
+	start_time = run_start_time(output_file)
+	n_events = len(timeline['trgTime'])
+
+	with uproot.recreate(output_file) as f:
+		f.mkrntuple("EventTree", {name: (branch_type if isinstance(branch_type, str) else np.dtype(branch_type)) for name, branch_type in event_types.items()})
+		f.mktree("SyntheticTruth", {name: np.dtype(branch_type) for name, branch_type in truth_types.items()})
+		for start in tqdm(range(0, n_events, block_size), desc="Generating", leave=True):
+			block = {key: value[start:start + block_size] for key, value in timeline.items()}
+			f["EventTree"].extend({'eventId': np.arange(start, start + len(block['trgTime']), dtype=np.int64), **event_block(rng, block, channels, start_time, pulse_fraction)})
+		if n_events > 0:
+			f["SyntheticTruth"].extend({
+				'eventId': np.arange(n_events, dtype=np.int64),
+				'kind': timeline['kind'],
+				'energy': timeline['energy'],
+				'x': timeline['vertex'][:, 0],
+				'y': timeline['vertex'][:, 1],
+				'z': timeline['vertex'][:, 2]
+			})
+	return n_events
+
+def main():
+	args = parse_arguments()
+	print("### Welcome to the HORUS synthetic EventTree generator ###")
+	time_start = time.time()
+	n_events = generate_run(args.OutputFile, args.duration, args.rate, args.muon_rate, args.burst_mean, args.bipo_rate, args.pulse_fraction, args.seed, args.block_size)
+	print(f"Output ROOT file created: {args.OutputFile} ({n_events} events in {time.time() - time_start:.2f} s)")
+
+if __name__ == "__main__":
+	main()
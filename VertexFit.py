@@ -0,0 +1,254 @@
+import time
+import numpy as np
+from multiprocessing import Pool
+from numba import njit
+
+# Batched maximum-likelihood vertex fit: x, y, z, t0 and the light yield N of every event, from the charges and the
+# times (WF_RiseTime) of its ID hits, one Levenberg-Marquardt (damped Gauss-Newton) fit per event in a compiled loop.
+#   charge: q_i ~ Gauss(mu_i, (q_rel * mu_i)^2 + q_noise^2), mu_i = N / (d_i^2 + d0^2) (d in m), solid angle ~ 1/d^2
+#   time:   t_i = t0 + d_i / v_LS with Gaussian errors sigma_t and a Huber cost beyond huber_k * sigma_t
+#           (late light, dark noise); only hits with q > q_time_min are used for the time
+# The fit starts from the charge barycenter; the events are split in blocks fitted in a process pool.
+
+v_LS = 3.0e8 / 1.55 * 1e-6  # mm/ns, as the TOF of EventReconstruction
+
+# Fit status of every event
+CONVERGED, MAX_ITERATIONS, TOO_FEW_HITS, FAILED = 0, 1, 2, 3
+status_names = ("converged", "max_iterations", "too_few_hits", "failed")
+
+default_settings = {
+    'sigma_t': 3.,  # ns
+    'huber_k': 3.,
+    'q_rel': 0.3,
+    'q_noise': 100.,
+    'q_time_min': 200.,
+    'd0': 0.5,  # m
+    'max_iterations': 50,
+    'tolerance': 1.  # mm
+}
+
+@njit(cache=True)
+def solve(A, b):
+    # Gaussian elimination with partial pivoting of a small dense system; returns False if it is singular
+    n = len(b)
+    M = A.copy()
+    x = b.copy()
+    for k in range(n):
+        p = k
+        for i in range(k + 1, n):
+            if abs(M[i, k]) > abs(M[p, k]):
+                p = i
+        if M[p, k] == 0. or M[p, k] != M[p, k]:
+            return x, False
+        if p != k:
+            for j in range(n):
+                M[k, j], M[p, j] = M[p, j], M[k, j]
+            x[k], x[p] = x[p], x[k]
+        for i in range(k + 1, n):
+            f = M[i, k] / M[k, k]
+            for j in range(k, n):
+                M[i, j] -= f * M[k, j]
+            x[i] -= f * x[k]
+    for k in range(n - 1, -1, -1):
+        for j in range(k + 1, n):
+            x[k] -= M[k, j] * x[j]
+        x[k] /= M[k, k]
+    return x, True
+
+@njit(cache=True)
+def event_cost(p, x, y, z, t, q, timed, sigma_q, sigma_t, huber_k, d0, A, b):
+    # Cost (-2 log L up to a constant) at p; fills the Gauss-Newton normal equations A, b
+    A[:, :] = 0.
+    b[:] = 0.
+    J = np.zeros(5)
+    cost = 0.
+    for i in range(len(x)):
+        dx, dy, dz = p[0] - x[i], p[1] - y[i], p[2] - z[i]
+        d = np.sqrt(dx * dx + dy * dy + dz * dz)
+        s = d * d * 1e-6 + d0 * d0
+        g = 1. / s
+        mu = p[4] * g
+        # Charge term
+        r = (q[i] - mu) / sigma_q[i]
+        dmu = -p[4] * g * g * 2e-6 / sigma_q[i]
+        J[0], J[1], J[2], J[3], J[4] = -dmu * dx, -dmu * dy, -dmu * dz, 0., -g / sigma_q[i]
+        cost += r * r
+        for k in range(5):
+            b[k] += J[k] * r
+            for j in range(5):
+                A[k, j] += J[k] * J[j]
+        if not timed[i]:
+            continue
+        # Time term, Huber-weighted (iteratively reweighted least squares)
+        r = (t[i] - p[3] - d / v_LS) / sigma_t
+        w = 1.
+        if abs(r) > huber_k:
+            w = huber_k / abs(r)
+            cost += 2. * huber_k * abs(r) - huber_k * huber_k
+        else:
+            cost += r * r
+        inv = 1. / (max(d, 1e-6) * v_LS * sigma_t)
+        J[0], J[1], J[2], J[3], J[4] = -dx * inv, -dy * inv, -dz * inv, -1. / sigma_t, 0.
+        for k in range(5):
+            b[k] += w * J[k] * r
+            for j in range(5):
+                A[k, j] += w * J[k] * J[j]
+    return cost
+
+@njit(cache=True)
+def fit_event(x, y, z, t, q, timed, start, sigma_t, huber_k, q_rel, q_noise, d0, max_iterations, tolerance):
+    # Returns the parameters, the cost per degree of freedom, the status and the number of iterations
+    p = np.empty(5)
+    p[0], p[1], p[2] = start[0], start[1], start[2]
+    n_timed = 0
+    t0_sum = 0.
+    g_sum = 0.
+    q_sum = 0.
+    for i in range(len(x)):
+        d = np.sqrt((p[0] - x[i]) ** 2 + (p[1] - y[i]) ** 2 + (p[2] - z[i]) ** 2)
+        g_sum += 1. / (d * d * 1e-6 + d0 * d0)
+        q_sum += q[i]
+        if timed[i]:
+            n_timed += 1
+            t0_sum += t[i] - d / v_LS
+    ndf = len(x) + n_timed - 5
+    if n_timed < 4 or ndf < 1 or q_sum <= 0. or not np.isfinite(p[0] + p[1] + p[2]):
+        return p, np.nan, TOO_FEW_HITS, 0
+    p[3] = t0_sum / n_timed
+    p[4] = q_sum / g_sum
+
+    A = np.zeros((5, 5))
+    b = np.zeros(5)
+    A_trial = np.zeros((5, 5))
+    b_trial = np.zeros(5)
+    sigma_q = np.empty(len(x))
+    damping = 1e-3
+    cost = np.nan
+    for iteration in range(1, max_iterations + 1):
+        # Charge errors from the current expectation, fixed within the iteration
+        for i in range(len(x)):
+            mu = p[4] / (((p[0] - x[i]) ** 2 + (p[1] - y[i]) ** 2 + (p[2] - z[i]) ** 2) * 1e-6 + d0 * d0)
+            sigma_q[i] = np.sqrt((q_rel * mu) ** 2 + q_noise * q_noise)
+        cost = event_cost(p, x, y, z, t, q, timed, sigma_q, sigma_t, huber_k, d0, A, b)
+        while True:
+            M = A.copy()
+            for k in range(5):
+                M[k, k] += damping * max(A[k, k], 1e-12)
+            step, ok = solve(M, -b)
+            if not ok:
+                return p, cost / ndf, FAILED, iteration
+            trial = p + step
+            trial[4] = max(trial[4], 1e-3 * p[4])
+            trial_cost = event_cost(trial, x, y, z, t, q, timed, sigma_q, sigma_t, huber_k, d0, A_trial, b_trial)
+            if trial_cost <= cost:
+                damping = max(damping / 10., 1e-9)
+                break
+            damping *= 10.
+            if damping > 1e9:
+                # No step lowers the cost any more: at the minimum within the precision
+                return p, cost / ndf, CONVERGED, iteration
+        p = trial
+        if np.sqrt(step[0] ** 2 + step[1] ** 2 + step[2] ** 2) < tolerance and abs(step[3]) < tolerance / v_LS:
+            return p, trial_cost / ndf, CONVERGED, iteration
+    return p, cost / ndf, MAX_ITERATIONS, max_iterations
+
+@njit(cache=True)
+def fit_events(offsets, x, y, z, t, q, timed, start, sigma_t, huber_k, q_rel, q_noise, d0, max_iterations, tolerance):
+    # One fit per segment [offsets[e], offsets[e + 1]) of the hit arrays
+    n_events = len(offsets) - 1
+    params = np.full((n_events, 5), np.nan)
+    chi2 = np.full(n_events, np.nan)
+    status = np.empty(n_events, dtype=np.int32)
+    iterations = np.zeros(n_events, dtype=np.int32)
+    for e in range(n_events):
+        lo, hi = offsets[e], offsets[e + 1]
+        p, c, s, n = fit_event(x[lo:hi], y[lo:hi], z[lo:hi], t[lo:hi], q[lo:hi], timed[lo:hi], start[e],
+                               sigma_t, huber_k, q_rel, q_noise, d0, max_iterations, tolerance)
+        if s != TOO_FEW_HITS:
+            params[e] = p
+        chi2[e] = c
+        status[e] = s
+        iterations[e] = n
+    return params, chi2, status, iterations
+
+def fit_block(task):
+    # Worker: fits a block of events; offsets start at 0 within the block
+    offsets, x, y, z, t, q, start, settings = task
+    timed = q > settings['q_time_min']
+    return fit_events(offsets, x, y, z, t, q, timed, start, settings['sigma_t'], settings['huber_k'], settings['q_rel'],
+                      settings['q_noise'], settings['d0'], settings['max_iterations'], settings['tolerance'])
+
+def split_blocks(offsets, n_blocks):
+    # Event ranges with about the same number of hits each
+    n_events = len(offsets) - 1
+    edges = np.searchsorted(offsets, np.linspace(0, offsets[-1], n_blocks + 1)[1:-1]) if n_events > 0 else []
+    edges = np.unique(np.concatenate([[0], np.clip(edges, 0, n_events), [n_events]])).astype(int)
+    return list(zip(edges[:-1], edges[1:]))
+
+class VertexFitter:
+    # Fits the events of process_data in blocks, in a pool of `workers` processes (kept open between calls);
+    # the totals (events, status counts, iterations, fit time) are printed by summary()
+    def __init__(self, workers=1, block_events=2000, **settings):
+        self.workers = workers
+        self.block_events = block_events
+        self.settings = {**default_settings, **settings}
+        self.pool = None
+        self.n_events = 0
+        self.status_counts = np.zeros(len(status_names), dtype=np.int64)
+        self.iterations = 0
+        self.fit_time = 0.
+
+    def fit(self, offsets, x, y, z, t, q, start):
+        # offsets: hit segments of the events; x, y, z (mm), t (ns) and q (> 0) of the hits; start: (n_events, 3)
+        # Returns a dict with the fitted x, y, z, t0, N, the cost per degree of freedom (chi2), status and iterations
+        time_start = time.time()
+        offsets = np.asarray(offsets, dtype=np.int64)
+        columns = [np.ascontiguousarray(values, dtype=np.float64) for values in (x, y, z, t, q)]
+        start = np.ascontiguousarray(start, dtype=np.float64)
+        n_events = len(offsets) - 1
+        blocks = split_blocks(offsets, max(self.workers, -(-n_events // self.block_events)))
+        tasks = [(offsets[lo:hi + 1] - offsets[lo], *[values[offsets[lo]:offsets[hi]] for values in columns], start[lo:hi], self.settings) for lo, hi in blocks]
+        if self.workers > 1 and len(tasks) > 1:
+            if self.pool is None:
+                self.pool = Pool(self.workers)
+            parts = self.pool.map(fit_block, tasks)
+        else:
+            parts = [fit_block(task) for task in tasks]
+        if len(parts) > 0:
+            params, chi2, status, iterations = (np.concatenate(values) for values in zip(*parts))
+        else:
+            params, chi2, status, iterations = np.empty((0, 5)), np.empty(0), np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32)
+
+        self.n_events += n_events
+        self.status_counts += np.bincount(status, minlength=len(status_names))
+        self.iterations += int(iterations.sum())
+        self.fit_time += time.time() - time_start
+        return {'x': params[:, 0], 'y': params[:, 1], 'z': params[:, 2], 't0': params[:, 3], 'N': params[:, 4],
+                'chi2': chi2, 'status': status, 'iterations': iterations}
+
+    def record(self, report):
+        # Counters and fit time (part of the reconstruction stage) in a RunReport
+        report.add_time("vertex_fit", self.fit_time)
+        report.count("vertex_fits", self.n_events)
+        for name, n in zip(status_names, self.status_counts):
+            report.count(f"vertex_{name}", int(n))
+        report.count("vertex_iterations", self.iterations)
+
+    def summary(self):
+        rate = self.n_events / self.fit_time if self.fit_time > 0 else 0.
+        fitted = self.n_events - self.status_counts[TOO_FEW_HITS]
+        return (f"Vertex fit: {self.n_events} events in {self.fit_time:.2f} s: {rate:.0f} events/s; "
+                + ", ".join(f"{name} {n}" for name, n in zip(status_names, self.status_counts))
+                + f"; {self.iterations / max(fitted, 1):.1f} iterations per fitted event")
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -3,93 +3,363 @@
 # Author: Davide Basilico davide.basilico@mi.infn.it , Marco Beretta marco.beretta@mi.infn.it
 
 import sys
+import os
+import shutil
+import json
 import uproot
 import re
 import matplotlib.pyplot as plt
 import numpy as np
 import time
+import argparse
+from argparse import RawTextHelpFormatter
+from multiprocessing import Pool
+from functools import partial
+from contextlib import closing
 import awkward as ak
 from datetime import datetime
 from Waveform import Waveform
+from WaveformBatch import analyze_waveform_block, sweep_waveform_block, parameter_grid, default_config, block_bytes_per_sample
+from PulseFinder import analyze_pulses_block
+from HitTable import HitWriter, concatenate_hits, output_formats, table_dtypes, cast_hits
+from CableMap import load_cable_map
+from EventReader import read_chunks, entry_step, ReadStats
+from WaveformCache import open_cache, memory_size
+from Instrumentation import RunReport, profile_modes
+from Manifest import Manifest
+from Histograms import HistogramSet
 from tqdm import tqdm
 from utils import (
     extract_date_and_formatted_date,
-    read_all_PMTs_coordinates,
-    load_PMT_coordinates,
-    find_PMT_Coordinates,
     print_progress,
     generate_synthetic_waveform
 )
 from numba import njit,jit
 
-OD_ids = [(17,1), (18,1), (19,5), (20,1), (37, 3), (38,1), (38,5), (39,1), (40,1), (42, 1), (42, 5), (43, 3)]
+cable_map = load_cable_map()
+
+def high_gain_channels(chunk):
+	# Only high-gains, with their cable map entries
+	high_gain = np.flatnonzero(chunk['channelID'] % 2 != 0)
+	return high_gain, cable_map.gather(chunk['GCUID'][high_gain], chunk['channelID'][high_gain])
+
+def hit_table(chunk, high_gain, gathered, rows, charge, rise_time):
+	# One hit per entry of rows (positions among the high-gain channels of the chunk), with its charge and rise time
+	offsets = chunk['offsets']
+	n_channels = np.diff(offsets)
+	trgTime = chunk['trgTime']
+	IDdata_GCUID = chunk['GCUID']
+	IDdata_channelID = chunk['channelID']
+
+	event = np.repeat(np.arange(len(n_channels)), n_channels)
+	position = np.arange(len(event)) - np.repeat(offsets[:-1], n_channels)
+
+	x, y, z, gain_corr, OD, live = gathered
+	selected = high_gain[rows]
+	j = event[selected]
+
+	return {
+		'index': chunk['entry_start'] + j,
+		'charge': charge / gain_corr[rows] * 100.,
+		'GCU': position[selected],
+		'WF_RiseTime': rise_time,
+		'trgTime': trgTime[j],
+		'ID_channel': IDdata_channelID[selected],
+		'GCUID': IDdata_GCUID[selected],
+		'x_PMT': x[rows],
+		'y_PMT': y[rows],
+		'z_PMT': z[rows],
+		'LivePMTs': n_channels[j] // 2,
+		'gain': gain_corr[rows],
+		'OD': OD[rows].astype(int),
+		'Shape_Ch': n_channels[j]
+	}
+
+def chunk_hits(chunk, high_gain, gathered, result):
+	# Hit table of the fired high-gain channels of a chunk
+	live = gathered[-1]
+	rows = np.flatnonzero(result['fired'] & live)  # Channels with no gain correction are skipped
+	return hit_table(chunk, high_gain, gathered, rows, result['charge'][rows], result['rise_time'][rows])
+
+def pulse_hits(chunk, high_gain, gathered, pulses):
+	# One hit per pulse of the high-gain channels (see PulseFinder); WF_RiseTime is the start of the pulse
+	n_pulses = np.diff(pulses['offsets'])
+	waveform = np.repeat(np.arange(len(n_pulses)), n_pulses)
+	keep = gathered[-1][waveform]
+	rows = waveform[keep]
+	hits = hit_table(chunk, high_gain, gathered, rows, pulses['charge'][keep], pulses['start'][keep])
+	hits['pulse'] = (np.arange(len(waveform)) - np.repeat(pulses['offsets'][:-1], n_pulses))[keep]
+	hits['peak'] = pulses['peak'][keep]
+	hits['amplitude'] = pulses['amplitude'][keep]
+	hits['width'] = pulses['width'][keep]
+	return hits
+
+def analyze_chunk(chunk, cleaning, cleaning_cutoff=0.10, configs=None, multi_pulse='false', compact='false'):
+	# Analyze all the high-gain waveforms of a flat chunk (see EventReader.flatten_events) at once;
+	# with configs, returns one hit table per configuration of the sweep, with multi_pulse one hit per pulse.
+	# With compact, the waveforms are analysed in float32 and the hits have the compact dtypes (see HitTable)
+	high_gain, gathered = high_gain_channels(chunk)
+	samples = chunk['samples'][high_gain]
+	if multi_pulse == 'true':
+		pulses = analyze_pulses_block(samples, threshold_method='std_dev', baseline_entries=50, cleaning=cleaning, cleaning_cutoff=cleaning_cutoff)
+		hits = pulse_hits(chunk, high_gain, gathered, pulses)
+	elif configs is not None:
+		hits = [chunk_hits(chunk, high_gain, gathered, result) for result in sweep_waveform_block(samples, configs, cleaning, cleaning_cutoff)]
+	else:
+		result = analyze_waveform_block(samples, threshold_method='std_dev', baseline_entries=50, cleaning=cleaning, cleaning_cutoff=cleaning_cutoff,
+			dtype=np.float32 if compact == 'true' else np.float64)
+		hits = chunk_hits(chunk, high_gain, gathered, result)
+	if compact == 'true':
+		dtypes = table_dtypes(multi_pulse, compact)
+		hits = [cast_hits(config_hits, dtypes) for config_hits in hits] if configs is not None else cast_hits(hits, dtypes)
+	return hits
+
+def parse_arguments():
+	prs = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter)
+	prs.add_argument("InputFile", help="Input ROOT file (EventTree)")
+	prs.add_argument("OutputFile", help="Output hit file (text or ROOT, see --format)")
+	prs.add_argument("Entries", nargs="?", type=int, default=0, help="Number of synthetic waveforms (synth mode only)")
+	prs.add_argument("-f", "--format", default="txt", choices=output_formats, help="Output format: tab-separated text or ROOT TTree (HitTree); default: txt")
+	prs.add_argument("-w", "--workers", type=int, default=1, help="Number of worker processes; default: 1 (serial)")
+	prs.add_argument("--cleaning", default="false", help="Low-pass FFT cleaning of the waveforms before the rise time and charge; default: false")
+	prs.add_argument("--cutoff", type=float, default=0.10, help="Cleaning cutoff frequency in units of the sampling frequency; default: 0.10")
+	prs.add_argument("-s", "--step_size", default="50 MB", help="Size of the chunks read from EventTree, in bytes (e.g. '50 MB') or entries; default: 50 MB")
+	prs.add_argument("--memory_budget", default="null", help="Memory for the chunks being analysed, shared by the workers (e.g. '2 GB'): the chunk size in entries\nis computed from the samples per entry of the run, instead of --step_size; default: none")
+	prs.add_argument("--compact", default="false", help="Memory-efficient mode: waveforms analysed in float32, hits with compact dtypes (uint8/uint16 channels\nand flags, float32 charges and positions, see HitTable.py); default: false")
+	prs.add_argument("--cache", default="true", help="Read the decoded waveform cache of the run (see WaveformCache.py) when it exists; default: true")
+	prs.add_argument("--cache_dir", default="null", help="Waveform cache directory; default: waveform_cache next to the input file")
+	prs.add_argument("--profile", default="false", choices=profile_modes, help="Profile the run: cprofile (OutputFile.prof) or sample (in the report); default: false")
+	prs.add_argument("--multi_pulse", default="false", help="Find every pulse of each waveform, one hit per pulse (with pulse, peak, amplitude, width columns); default: false (first pulse only)")
+	prs.add_argument("--histograms", default="null", help="ROOT file for the monitoring histograms of the hits (charge and rise time, also per channel); default: none")
+	prs.add_argument("--manifest", default="null", help="Manifest JSON file (e.g. manifest.json, shared by all the runs): skip the run if it was already analysed\nwith the same parameters from the same file, resume it from the last finished chunk if it was interrupted; default: none")
+	prs.add_argument("--sweep", default="null", help="JSON file with lists of values for threshold_method, threshold_absolute, threshold_std_dev,\nrise_fraction, baseline_entries, integration_window: every combination is analysed in a single pass\nand written to OutputFile_cfg<N>; default: none")
+	return prs.parse_args()
+
+def split_entry_range(Entries, n_chunks):
+	edges = np.linspace(0, Entries, min(n_chunks, max(Entries, 1)) + 1).astype(int)
+	return [(int(lo), int(hi)) for lo, hi in zip(edges[:-1], edges[1:]) if lo < hi]
+
+def open_events(input_file, use_cache="true", cache_dir="null"):
+	# Number of entries, chunk reader and name of the source of a run: the decoded waveform cache if there is one, the EventTree otherwise
+	cache = open_cache(input_file, cache_dir) if use_cache == "true" else None
+	if cache is not None:
+		return cache.num_entries, cache.chunks, cache.path
+	tree = uproot.open(input_file)['EventTree']
+	return int(tree.num_entries), partial(read_chunks, tree), input_file
+
+def analyze_entry_range(task):
+	# Worker: opens its own uproot handle (or memory maps of the cache) and returns the hits of [entry_start, entry_stop) with its read statistics
+	# and, if asked for, its own histograms of the hits (added to the others in the main process)
+	input_file, entry_start, entry_stop, step_size, cleaning, cleaning_cutoff, configs, use_cache, cache_dir, multi_pulse, compact, fill_histograms = task
+	_, chunks, _ = open_events(input_file, use_cache, cache_dir)
+	stats = ReadStats()
+	hits = [analyze_chunk(chunk, cleaning, cleaning_cutoff, configs, multi_pulse, compact) for chunk in chunks(entry_start, entry_stop, step_size, stats=stats)]
+	if configs is not None:
+		return [concatenate_hits([chunk[k] for chunk in hits], table_dtypes('false', compact)) for k in range(len(configs))], stats, None
+	hits = concatenate_hits(hits, table_dtypes(multi_pulse, compact))
+	histograms = None
+	if fill_histograms:
+		histograms = HistogramSet(cable_map)
+		histograms.fill_hits(hits)
+	return hits, stats, histograms
+
+def count_hits(report, hits):
+	if isinstance(hits, list):
+		for k, config_hits in enumerate(hits):
+			report.count(f"fired_hits_cfg{k}", len(config_hits['index']))
+	else:
+		report.count("fired_hits", len(hits['index']))
+
+def analyze_chunks(input_file, workers=1, step_size="50 MB", cleaning='false', cleaning_cutoff=0.10, configs=None, use_cache="true", cache_dir="null", report=None, multi_pulse='false', entry_start=0, histograms=None, compact='false'):
+	# Yields (entry_stop, hits) for the EventTree entries from entry_start on, in entry order, one chunk at a time
+	# (hits is a list with one table per configuration when sweeping); the throughput is printed at the end
+	# and the stages are timed in report. The hits are added to histograms (a HistogramSet) if given
+	report = report if report is not None else RunReport("analyze_file")
+	num_entries, chunks, source = open_events(input_file, use_cache, cache_dir)
+	print("Reading: ", source)
+	Entries = num_entries - 1 
+	step_size = entry_step(step_size)
+	stats = ReadStats()
+	if entry_start > 0:
+		print("Resuming from entry ", entry_start)
+
+	with tqdm(total=Entries, initial=min(entry_start, max(Entries, 0)), desc="Processing", unit="events", leave=True) as progress:
+		if workers > 1:
+			# Several chunks per worker to balance the load; imap returns them in entry order
+			ranges = [(entry_start + lo, entry_start + hi) for lo, hi in split_entry_range(Entries - entry_start, 4 * workers)]
+			tasks = [(input_file, lo, hi, step_size, cleaning, cleaning_cutoff, configs, use_cache, cache_dir, multi_pulse, compact, histograms is not None) for lo, hi in ranges]
+			print("Parallel mode: ", workers, " workers, ", len(tasks), " chunks")
+			with Pool(workers) as pool:
+				results = pool.imap(analyze_entry_range, tasks)
+				for _, entry_stop in ranges:
+					# Reading and analysis both happen in the workers: only the waiting time is seen here
+					with report.stage("read_and_analysis_workers"):
+						hits, worker_stats, worker_histograms = next(results)
+					stats.merge(worker_stats)
+					if histograms is not None:
+						histograms.add(worker_histograms)
+					progress.update(worker_stats.events)
+					count_hits(report, hits)
+					yield entry_stop, hits
+		else:
+			for chunk in chunks(entry_start, Entries, step_size, stats=stats):
+				progress.update(chunk['n_events'])
+				with report.stage("waveform_analysis"):
+					hits = analyze_chunk(chunk, cleaning, cleaning_cutoff, configs, multi_pulse, compact)
+				if histograms is not None:
+					with report.stage("histograms"):
+						histograms.fill_hits(hits)
+				count_hits(report, hits)
+				yield chunk['entry_start'] + chunk['n_events'], hits
+	report.add_time("read", stats.wait_time)  # summed over the workers in parallel mode
+	report.count("entries", stats.events)
+	report.count("channels", stats.channels)
+	report.count("bytes_decoded", stats.bytes)
+	report.count("bytes_input", os.path.getsize(input_file))
+	print(stats.summary())
+
+def analyze_file(input_file, workers=1, step_size="50 MB", cleaning='false', cleaning_cutoff=0.10, configs=None, use_cache="true", cache_dir="null", report=None, multi_pulse='false', histograms=None, compact='false'):
+	# Yields the hits of the whole EventTree in entry order, one chunk at a time (see analyze_chunks)
+	for _, hits in analyze_chunks(input_file, workers, step_size, cleaning, cleaning_cutoff, configs, use_cache, cache_dir, report, multi_pulse, histograms=histograms, compact=compact):
+		yield hits
+
+def budget_step_size(input_file, memory_budget, workers=1, cleaning='false', compact='false', multi_pulse='false', use_cache="true", cache_dir="null", probe_entries=20):
+	# Entries per chunk such that the chunks analysed at the same time (one per worker) fit in memory_budget ("2 GB").
+	# Per sample of a chunk: the decoded samples (the chunk being analysed, the one read ahead and the awkward arrays
+	# they are flattened from; memory maps of the cache are only paged in), the copy of the high-gain half and the
+	# working memory of the analysis (WaveformBatch.block_bytes_per_sample); the samples per entry are those of the first entries
+	num_entries, chunks, source = open_events(input_file, use_cache, cache_dir)
+	probe = min(num_entries, probe_entries)
+	if probe == 0:
+		return 1
+	with closing(chunks(0, probe, probe)) as probe_chunks:
+		samples = next(probe_chunks)['samples']
+	samples_per_entry = max(samples.size / probe, 1.)
+	copies = 1 if source != input_file else 3
+	dtype = np.float32 if compact == 'true' and multi_pulse != 'true' else np.float64
+	bytes_per_sample = copies * samples.itemsize + 0.5 * (samples.itemsize + block_bytes_per_sample(dtype, cleaning))
+	step = int(memory_size(memory_budget) / max(workers, 1) / (samples_per_entry * bytes_per_sample))
+	print(f"Memory budget: {memory_budget} for {max(workers, 1)} worker(s), {samples_per_entry:.0f} samples per entry: {max(step, 1)} entries per chunk")
+	return max(step, 1)
+
+# Parameters that change the hits: a run is analysed again when one of them differs from the manifest
+manifest_parameters = ('format', 'cleaning', 'cutoff', 'multi_pulse', 'compact')
+
+def incremental_analysis(args, extracted_string, extracted_date, report):
+	# With a manifest, runs already analysed from the same file with the same parameters are skipped, and the hits
+	# of every finished chunk are saved in OutputFile.parts, so that an interrupted run restarts from the last
+	# finished chunk; the output file (and the histograms, if asked for) is written from the parts at the end
+	manifest = Manifest(args.manifest)
+	parameters = {name: vars(args)[name] for name in manifest_parameters}
+	if manifest.is_done(args.InputFile, args.OutputFile, "WaveformAnalyzer", parameters):
+		print("Unchanged since the last analysis, skipped: ", args.InputFile)
+		return
+	parts_dir = args.OutputFile + ".parts"
+	entry_start = manifest.resume_point(args.InputFile, args.OutputFile, "WaveformAnalyzer", parameters) if os.path.isdir(parts_dir) else 0
+	if entry_start == 0:
+		shutil.rmtree(parts_dir, ignore_errors=True)
+		os.makedirs(parts_dir)
+		manifest.start(args.InputFile, args.OutputFile, "WaveformAnalyzer", parameters)
+	for part in os.listdir(parts_dir):
+		# Chunks written after the last one recorded as finished are redone
+		if part.endswith(".tmp.npz") or not part.endswith(".npz") or int(part[5:-4]) > entry_start:
+			os.remove(os.path.join(parts_dir, part))
+
+	for entry_stop, hits in analyze_chunks(args.InputFile, args.workers, args.step_size, args.cleaning, args.cutoff, None, args.cache, args.cache_dir, report, args.multi_pulse, entry_start, compact=args.compact):
+		with report.stage("write"):
+			part = os.path.join(parts_dir, f"hits_{entry_stop:012d}")
+			np.savez(part + ".tmp.npz", **hits)
+			os.replace(part + ".tmp.npz", part + ".npz")
+		manifest.chunk_done(args.OutputFile, entry_stop)
+
+	dtypes = table_dtypes(args.multi_pulse, args.compact)
+	histograms = HistogramSet(cable_map) if args.histograms != "null" else None
+	with report.stage("write"):
+		with HitWriter(args.OutputFile, args.format, extracted_string, extracted_date, dtypes=dtypes) as file:
+			for part in sorted(os.listdir(parts_dir)):
+				with np.load(os.path.join(parts_dir, part)) as part_hits:
+					hits = {key: part_hits[key] for key in dtypes}
+				file.write(hits)
+				if histograms is not None:
+					histograms.fill_hits(hits)
+	if histograms is not None:
+		histograms.write(args.histograms)
+	manifest.finish(args.OutputFile)
+	shutil.rmtree(parts_dir)
+
+def sweep_output_name(output_file, k):
+	stem, extension = os.path.splitext(output_file)
+	return f"{stem}_cfg{k}{extension}"
+
+def sweep(args, extracted_string, extracted_date, report):
+	# Every configuration of the grid on each chunk, read once; one hit file per configuration
+	with open(args.sweep) as f:
+		configs = parameter_grid(**json.load(f))
+	print("Sweep: ", len(configs), " configurations")
+	with open(os.path.splitext(args.OutputFile)[0] + "_configs.txt", 'w') as f:
+		f.write("config\tfile\t" + "\t".join(default_config) + "\n")
+		for k, config in enumerate(configs):
+			f.write(f"{k}\t{sweep_output_name(args.OutputFile, k)}\t" + "\t".join(str(config[name]) for name in default_config) + "\n")
+
+	writers = [HitWriter(sweep_output_name(args.OutputFile, k), args.format, extracted_string, extracted_date, dtypes=table_dtypes('false', args.compact)) for k in range(len(configs))]
+	try:
+		for hits in analyze_file(args.InputFile, args.workers, args.step_size, args.cleaning, args.cutoff, configs, args.cache, args.cache_dir, report, compact=args.compact):
+			with report.stage("write"):
+				for writer, config_hits in zip(writers, hits):
+					writer.write(config_hits)
+	finally:
+		for writer in writers:
+			writer.close()
 
 def main():
 
 	synth_mode = 'false'
-	cleaning = 'false'
-	
-	if len(sys.argv) < 3:
-		print("Usage: python WF_Analyzer.py [Input_RootFile] [Output_TxtFile]")
-		sys.exit(1)
+
+	args = parse_arguments()
+	cleaning = args.cleaning
 		
 	header_synth = "name	date	index	charge	WF_RiseTime	\n"
-	header = "name\tdate\tindex\tcharge\tGCU\tWF_RiseTime\ttrgTime\tID_channel\tGCUID\tx_PMT\ty_PMT\tz_PMT\tLivePMTs\tgain\tOD\tShape_Ch\n"
 
 	OD_fired = 0
 
-	# Read all the PMTs coordinates (x,y,z)
-	all_PMTs_x, all_PMTs_y, all_PMTs_z, all_PMTs_gain_corr = read_all_PMTs_coordinates("OSIRIS_cable_map_N.conf")
-
-	with open(sys.argv[2], 'w'):
-		pass
+	if args.sweep == "null" and args.manifest == "null":
+		with open(args.OutputFile, 'w'):
+			pass
 
 	print("### Welcome to the HORUS WaveformAnalyzer ###")		
 
 	if(synth_mode == 'false'):
 	
-		block_size = 100
-		file = uproot.open(sys.argv[1])
-		tree = file['EventTree']
-		Entries = int(tree.num_entries) - 1 
-	
-		extracted_string, extracted_date = extract_date_and_formatted_date(sys.argv[1])
+		extracted_string, extracted_date = extract_date_and_formatted_date(args.InputFile)
 		print("Run: " , extracted_string, "\nDate:", extracted_date)		
-		with open(sys.argv[2], 'a') as file:
-			file.write(header)
-	
-			for start in tqdm(range(0, Entries, block_size), desc="Processing", leave=True):
-				stop = min(start + block_size, Entries)
-				events = tree.arrays(["eventId", "trgSec", "trgNsec", "IDdata.samples", "IDdata.GCUID", "IDdata.channelID"], entry_start=start, entry_stop=stop)
-				trgTime = []
-
-				for j in range(stop - start):
-					trgTime.append(events["trgSec"][j] + 1e-9*events["trgNsec"][j])
-					IDdata_GCUID = ak.to_numpy(events["IDdata.GCUID"][j])
-					IDdata_channelID = ak.to_numpy(events["IDdata.channelID"][j])
-					IDdata_samples_vector = ak.to_numpy(events["IDdata.samples"][j])
-
-					for i in range(IDdata_channelID.shape[0]):
-						
-						if IDdata_channelID[i] % 2 == 0:  # Only high-gains
-							continue
-										
-						waveform = Waveform(IDdata_samples_vector[i, :], threshold_method='std_dev', baseline_entries=50, cleaning=cleaning)
-						fired_PMTs, integrated_charge, rise_time = waveform.analyze_waveform()
-
-						if fired_PMTs > 0:
-							coordinate, gain_corr = find_PMT_Coordinates(IDdata_GCUID[i], IDdata_channelID[i])
-							if(gain_corr == 0): continue
-							integrated_charge = integrated_charge / float(gain_corr) * 100.
-
-							if (IDdata_GCUID[i], IDdata_channelID[i]) in OD_ids:
-								OD_fired = 1
-								#print("GCU: ", IDdata_GCUID[i], "; channelID: ", IDdata_channelID[i])
-							else:
-								OD_fired = 0
-
-							file.write(f"{extracted_string}\t{extracted_date}\t{start+j}\t{integrated_charge}\t{i}\t{rise_time}\t{trgTime[j]}\t{IDdata_channelID[i]}\t{IDdata_GCUID[i]}\t{coordinate[0]}\t{coordinate[1]}\t{coordinate[2]}\t{int(IDdata_channelID.shape[0]/2)}\t{gain_corr}\t{OD_fired}\t{IDdata_samples_vector.shape[0]}\n")
-						
+		report = RunReport("WaveformAnalyzer", vars(args), args.profile)
+		if args.memory_budget != "null":
+			args.step_size = budget_step_size(args.InputFile, args.memory_budget, args.workers, args.cleaning, args.compact, args.multi_pulse, args.cache, args.cache_dir)
+		if args.sweep != "null":
+			if args.multi_pulse == "true":
+				raise ValueError("The parameter sweep works on the first pulse only: --sweep and --multi_pulse true cannot be combined.")
+			if args.manifest != "null":
+				raise ValueError("The parameter sweep is not tracked by the manifest: --sweep and --manifest cannot be combined.")
+			if args.histograms != "null":
+				raise ValueError("The histograms are filled for a single configuration: --sweep and --histograms cannot be combined.")
+			sweep(args, extracted_string, extracted_date, report)
+			report.write(args.OutputFile)
+			return
+		if args.manifest != "null":
+			incremental_analysis(args, extracted_string, extracted_date, report)
+			report.write(args.OutputFile)
+			return
+
+		dtypes = table_dtypes(args.multi_pulse, args.compact)
+		histograms = HistogramSet(cable_map) if args.histograms != "null" else None
+		with HitWriter(args.OutputFile, args.format, extracted_string, extracted_date, dtypes=dtypes) as file:
+
+			for hits in analyze_file(args.InputFile, args.workers, args.step_size, cleaning, args.cutoff, use_cache=args.cache, cache_dir=args.cache_dir, report=report, multi_pulse=args.multi_pulse, histograms=histograms, compact=args.compact):
+				with report.stage("write"):
+					file.write(hits)
+		if histograms is not None:
+			histograms.write(args.histograms)
+		report.write(args.OutputFile)
 
 	if(synth_mode == 'true'):
 	
@@ -98,9 +368,9 @@ def main():
 		extracted_string, extracted_date = '2024_X', '2024_MM_DD'
 		
 		
-		with open(sys.argv[2], 'a') as file:
+		with open(args.OutputFile, 'a') as file:
 			file.write(header_synth)	
-			Entries = int(sys.argv[3])	
+			Entries = args.Entries	
 			for start in tqdm(range(0, Entries), desc="Processing", leave=True):
 				
 				if(start % 2 ==0):
@@ -109,6 +379,12 @@ def main():
 					synth_params = {'flat_height': 11000, 'gaussian_amplitude': 0,'gaussian_center': 250,'gaussian_width': 10}
 					
 				samples = generate_synthetic_waveform(synth_params)					
+				if(args.multi_pulse == 'true'):
+					# Both Gaussians of the synthetic waveform, one line each
+					pulses = analyze_pulses_block(samples[None, :], threshold_method='std_dev', baseline_entries=50, cleaning=cleaning)
+					for integrated_charge, rise_time in zip(pulses['charge'], pulses['start']):
+						file.write(f"{extracted_string}\t{extracted_date}\t{start}\t{integrated_charge}\t{rise_time}\n")
+					continue
 				waveform = Waveform(samples, threshold_method='std_dev', baseline_entries=50, cleaning=cleaning)
 				fired_PMTs, integrated_charge, rise_time = waveform.analyze_waveform()
 				#print(start,fired_PMTs, integrated_charge, rise_time)
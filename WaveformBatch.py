@@ -0,0 +1,173 @@
+import numpy as np
+import itertools
+from functools import lru_cache
+
+# Vectorized counterpart of Waveform: every row of `samples` is one waveform (channels x samples)
+
+def baseline_statistics(samples, baseline_entries):
+	baseline = np.mean(samples[:, :baseline_entries], axis=1)  # Average of earliest baseline_entries of each WF
+	std_dev_baseline = np.std(samples[:, :baseline_entries], axis=1)
+	min_value = np.min(samples, axis=1)
+	return baseline, std_dev_baseline, min_value
+
+@lru_cache(maxsize=None)
+def low_pass_mask(n_samples, cutoff=0.10):
+	# Kept frequencies of the real FFT of a waveform with n_samples samples (cutoff in units of the sampling frequency)
+	mask = np.fft.rfftfreq(n_samples) < cutoff
+	mask.flags.writeable = False
+	return mask
+
+def clean_waveform_block(samples, cutoff=0.10, dtype=None, block_rows=2048):
+	# Same low-pass filter as Waveform.clean_data: the filtered spectrum is Hermitian, so the real FFT gives the same waveform.
+	# With dtype, the cleaned waveforms are stored in dtype and filtered block_rows at a time, so that the FFT temporaries stay small
+	n_samples = samples.shape[1]
+	if dtype is None:
+		freq_domain = np.fft.rfft(samples, axis=1)
+		freq_domain *= low_pass_mask(n_samples, cutoff)
+		return np.abs(np.fft.irfft(freq_domain, n=n_samples, axis=1))
+	cleaned = np.empty(samples.shape, dtype=dtype)
+	for start in range(0, len(samples), block_rows):
+		freq_domain = np.fft.rfft(samples[start:start + block_rows], axis=1)
+		freq_domain *= low_pass_mask(n_samples, cutoff)
+		np.abs(np.fft.irfft(freq_domain, n=n_samples, axis=1), out=cleaned[start:start + block_rows])
+	return cleaned
+
+def check_threshold_block(baseline, std_dev_baseline, min_value, method, threshold_absolute=20, threshold_std_dev=5):
+	if method == 'baseline':
+		return baseline - min_value > threshold_absolute
+	elif method == 'std_dev':
+		return (baseline - min_value) > threshold_std_dev * std_dev_baseline
+	else:
+		raise ValueError("Threshold finder method not valid. Please use 'baseline', 'std_dev', or 'deconvolution'.")
+
+def find_rise_time_block(samples, baseline, diff_baseline_max, rise_fraction=5):
+	# First sample whose distance from the baseline exceeds 1/rise_fraction of the pulse height; -1 if none
+	# (the distances are computed in the dtype of baseline)
+	distance = baseline[:, None] - samples
+	np.abs(distance, out=distance)
+	crossing = distance > (np.abs(diff_baseline_max) / rise_fraction)[:, None]
+	del distance
+	found = crossing.any(axis=1)
+	return np.where(found, crossing.argmax(axis=1), -1)
+
+def integrate_charge_block(samples, baseline, rise_time, integration_window=100):
+	n_samples = samples.shape[1]
+	window = rise_time[:, None] + np.arange(integration_window)
+	in_window = (rise_time[:, None] >= 0) & (window < n_samples)
+	gathered = np.take_along_axis(samples, np.clip(window, 0, n_samples - 1), axis=1)
+	return np.sum(np.where(in_window, gathered - baseline[:, None], 0.), axis=1)
+
+def analyze_waveform_block(samples, threshold_method='std_dev', baseline_entries=50, cleaning='false',
+			threshold_absolute=20, threshold_std_dev=5, rise_fraction=5, integration_window=100, cleaning_cutoff=0.10, dtype=np.float64):
+	# dtype of the per-sample temporaries (cleaned waveforms, distances from the baseline): float32 halves the memory
+	# of a block; the baseline statistics and the charge (a window of integration_window samples) are always in float64
+	samples = np.asarray(samples)
+	baseline, std_dev_baseline, min_value = baseline_statistics(samples, baseline_entries)
+	over_threshold = check_threshold_block(baseline, std_dev_baseline, min_value, threshold_method, threshold_absolute, threshold_std_dev)
+
+	# As in Waveform, baseline and minimum are taken before cleaning
+	if(cleaning == 'true'):
+		samples = clean_waveform_block(samples, cleaning_cutoff, None if dtype == np.float64 else dtype)
+
+	sample_baseline = baseline.astype(dtype)
+	rise_time = find_rise_time_block(samples, sample_baseline, sample_baseline - min_value, rise_fraction)
+	rise_time = np.where(over_threshold, rise_time, -1)
+	fired = rise_time >= 0
+	integrated_charge = integrate_charge_block(samples, baseline, rise_time, integration_window)
+
+	return {
+		'baseline': baseline,
+		'std_dev_baseline': std_dev_baseline,
+		'min_value': min_value,
+		'over_threshold': over_threshold,
+		'fired': fired,
+		'rise_time': rise_time,
+		'charge': integrated_charge
+	}
+
+def block_bytes_per_sample(dtype=np.float64, cleaning='false'):
+	# Approximate peak working memory of analyze_waveform_block per sample of the block, on top of the samples:
+	# the distances from the baseline and the crossing mask, with cleaning the cleaned waveforms and (float64 only,
+	# the others are filtered in blocks) the spectrum of the whole block
+	itemsize = np.dtype(dtype).itemsize
+	if cleaning != 'true':
+		return itemsize + 1
+	return (3 if np.dtype(dtype) == np.float64 else 2) * itemsize + 1
+
+# Parameter sweep: several analysis configurations evaluated on the same block.
+# Prefix sums of the samples (and of their squares) give the baseline statistics for any
+# baseline_entries and the charge for any integration window without touching the samples again.
+
+default_config = {
+	'threshold_method': 'std_dev',
+	'threshold_absolute': 20,
+	'threshold_std_dev': 5,
+	'rise_fraction': 5,
+	'baseline_entries': 50,
+	'integration_window': 100
+}
+
+def parameter_grid(**values):
+	# All the combinations of the given parameter values; missing parameters take the default value
+	names = list(default_config)
+	values = {name: values.get(name, [default_config[name]]) for name in names}
+	return [dict(zip(names, combination)) for combination in itertools.product(*(values[name] for name in names))]
+
+def prefix_sums(samples):
+	# Column k holds the sum of the first k samples; integer samples are summed exactly
+	dtype = np.int64 if np.issubdtype(samples.dtype, np.integer) else np.float64
+	sums = np.zeros((samples.shape[0], samples.shape[1] + 1), dtype=dtype)
+	np.cumsum(samples, axis=1, dtype=dtype, out=sums[:, 1:])
+	return sums
+
+def baseline_from_sums(sums, squares, baseline_entries):
+	n = min(baseline_entries, sums.shape[1] - 1)
+	S1 = sums[:, n]
+	S2 = squares[:, n]
+	baseline = S1 / n
+	std_dev_baseline = np.sqrt(np.maximum(n * S2 - S1 * S1, 0) / (n * n))
+	return baseline, std_dev_baseline
+
+def sweep_waveform_block(samples, configs, cleaning='false', cleaning_cutoff=0.10):
+	# One result (as in analyze_waveform_block) per configuration; the shared quantities are computed once
+	samples = np.asarray(samples)
+	n_samples = samples.shape[1]
+	sums = prefix_sums(samples)
+	squares = prefix_sums(samples.astype(sums.dtype) ** 2)
+	min_value = np.min(samples, axis=1) if n_samples > 0 else np.zeros(len(samples))
+	if(cleaning == 'true'):
+		samples = clean_waveform_block(samples, cleaning_cutoff)
+		charge_sums = prefix_sums(samples)
+	else:
+		charge_sums = sums
+
+	baselines, rise_times, charges = {}, {}, {}
+	results = []
+	for config in configs:
+		config = {**default_config, **config}
+		baseline_entries, rise_fraction, integration_window = config['baseline_entries'], config['rise_fraction'], config['integration_window']
+		if baseline_entries not in baselines:
+			baselines[baseline_entries] = baseline_from_sums(sums, squares, baseline_entries)
+		baseline, std_dev_baseline = baselines[baseline_entries]
+		if (baseline_entries, rise_fraction) not in rise_times:
+			rise_times[baseline_entries, rise_fraction] = find_rise_time_block(samples, baseline, baseline - min_value, rise_fraction)
+		rise_time = rise_times[baseline_entries, rise_fraction]
+		if (baseline_entries, rise_fraction, integration_window) not in charges:
+			start = np.clip(rise_time, 0, n_samples)
+			stop = np.minimum(start + integration_window, n_samples)
+			window_sum = np.take_along_axis(charge_sums, stop[:, None], axis=1)[:, 0] - np.take_along_axis(charge_sums, start[:, None], axis=1)[:, 0]
+			charges[baseline_entries, rise_fraction, integration_window] = np.where(rise_time >= 0, window_sum - (stop - start) * baseline, 0.)
+		charge = charges[baseline_entries, rise_fraction, integration_window]
+
+		over_threshold = check_threshold_block(baseline, std_dev_baseline, min_value, config['threshold_method'], config['threshold_absolute'], config['threshold_std_dev'])
+		fired = over_threshold & (rise_time >= 0)
+		results.append({
+			'baseline': baseline,
+			'std_dev_baseline': std_dev_baseline,
+			'min_value': min_value,
+			'over_threshold': over_threshold,
+			'fired': fired,
+			'rise_time': np.where(fired, rise_time, -1),
+			'charge': np.where(fired, charge, 0.)
+		})
+	return results
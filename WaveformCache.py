@@ -0,0 +1,160 @@
+# OSIRIS DECODED WAVEFORM CACHE
+# Decodes the EventTree of a run once into memory-mappable .npy files, which WaveformAnalyzer reads instead of the ROOT file
+# Authors: Davide Basilico davide.basilico@mi.infn.it, Marco Beretta marco.beretta@mi.infn.it
+
+import os
+import re
+import shutil
+import time
+import argparse
+from argparse import RawTextHelpFormatter
+import numpy as np
+import awkward as ak
+import uproot
+from tqdm import tqdm
+from EventReader import read_chunks, entry_step, ReadStats
+from utils import extract_date_and_formatted_date
+
+# One directory per run, named after the run string (e.g. 20240701_120000):
+#   samples.npy    (channels x samples) int16
+#   GCUID.npy, channelID.npy   uint8 per channel
+#   trgSec.npy, trgNsec.npy    int64 per event
+#   offsets.npy    int64, channels of event j are offsets[j]:offsets[j+1]
+#   stamp.npy      size and mtime of the ROOT file the cache was made from
+cache_arrays = ('samples', 'GCUID', 'channelID', 'trgSec', 'trgNsec', 'offsets')
+cache_dtypes = {'samples': np.int16, 'GCUID': np.uint8, 'channelID': np.uint8, 'trgSec': np.int64, 'trgNsec': np.int64}
+
+def default_cache_dir(input_file):
+	return os.path.join(os.path.dirname(os.path.abspath(input_file)), "waveform_cache")
+
+def cache_path(input_file, cache_dir="null"):
+	extracted_string, _ = extract_date_and_formatted_date(input_file)
+	if extracted_string is None:
+		return None
+	return os.path.join(default_cache_dir(input_file) if cache_dir == "null" else cache_dir, extracted_string)
+
+def file_stamp(input_file):
+	return np.array([os.path.getsize(input_file), os.path.getmtime(input_file)])
+
+class WaveformCache:
+	# Read-only memory maps of a run; slices are views on the files, so nothing is copied until it is used
+	def __init__(self, path):
+		self.path = path
+		self.arrays = {name: np.load(os.path.join(path, name + ".npy"), mmap_mode='r') for name in cache_arrays}
+		self.num_entries = len(self.arrays['offsets']) - 1
+
+	def chunk(self, entry_start, entry_stop):
+		# Same flat chunk as EventReader.flatten_events
+		offsets = self.arrays['offsets'][entry_start:entry_stop + 1]
+		lo, hi = offsets[0], offsets[-1]
+		return {
+			'entry_start': entry_start,
+			'n_events': entry_stop - entry_start,
+			'trgTime': self.arrays['trgSec'][entry_start:entry_stop] + 1e-9*self.arrays['trgNsec'][entry_start:entry_stop],
+			'offsets': offsets - lo,
+			'samples': self.arrays['samples'][lo:hi],
+			'GCUID': self.arrays['GCUID'][lo:hi],
+			'channelID': self.arrays['channelID'][lo:hi]
+		}
+
+	def chunks(self, entry_start, entry_stop, step_size="50 MB", stats=None):
+		# step_size in entries (int) or bytes ("50 MB"), converted with the average size of an event
+		step_size = entry_step(step_size)
+		if isinstance(step_size, str):
+			bytes_per_entry = max(self.arrays['samples'].nbytes / max(self.num_entries, 1), 1.)
+			step_size = max(int(memory_size(step_size) / bytes_per_entry), 1)
+		for start in range(entry_start, entry_stop, step_size):
+			time_wait = time.perf_counter()
+			chunk = self.chunk(start, min(start + step_size, entry_stop))
+			if stats is not None:
+				stats.wait_time += time.perf_counter() - time_wait
+				stats.add(chunk)
+			yield chunk
+
+def memory_size(step_size):
+	match = re.fullmatch(r'\s*([0-9.]+)\s*([kMGT]?i?B)\s*', step_size)
+	if match is None:
+		raise ValueError(f"Step size not valid: {step_size}. Please use a number of entries or a size like '50 MB'.")
+	unit = match.group(2)
+	base = 1024 if 'i' in unit else 1000
+	return float(match.group(1)) * base ** ('BkMGT'.index(unit[0]) if unit != 'B' else 0)
+
+def fits_dtype(values, dtype):
+	info = np.iinfo(dtype)
+	return values.size == 0 or (values.min() >= info.min and values.max() <= info.max)
+
+def open_cache(input_file, cache_dir="null"):
+	# The cache of the run if it exists and was made from this very file, None otherwise
+	path = cache_path(input_file, cache_dir)
+	if path is None or not os.path.exists(os.path.join(path, "stamp.npy")):
+		return None
+	if not np.array_equal(np.load(os.path.join(path, "stamp.npy")), file_stamp(input_file)):
+		print("Waveform cache out of date, not used: ", path)
+		return None
+	return WaveformCache(path)
+
+def build_cache(input_file, cache_dir="null", step_size="50 MB"):
+	path = cache_path(input_file, cache_dir)
+	if path is None:
+		raise ValueError(f"No run string (YYYYMMDD_hhmmss) in the file name: {input_file}")
+	tree = uproot.open(input_file)['EventTree']
+	num_entries = int(tree.num_entries)
+	step_size = entry_step(step_size)
+
+	# Channel counts first (small branch), so that the sample matrix can be allocated on disk at once
+	n_channels = ak.to_numpy(ak.num(tree.arrays(["IDdata.channelID"])["IDdata.channelID"]))
+	offsets = np.append(0, np.cumsum(n_channels)).astype(np.int64)
+	first = int(np.argmax(n_channels > 0))
+	n_samples = len(tree.arrays(["IDdata.samples"], entry_start=first, entry_stop=first + 1)["IDdata.samples"][0][0]) if offsets[-1] > 0 else 0
+
+	work_path = path + ".tmp"
+	shutil.rmtree(work_path, ignore_errors=True)
+	os.makedirs(work_path)
+	np.save(os.path.join(work_path, "offsets.npy"), offsets)
+	arrays = {'samples': np.lib.format.open_memmap(os.path.join(work_path, "samples.npy"), mode='w+', dtype=np.int16, shape=(int(offsets[-1]), n_samples))}
+	for name in ('GCUID', 'channelID'):
+		arrays[name] = np.lib.format.open_memmap(os.path.join(work_path, name + ".npy"), mode='w+', dtype=cache_dtypes[name], shape=(int(offsets[-1]),))
+	for name in ('trgSec', 'trgNsec'):
+		arrays[name] = np.lib.format.open_memmap(os.path.join(work_path, name + ".npy"), mode='w+', dtype=cache_dtypes[name], shape=(num_entries,))
+
+	stats = ReadStats()
+	with tqdm(total=num_entries, desc="Caching", unit="events", leave=True) as progress:
+		for events, report in tree.iterate(["trgSec", "trgNsec"], step_size=step_size, report=True):
+			arrays['trgSec'][report.tree_entry_start:report.tree_entry_stop] = ak.to_numpy(events["trgSec"])
+			arrays['trgNsec'][report.tree_entry_start:report.tree_entry_stop] = ak.to_numpy(events["trgNsec"])
+		for chunk in read_chunks(tree, 0, num_entries, step_size, stats=stats):
+			lo, hi = offsets[chunk['entry_start']], offsets[chunk['entry_start'] + chunk['n_events']]
+			for name in ('samples', 'GCUID', 'channelID'):
+				if not fits_dtype(chunk[name], cache_dtypes[name]):
+					raise ValueError(f"{name} out of the {np.dtype(cache_dtypes[name]).name} range, the waveform cache cannot store them.")
+			arrays['samples'][lo:hi] = chunk['samples']
+			arrays['GCUID'][lo:hi] = chunk['GCUID']
+			arrays['channelID'][lo:hi] = chunk['channelID']
+			progress.update(chunk['n_events'])
+	for array in arrays.values():
+		array.flush()
+	del arrays
+
+	# The stamp is written last: a cache without it is incomplete and never used
+	np.save(os.path.join(work_path, "stamp.npy"), file_stamp(input_file))
+	shutil.rmtree(path, ignore_errors=True)
+	os.replace(work_path, path)
+	print(stats.summary())
+	return path
+
+def parse_arguments():
+	prs = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter)
+	prs.add_argument("InputFile", nargs="+", help="Input ROOT file(s) (EventTree)")
+	prs.add_argument("--cache_dir", default="null", help="Cache directory; default: waveform_cache next to each input file")
+	prs.add_argument("-s", "--step_size", default="50 MB", help="Size of the chunks read from EventTree; default: 50 MB")
+	return prs.parse_args()
+
+def main():
+	args = parse_arguments()
+	print("### Welcome to the HORUS waveform cache ###")
+	for input_file in args.InputFile:
+		path = build_cache(input_file, args.cache_dir, args.step_size)
+		print("Waveform cache created: ", path)
+
+if __name__ == "__main__":
+	main()
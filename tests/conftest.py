@@ -0,0 +1,22 @@
+import os
+import sys
+import pandas as pd
+import pytest
+
+# The modules of HORUS are scripts in the top directory of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+@pytest.fixture(scope="session")
+def synthetic_run(tmp_path_factory):
+	# Short synthetic run with many muons (see SyntheticEventTree.py), shared by the tests
+	from SyntheticEventTree import generate_run
+	path = str(tmp_path_factory.mktemp("runs") / "SYN_20240101_000000.root")
+	generate_run(path, duration=1., muon_rate=20., seed=7)
+	return path
+
+@pytest.fixture(scope="session")
+def synthetic_hits(synthetic_run):
+	# Hit table of synthetic_run, as WaveformAnalyzer makes it
+	from WaveformAnalyzer import analyze_file
+	from HitTable import concatenate_hits
+	return pd.DataFrame(concatenate_hits(list(analyze_file(synthetic_run, use_cache="false"))))
@@ -0,0 +1,40 @@
+import numpy as np
+import pandas as pd
+import pytest
+from HitTable import HitWriter, read_hits, iterate_hits, concatenate_hits, table_dtypes, compact_hit_dtypes
+from WaveformAnalyzer import analyze_file
+from EventReconstruction import process_data, load_dtypes
+from Benchmark import compact_tolerances, compact_max_mismatch, outside_tolerances
+
+def analyzed_hits(input_file, cleaning, compact):
+	return pd.DataFrame(concatenate_hits(list(analyze_file(input_file, cleaning=cleaning, use_cache="false", compact=compact)), table_dtypes('false', compact)))
+
+@pytest.fixture(scope="module")
+def compact_hits(synthetic_run):
+	return analyzed_hits(synthetic_run, 'false', 'true')
+
+@pytest.mark.parametrize("output_format", ["txt", "root"])
+def test_compact_hit_files_read_back_the_same(compact_hits, tmp_path, output_format):
+	path = str(tmp_path / f"hits.{output_format}")
+	with HitWriter(path, output_format, "20240101_000000", "2024-01-01", buffer_rows=1000, dtypes=compact_hit_dtypes) as writer:
+		for start in range(0, len(compact_hits), 1500):
+			writer.write({key: values[start:start + 1500] for key, values in compact_hits.items()})
+	loaded = read_hits(path, load_dtypes("true"))[list(compact_hit_dtypes)]
+	pd.testing.assert_frame_equal(loaded, compact_hits)
+	chunks = list(iterate_hits(path, 777, load_dtypes("true")))
+	assert [last for _, last in chunks] == [False] * (len(chunks) - 1) + [True]
+	pd.testing.assert_frame_equal(pd.concat([hits for hits, _ in chunks], ignore_index=True)[list(compact_hit_dtypes)], compact_hits)
+
+@pytest.mark.parametrize("cleaning", ["false", "true"])
+def test_compact_analysis_is_within_the_tolerances(synthetic_run, cleaning):
+	# Same check as Benchmark.py --compact true: hits and events against those of the float64 analysis
+	hits = analyzed_hits(synthetic_run, cleaning, 'false')
+	compact = analyzed_hits(synthetic_run, cleaning, 'true')
+	assert all(compact[key].dtype == dtype for key, dtype in compact_hit_dtypes.items())
+	outside = {
+		'hits': outside_tolerances(hits, compact, compact_tolerances['hits']),
+		'events': outside_tolerances(process_data(hits).events, process_data(compact).events, compact_tolerances['events'])
+	}
+	for table, fractions in outside.items():
+		for name, fraction in fractions.items():
+			assert fraction <= compact_max_mismatch, f"{table}.{name}"
@@ -0,0 +1,27 @@
+import os
+import json
+import numpy as np
+import pytest
+from EventReconstruction import RecWriter, process_data, calculate_energies
+from EventStore import build_store, EventStore
+
+@pytest.mark.parametrize("trigger_times", ["finite", "nan", "none"])
+def test_meta_has_a_time_range_only_with_finite_trigger_times(synthetic_hits, tmp_path, trigger_times):
+	results = calculate_energies(process_data(synthetic_hits))
+	if trigger_times == "nan":
+		results.events['trgTime'] = np.nan
+	elif trigger_times == "none":
+		results = results.take(slice(0, 0))
+	rec_file = str(tmp_path / "rec.root")
+	with RecWriter(rec_file) as writer:
+		writer.write(results)
+	build_store([rec_file], str(tmp_path / "store"))
+	with open(os.path.join(tmp_path, "store", "meta.json")) as f:
+		meta = json.load(f, parse_constant=lambda name: pytest.fail(f"{name} in meta.json"))
+	run = meta['runs'][0]
+	assert run['events'] == len(results)
+	if trigger_times == "finite":
+		assert (run['t_min'], run['t_max']) == (np.nanmin(results.events['trgTime']), np.nanmax(results.events['trgTime']))
+	else:
+		assert run['t_min'] is None and run['t_max'] is None
+		assert EventStore(str(tmp_path / "store")).time_range() == (None, None)
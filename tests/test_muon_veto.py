@@ -0,0 +1,61 @@
+import numpy as np
+import pandas as pd
+import pytest
+from MuonVeto import muon_times, veto_mask, vetoed_live_time
+
+def loop_veto(results, threshold, window):
+	# The per-muon loop of the original EventReconstruction.apply_muon_veto
+	od_mult = results['OD_fired'] >= threshold
+	for index, row in results[od_mult].iterrows():
+		time_diff_condition = (results['trgTime'] - row['trgTime']).abs() < window
+		results = results.loc[~time_diff_condition]
+	return results.loc[~od_mult]
+
+def merged_live_time(muons, window, t_start, t_stop):
+	# Length of the union of the muon windows within [t_start, t_stop], merging the windows one at a time
+	total, covered = 0., -np.inf
+	for t in np.sort(muons):
+		start, stop = max(t - window, covered, t_start), min(t + window, t_stop)
+		total += max(stop - start, 0.)
+		covered = max(covered, t + window)
+	return total
+
+def grid_events():
+	# Times on a binary grid, so that the distances to the muons are exact: events exactly one window away from a muon,
+	# muons closer than two windows (overlapping windows), events at the time of a muon, a muon and an event without a time
+	trgTime = np.arange(64) * 0.125
+	OD_fired = np.zeros(64, dtype=np.int32)
+	OD_fired[[4, 10, 13, 14, 30, 50]] = [5, 7, 5, 9, 6, 12]
+	trgTime[[20, 50]] = np.nan
+	trgTime[31] = trgTime[30]
+	return pd.DataFrame({'trgTime': trgTime, 'OD_fired': OD_fired}, index=pd.Index(np.arange(64) + 100, name='index'))
+
+def random_events(n=5000, seed=3):
+	# Real trigger times (~1.7e9 s, so |dt| is rounded) with muons often within two windows of each other
+	rng = np.random.default_rng(seed)
+	trgTime = 1.7e9 + np.cumsum(rng.exponential(5e-6, n))
+	OD_fired = np.where(rng.uniform(0, 1, n) < 0.05, rng.integers(5, 30, n), rng.integers(0, 5, n))
+	return pd.DataFrame({'trgTime': trgTime, 'OD_fired': OD_fired}, index=pd.Index(np.arange(n), name='index'))
+
+@pytest.mark.parametrize("events, window", [(grid_events(), 0.25), (grid_events(), 0.5), (random_events(), 20e-6)])
+def test_veto_mask_is_the_loop_veto(events, window):
+	trgTime, OD_fired = events['trgTime'].to_numpy(), events['OD_fired'].to_numpy()
+	muons = muon_times(trgTime, OD_fired, 5)
+	assert np.any(np.diff(muons) < 2 * window)
+	vetoed = veto_mask(trgTime, muons, window) | (OD_fired >= 5)
+	assert np.array_equal(events.index[~vetoed], loop_veto(events, 5, window).index)
+
+def test_events_one_window_away_are_kept():
+	events = grid_events()
+	vetoed = veto_mask(events['trgTime'].to_numpy(), muon_times(events['trgTime'].to_numpy(), events['OD_fired'].to_numpy(), 5), 0.25)
+	# Muon at 0.5 s (row 4): rows 2 and 6 are exactly 0.25 s away, rows 3 and 5 within
+	assert list(vetoed[1:8]) == [False, False, True, True, True, False, False]
+
+@pytest.mark.parametrize("events, window", [(grid_events(), 0.25), (grid_events(), 0.5), (random_events(), 20e-6)])
+def test_vetoed_live_time_is_the_union_of_the_windows(events, window):
+	trgTime = events['trgTime'].to_numpy()
+	muons = muon_times(trgTime, events['OD_fired'].to_numpy(), 5)
+	t_start, t_stop = np.nanmin(trgTime), np.nanmax(trgTime)
+	expected = merged_live_time(muons - t_start, window, 0., t_stop - t_start)
+	assert expected < len(muons) * 2 * window
+	assert np.isclose(vetoed_live_time(muons, window, t_start, t_stop), expected, rtol=1e-12, atol=1e-15)
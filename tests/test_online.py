@@ -0,0 +1,78 @@
+import shutil
+from contextlib import closing
+import numpy as np
+import pandas as pd
+import pytest
+import Online
+from Online import OnlineReconstruction, RollingCoincidences, Publisher
+from WaveformAnalyzer import open_events
+from Coincidence import find_coincidences, Po_tau, hmTau, EB_min, EB_max, EP_min, EP_max, r_cut
+
+def bipo_like_events(n=3000, seed=4):
+	# Time-ordered events close enough in time, energy and space to make many pairs, some beyond r_cut
+	rng = np.random.default_rng(seed)
+	position = rng.normal(0., 2500., (n, 3))
+	return pd.DataFrame({
+		'trgTime': 1.7e9 + np.cumsum(rng.exponential(200e-6, n)),
+		'Energy_Prompt': rng.uniform(0., 2.5, n),
+		'x_CM': position[:, 0],
+		'y_CM': position[:, 1],
+		'z_CM': position[:, 2]
+	}, index=pd.Index(np.arange(n) + 10, name='index'))
+
+def sorted_pairs(pairs):
+	return pairs.sort_values(['prompt_index', 'delayed_index']).reset_index(drop=True)
+
+@pytest.mark.parametrize("batch_size", [1, 7, 250, 3000])
+def test_rolling_pairs_are_the_pairs_of_the_whole_run(batch_size):
+	events = bipo_like_events()
+	expected = find_coincidences(events, Po_tau * hmTau, 0., EB_min, EB_max, EP_min, EP_max, r_cut, energy='Energy_Prompt')
+	coincidences = RollingCoincidences()
+	found = [coincidences.add(events.iloc[:0])]
+	for start in range(0, len(events), batch_size):
+		found.append(coincidences.add(events.iloc[start:start + batch_size]))
+	pairs = pd.concat(found)
+	assert len(expected) > 100
+	assert coincidences.pairs == len(expected)
+	pd.testing.assert_frame_equal(sorted_pairs(pairs), sorted_pairs(expected))
+
+def failing_open_events(fail_at_chunk):
+	# Online.open_events whose chunk reader raises a read error once, when the given chunk is read
+	state = {'failed': False}
+	def open_events_with_error(file_path, use_cache):
+		num_entries, chunks, source = open_events(file_path, use_cache)
+		def failing_chunks(entry_start, entry_stop, step_size):
+			with closing(chunks(entry_start, entry_stop, step_size)) as run_chunks:
+				for k, chunk in enumerate(run_chunks):
+					if k == fail_at_chunk and not state['failed']:
+						state['failed'] = True
+						raise OSError("simulated read error")
+					yield chunk
+		return num_entries, failing_chunks, source
+	return open_events_with_error, state
+
+def follow_run(directory, status_file):
+	online = OnlineReconstruction(directory, [Publisher(status_file)], step_size="20")
+	while online.poll() > 0:
+		pass
+	return online.close()
+
+@pytest.mark.parametrize("fail_at_chunk", [0, 3])
+def test_read_error_is_resumed_without_double_counting(synthetic_run, tmp_path, monkeypatch, fail_at_chunk):
+	directory = tmp_path / "runs"
+	directory.mkdir()
+	shutil.copy(synthetic_run, directory)
+	expected = follow_run(str(directory), str(tmp_path / "expected.json"))
+
+	open_events_with_error, state = failing_open_events(fail_at_chunk)
+	monkeypatch.setattr(Online, "open_events", open_events_with_error)
+	online = OnlineReconstruction(str(directory), [Publisher(str(tmp_path / "status.json"))], step_size="20")
+	entries = online.poll()
+	assert state['failed']
+	assert entries == 20 * fail_at_chunk
+	while online.poll() > 0:
+		pass
+	status = online.close()
+	assert expected['entries'] > 100
+	for name in ('entries', 'hits', 'events', 'muons', 'vetoed_events', 'coincidences', 'runs'):
+		assert status[name] == expected[name], name
@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+from utils import generate_synthetic_waveform
+from WaveformBatch import analyze_waveform_block
+from PulseFinder import analyze_pulses_block
+
+def two_gaussian_waveforms(n=300, seed=1):
+	# Synthetic waveforms of utils (two Gaussians 200 samples apart) with various amplitudes, centers and widths; one in six is noise only
+	np.random.seed(seed)
+	rows, params = [], []
+	for k in range(n):
+		synth_params = {'flat_height': 11000, 'gaussian_amplitude': 0 if k % 6 == 0 else -30 - 25 * (k % 40), 'gaussian_center': 60 + (7 * k) % 330, 'gaussian_width': 3 + k % 12}
+		rows.append(generate_synthetic_waveform(synth_params))
+		params.append(synth_params)
+	return np.array(rows), params
+
+@pytest.mark.parametrize("cleaning", ["false", "true"])
+@pytest.mark.parametrize("method", ["std_dev", "baseline"])
+def test_first_pulse_is_the_single_pulse(method, cleaning):
+	samples, _ = two_gaussian_waveforms()
+	single = analyze_waveform_block(samples, method, 50, cleaning)
+	pulses = analyze_pulses_block(samples, method, 50, cleaning)
+	n_pulses = np.diff(pulses['offsets'])
+	assert np.array_equal(n_pulses > 0, single['fired'])
+	first = pulses['offsets'][:-1][single['fired']]
+	assert np.array_equal(pulses['start'][first], single['rise_time'][single['fired']])
+	# The charge of the first pulse stops at the next one, the single-pulse charge does not
+	next_start = np.where(n_pulses[single['fired']] > 1, pulses['start'][np.minimum(first + 1, len(pulses['start']) - 1)], samples.shape[1])
+	alone = next_start >= pulses['start'][first] + 100
+	assert alone.mean() > 0.9
+	assert np.allclose(pulses['charge'][first][alone], single['charge'][single['fired']][alone], rtol=1e-9, atol=1e-6)
+
+def test_second_gaussian_is_found():
+	samples, params = two_gaussian_waveforms()
+	pulses = analyze_pulses_block(samples, 'std_dev', 50)
+	n_pulses = np.diff(pulses['offsets'])
+	for i, synth_params in enumerate(params):
+		if synth_params['gaussian_amplitude'] > -200:
+			continue
+		assert n_pulses[i] == 2
+		second = pulses['offsets'][i] + 1
+		assert abs(pulses['peak'][second] - (synth_params['gaussian_center'] + 200)) <= 3
+
+def test_noise_sample_is_not_a_pulse():
+	# One noise sample over threshold before and one after a large pulse: the first pulse is still the large one,
+	# and neither sample is a pulse of its own
+	np.random.seed(2)
+	samples = generate_synthetic_waveform({'flat_height': 11000, 'gaussian_amplitude': 0, 'gaussian_center': 250, 'gaussian_width': 10})
+	samples -= 2000 * np.exp(-0.5 * ((np.arange(600) - 300) / 8) ** 2)
+	samples[20] -= 60
+	samples[520] -= 60
+	single = analyze_waveform_block(samples[None, :], 'std_dev', 50)
+	pulses = analyze_pulses_block(samples[None, :], 'std_dev', 50)
+	assert list(pulses['offsets']) == [0, 1]
+	assert pulses['start'][0] == single['rise_time'][0]
+	assert abs(pulses['peak'][0] - 300) <= 2
@@ -0,0 +1,56 @@
+import numpy as np
+import pandas as pd
+import awkward as ak
+import pytest
+from RecoKernel import segment_offsets, segment_kahan_sums, segment_means, EventTable
+
+def random_hits(n=20000, n_events=2000, seed=1, sort=False):
+	# Hits of random events in random order (or sorted), with NaN values, and one event with NaN only;
+	# the values span large offsets (trigger times) and small ones, where the summation order matters
+	rng = np.random.default_rng(seed)
+	index = rng.integers(0, n_events, n)
+	if sort:
+		index = np.sort(index)
+	values = rng.normal(0., 1., (n, 3)) * np.array([1e4, 1., 1e-3]) + np.array([1.7e9, 0., 0.])
+	values[rng.uniform(0, 1, (n, 3)) < 0.2] = np.nan
+	values[index == index[n // 2]] = np.nan
+	return index, values
+
+def segment_reduction(index, values):
+	order, events, offsets = segment_offsets(index)
+	sums, counts = segment_kahan_sums(values if order is None else values[order], offsets)
+	return events, sums, counts, segment_means(sums, counts)
+
+@pytest.mark.parametrize("sort", [False, True])
+def test_segment_sums_are_the_groupby_sums(sort):
+	index, values = random_hits(sort=sort)
+	events, sums, counts, means = segment_reduction(index, values)
+	grouped = pd.DataFrame(values).assign(index=index).groupby('index')
+	assert np.array_equal(events, grouped.sum().index.to_numpy())
+	assert np.array_equal(sums, grouped.sum().to_numpy())
+	assert np.array_equal(counts, grouped.count().to_numpy())
+	assert np.array_equal(means, grouped.mean().to_numpy(), equal_nan=True)
+
+def test_segment_sums_of_no_hits():
+	events, sums, counts, means = segment_reduction(np.array([], dtype=np.int64), np.zeros((0, 3)))
+	assert len(events) == 0 and sums.shape == (0, 3) and counts.shape == (0, 3) and means.shape == (0, 3)
+
+def event_table(counts, first_event=0):
+	# Events numbered from first_event with counts[i] hits whose values are event * 1000 + hit
+	events = pd.DataFrame({'Hits': counts}, index=pd.Index(np.arange(len(counts)) + first_event, name='index'))
+	values = np.concatenate([np.full(count, 1000. * (first_event + i)) + np.arange(count) for i, count in enumerate(counts)])
+	return EventTable(events, {'TOF': values, 'Pulse': np.zeros(len(values), dtype=np.int32)}, np.append(0, np.cumsum(counts)))
+
+def expected_hits(table):
+	return [[1000. * event + hit for hit in range(count)] for event, count in zip(table.events.index, table.events['Hits'])]
+
+def test_event_table_keeps_the_hits_of_its_rows():
+	table = event_table(np.array([3, 0, 2, 5, 1, 4]))
+	assert table.jagged('TOF').tolist() == expected_hits(table)
+	for rows in (np.array([5, 0, 3]), np.array([True, False, False, True, True, False]), slice(2, None), np.array([], dtype=np.int64)):
+		selected = table.take(rows)
+		assert selected.jagged('TOF').tolist() == expected_hits(selected)
+		assert selected.offsets[0] == 0 and selected.offsets[-1] == len(selected.hits['TOF']) == len(selected.hits['Pulse'])
+	joined = EventTable.concat([table.take(np.array([1, 3])), None, event_table(np.array([2, 2]), first_event=10)])
+	assert list(joined.events.index) == [1, 3, 10, 11]
+	assert ak.to_list(joined.jagged('TOF')) == expected_hits(joined)
@@ -0,0 +1,42 @@
+import awkward as ak
+import pytest
+import uproot
+from EventReconstruction import RecWriter, StreamingReconstruction, process_data, apply_muon_veto, calculate_energies
+
+def read_rec_arrays(path):
+	with uproot.open(path) as f:
+		return f["RecEvents"].arrays(library="ak")
+
+def reconstruct_in_memory(hits, path, muon):
+	results = process_data(hits)
+	if muon:
+		results = apply_muon_veto(results, 5, 20E-6)
+	results = calculate_energies(results)
+	with RecWriter(path) as writer:
+		writer.write(results)
+	return len(results)
+
+def reconstruct_streamed(hits, path, muon, chunk_size):
+	with RecWriter(path) as writer:
+		stream = StreamingReconstruction(writer, muon, 5, 20E-6)
+		for start in range(0, len(hits), chunk_size):
+			stream.add_hits(hits.iloc[start:start + chunk_size].reset_index(drop=True), last_chunk=start + chunk_size >= len(hits))
+		stream.close()
+
+@pytest.mark.parametrize("chunk_size", [37, 1000, 10 ** 7])
+@pytest.mark.parametrize("muon", [True, False])
+def test_streamed_output_is_the_in_memory_output(synthetic_hits, tmp_path, muon, chunk_size):
+	# Events cut by the chunk boundaries, muons vetoing events of the previous chunks and Energy_Delayed
+	# of the last event of a chunk must all come out as in the reconstruction of the whole run
+	n_events = reconstruct_in_memory(synthetic_hits, str(tmp_path / "memory.root"), muon)
+	reconstruct_streamed(synthetic_hits, str(tmp_path / "stream.root"), muon, chunk_size)
+	expected, streamed = read_rec_arrays(str(tmp_path / "memory.root")), read_rec_arrays(str(tmp_path / "stream.root"))
+	assert n_events > 100
+	assert expected.fields == streamed.fields
+	for name in expected.fields:
+		assert ak.array_equal(streamed[name], expected[name], equal_nan=True), name
+
+def test_synthetic_run_is_muon_rich(synthetic_hits):
+	# Otherwise the comparison above would not cover the veto across chunks
+	results = process_data(synthetic_hits)
+	assert len(results) - len(apply_muon_veto(results, 5, 20E-6)) > 20
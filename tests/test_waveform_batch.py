@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+from utils import generate_synthetic_waveform
+from Waveform import Waveform
+from WaveformBatch import analyze_waveform_block
+
+def synthetic_waveforms(n=200, seed=3):
+	# Synthetic waveforms of utils (two Gaussians) with various amplitudes, centers and widths, as uint16 ADC counts like
+	# the EventTree samples, and noise-only ones
+	np.random.seed(seed)
+	rows = [generate_synthetic_waveform({'flat_height': 11000, 'gaussian_amplitude': -15 - 20 * (k % 50), 'gaussian_center': 40 + (11 * k) % 350, 'gaussian_width': 2 + k % 15}) for k in range(n)]
+	return np.rint(np.array(rows)).astype(np.uint16)
+
+def noise_waveforms(n=200, seed=4):
+	np.random.seed(seed)
+	rows = [generate_synthetic_waveform({'flat_height': 11000, 'gaussian_amplitude': 0, 'gaussian_center': 250, 'gaussian_width': 10}) for k in range(n)]
+	return np.array(rows)
+
+@pytest.mark.parametrize("cleaning", ["false", "true"])
+@pytest.mark.parametrize("method", ["baseline", "std_dev"])
+@pytest.mark.parametrize("waveforms", [synthetic_waveforms, noise_waveforms])
+def test_block_matches_waveform(waveforms, method, cleaning):
+	samples = waveforms()
+	result = analyze_waveform_block(samples, threshold_method=method, baseline_entries=50, cleaning=cleaning)
+	for i, row in enumerate(samples):
+		fired_PMTs, integrated_charge, rise_time = Waveform(row, threshold_method=method, baseline_entries=50, cleaning=cleaning).analyze_waveform()
+		assert result['fired'][i] == (fired_PMTs == 1)
+		assert result['rise_time'][i] == (rise_time if rise_time is not None else -1)
+		assert result['charge'][i] == pytest.approx(integrated_charge, rel=1e-9, abs=1e-6)
+	if waveforms is synthetic_waveforms:
+		assert result['fired'].mean() > 0.5
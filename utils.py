@@ -3,6 +3,7 @@ import re
 import numpy as np
 from datetime import datetime
 from numba import njit,jit
+from CableMap import load_cable_map
 
 def print_progress(j, total_events, next_percentage):
     percentage_done = (j + 1) / total_events * 100
@@ -14,9 +15,10 @@ def print_progress(j, total_events, next_percentage):
     
 def extract_date_and_formatted_date(input_string):
 	match = re.search(r'(\d{8})_(\d{6})', input_string) # Isolate the date 
-	if match:
-		extracted_string = match.group(0)  # Full string
-		extracted_date_string = match.group(1)  # Only date
+	if not match:
+		return None, None  # no run string (YYYYMMDD_hhmmss)
+	extracted_string = match.group(0)  # Full string
+	extracted_date_string = match.group(1)  # Only date
 	try:
 		extracted_date = datetime.strptime(extracted_date_string, "%Y%m%d").date()
 		formatted_date = extracted_date.strftime("%Y-%m-%d")
@@ -25,22 +27,23 @@ def extract_date_and_formatted_date(input_string):
 		return None, None
 
 def read_all_PMTs_coordinates(nome_file):
-	x = np.array([])
-	y = np.array([])
-	z = np.array([])
-	gain_corr = np.array([])
+	x = []
+	y = []
+	z = []
+	gain_corr = []
 	with open(nome_file, 'r') as file:
 		for line in file:
 			columns = line.strip().split('\t')
 			try:
-				x = np.append(x, float(columns[11]))
-				y = np.append(y, float(columns[12]))
-				z = np.append(z, float(columns[13]))
-				gain_corr = np.append(gain_corr,float(columns[14]))
-				#theta = np.append(theta, np.sign(float(columns[-2])) * np.arccos(float(columns[-3]) / np.sqrt(float(columns[-3])**2 + float(columns[-2])**2)))
+				row = (float(columns[11]), float(columns[12]), float(columns[13]), float(columns[14]))
 			except ValueError:
 				continue
-	return x, y, z, gain_corr
+			x.append(row[0])
+			y.append(row[1])
+			z.append(row[2])
+			gain_corr.append(row[3])
+			#theta = np.append(theta, np.sign(float(columns[-2])) * np.arccos(float(columns[-3]) / np.sqrt(float(columns[-3])**2 + float(columns[-2])**2)))
+	return np.array(x), np.array(y), np.array(z), np.array(gain_corr)
 
 def load_PMT_coordinates(file_path):
     PMT_coordinates = {}
@@ -61,19 +64,11 @@ def load_PMT_coordinates(file_path):
         print("PMT coordinates file not found.")
     return PMT_coordinates, gain_corr
 
-PMT_coordinates_data, gain_corr_data = load_PMT_coordinates("OSIRIS_cable_map_N.conf")
-
 def find_PMT_Coordinates(GCUID_data, GCUChannel_data):
-    GCUID_data = int(GCUID_data)
-    GCUChannel_data_halved = int(GCUChannel_data) // 2
-    #print(PMT_coordinates_data[GCUID_data])
-    #print("############")
-    #print(GCUID_data,GCUChannel_data_halved)
-    #print(PMT_coordinates_data[GCUID_data])
-    if GCUID_data in PMT_coordinates_data and GCUChannel_data_halved in PMT_coordinates_data[GCUID_data]:
-        #print("OK", GCUID_data, GCUChannel_data, GCUChannel_data_halved, PMT_coordinates_data[GCUID_data][GCUChannel_data_halved], gain_corr_data[GCUID_data][GCUChannel_data_halved])
-        #print("############")
-        return PMT_coordinates_data[GCUID_data][GCUChannel_data_halved], gain_corr_data[GCUID_data][GCUChannel_data_halved]
+    # Scalar lookup kept for compatibility; use CableMap.gather for whole blocks of channels
+    x, y, z, gain_corr, OD, live = load_cable_map().gather(GCUID_data, GCUChannel_data)
+    if live:
+        return (float(x), float(y), float(z)), float(gain_corr)
     else:
         return ((0,0,0),0)
         